@@ -1,11 +1,23 @@
+import bisect
 import tkinter as tk
 from tkinter import ttk, messagebox
 from datetime import datetime, timedelta
-import sqlite3
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+import numpy as np
+
+from data_access import DeviceCatalogue, available_dates, load_series
+from day_cache import DayLoader
+from db import ConnectionPool
+from live import POLL_MS, TailFollower
+from rendering import DayPlot
+from rollups import POINTS_MIN
+from schema import SchemaError, check_schema
 
 DB_FILE = "mesures_bme280.db"
+POINTS_DEFILEMENT = 24  # une journée en moyennes horaires
+VITESSES = [1, 5, 25]
+NB_PRECHARGEES = 3
 
 class App(tk.Tk):
     def __init__(self):
@@ -20,7 +32,6 @@ class App(tk.Tk):
             "pressure": tk.BooleanVar(value=True),
         }
         self.current_date = None
-        self.timestamps = []
         self.available_dates = []
         self.min_date = None
         self.max_date = None
@@ -28,8 +39,18 @@ class App(tk.Tk):
 
         self.accel_speed = 0  # 0=normal, 1=rapide, 2=très rapide
         self.auto_scroll_job = None
+        # Mode direct : vue affichée (appareil, début, résolution) et suiveur de la base
+        self.shown_view = None
+        self.live = tk.BooleanVar(value=False)
+        self.follower = None
+        self.live_job = None
+        self.pool = ConnectionPool(DB_FILE)
+        self.catalogue = DeviceCatalogue(self.pool)
 
         self.create_widgets()
+        # Journées lues en arrière-plan : le défilement ne bloque jamais sur le disque
+        self.loader = DayLoader(self, self.pool, self.load_day)
+        self.check_schema()
         self.refresh_devices()
 
     def create_widgets(self):
@@ -74,6 +95,9 @@ class App(tk.Tk):
         btn_quit = ttk.Button(top_frame, text="Quitter", command=self.quit)
         btn_quit.pack(side=tk.RIGHT, padx=10)
 
+        ttk.Checkbutton(top_frame, text="Direct", variable=self.live,
+                        command=self.toggle_live).pack(side=tk.RIGHT, padx=5)
+
         # Champ date saisie + bouton
         ttk.Label(top_frame, text="Aller à la date (YYYY-MM-DD):").pack(side=tk.LEFT, padx=(20, 3))
         self.date_entry = ttk.Entry(top_frame, width=12)
@@ -90,19 +114,20 @@ class App(tk.Tk):
         self.fig, self.axes = plt.subplots(3, 1, figsize=(8, 6), sharex=True)
         plt.subplots_adjust(top=0.88, bottom=0.1, left=0.1, right=0.95, hspace=0.35)
 
-        for ax, voie in zip(self.axes, ["temperature", "humidity", "pressure"]):
-            ax.set_ylabel(voie.capitalize())
-            ax.grid(True)
-
         self.canvas = FigureCanvasTkAgg(self.fig, master=self)
         self.canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
+        # Courbes persistantes, mises à jour sans tout redessiner
+        self.day_plot = DayPlot(self.canvas, self.axes)
+
+    def check_schema(self):
+        try:
+            with self.pool.connection() as conn:
+                check_schema(conn)
+        except SchemaError as e:
+            messagebox.showwarning("Schéma de la base", str(e))
 
     def refresh_devices(self):
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute("SELECT DISTINCT device FROM mesures ORDER BY device")
-        devices = [row[0] for row in cursor.fetchall()]
-        conn.close()
+        devices = self.catalogue.devices(rafraichir=True)
         # Accepter tous les devices y compris simulés
         self.device_combo['values'] = devices
         if devices:
@@ -118,25 +143,13 @@ class App(tk.Tk):
         device = self.device_combo.get()
         if not device:
             return
-        capteurs = [f"{device}_BME1", f"{device}_BME2"]
-
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute(f"""
-            SELECT timestamp, temperature, humidity, pressure
-            FROM mesures
-            WHERE device=?
-            ORDER BY timestamp
-        """, (device,))
-        rows = cursor.fetchall()
-        conn.close()
-
-        self.timestamps = [datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S") for row in rows]
-        self.available_dates = sorted(set(ts.date() for ts in self.timestamps))
-
-        if self.timestamps:
-            self.min_date = self.timestamps[0]
-            self.max_date = self.timestamps[-1]
+
+        with self.pool.connection() as conn:
+            self.available_dates = available_dates(conn, [device])
+
+        if self.available_dates:
+            self.min_date = datetime.combine(self.available_dates[0], datetime.min.time())
+            self.max_date = datetime.combine(self.available_dates[-1], datetime.min.time())
             self.no_data = False
             # Affiche la première date ou aujourd'hui si présente
             date_to_show = datetime.now().date() if datetime.now().date() in self.available_dates else self.min_date.date()
@@ -145,10 +158,7 @@ class App(tk.Tk):
             self.no_data = True
             self.min_date = datetime.now()
             self.max_date = datetime.now()
-            for ax in self.axes:
-                ax.clear()
-                ax.set_title("Aucune donnée")
-            self.canvas.draw()
+            self.day_plot.clear(f"{device} - Aucune donnée")
 
     def plot_for_date(self, selected_date):
         self.current_date = selected_date
@@ -162,59 +172,42 @@ class App(tk.Tk):
         self.plot_data(device, start, end)
 
     def plot_data(self, device, start, end):
-        capteur1 = f"{device}_BME1"
-        capteur2 = f"{device}_BME2"
-
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute(f"""
-            SELECT timestamp, temperature, humidity, pressure
-            FROM mesures
-            WHERE device=?
-              AND timestamp >= ?
-              AND timestamp < ?
-            ORDER BY timestamp
-        """, (device, start.strftime("%Y-%m-%d %H:%M:%S"), end.strftime("%Y-%m-%d %H:%M:%S")))
-        rows = cursor.fetchall()
-        conn.close()
-
-        self.fig.suptitle(f"{device} - {start.date()}", fontsize=14)
-
-        # Préparation des listes
-        times = [datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S") for row in rows]
-        temperature = [row[1] for row in rows]
-        humidity = [row[2] for row in rows]
-        pressure = [row[3] for row in rows]
-
-        # On efface les graphiques
-        for ax in self.axes:
-            ax.clear()
-
-        # On affiche les données selon sélection des voies
-        if self.selected_channels["temperature"].get():
-            self.axes[0].plot(times, temperature, label="Température", color="red")
-            self.axes[0].set_ylabel("Température (°C)")
-            self.axes[0].grid(True)
-        else:
-            self.axes[0].set_ylabel("")
-        if self.selected_channels["humidity"].get():
-            self.axes[1].plot(times, humidity, label="Humidité", color="blue")
-            self.axes[1].set_ylabel("Humidité (%)")
-            self.axes[1].grid(True)
-        else:
-            self.axes[1].set_ylabel("")
-        if self.selected_channels["pressure"].get():
-            self.axes[2].plot(times, pressure, label="Pression", color="green")
-            self.axes[2].set_ylabel("Pression (hPa)")
-            self.axes[2].grid(True)
-        else:
-            self.axes[2].set_ylabel("")
-
-        for ax in self.axes:
-            ax.set_xlabel("Heure")
-            ax.legend(loc="upper right")
-
-        self.canvas.draw()
+        # En défilement très rapide (x25), moyennes horaires pré-agrégées ;
+        # la vue brute revient au relâchement du bouton
+        points_min = POINTS_DEFILEMENT if self.accel_speed >= 2 else POINTS_MIN
+        # Une journée qui n'est pas finie est toujours relue
+        self.loader.get((device, start, end, points_min),
+                        lambda valeur: self.show_series(device, start, end, valeur),
+                        erreur=lambda e: messagebox.showerror("Lecture de la base", str(e)),
+                        frais=end > datetime.now())
+        if not self.auto_scroll_job:
+            self.prefetch_days([start.date() - timedelta(days=1), start.date() + timedelta(days=1)],
+                               points_min)
+
+    def load_day(self, conn, cle):
+        # Thread de chargement
+        device, start, end, points_min = cle
+        return load_series(conn, device, start, end, points_min)
+
+    def prefetch_days(self, dates, points_min):
+        device = self.device_combo.get()
+        if not device or self.no_data:
+            return
+        cles = []
+        for d in dates:
+            if self.min_date.date() <= d <= self.max_date.date():
+                start = datetime.combine(d, datetime.min.time())
+                cles.append((device, start, start + timedelta(days=1), points_min))
+        self.loader.prefetch(cles)
+
+    def show_series(self, device, start, end, valeur):
+        resolution, times, valeurs = valeur
+        self.shown_view = (device, start, resolution)
+        titre = f"{device} - {start.date()}"
+        if resolution:
+            titre += f" (moyennes {resolution})"
+        visibles = {voie: var.get() for voie, var in self.selected_channels.items()}
+        self.day_plot.update(start, end, times, valeurs, visibles, titre)
 
     def refresh_plot(self):
         if self.current_date:
@@ -235,6 +228,48 @@ class App(tk.Tk):
             prev = self.current_date - timedelta(days=7)
             self.plot_for_date(prev)
 
+    def toggle_live(self):
+        if self.live.get():
+            self.follower = TailFollower(DB_FILE)
+            self.select_today()
+            self.live_job = self.after(POLL_MS, self.live_step)
+        else:
+            if self.live_job:
+                self.after_cancel(self.live_job)
+                self.live_job = None
+            if self.follower:
+                self.follower.close()
+                self.follower = None
+
+    def live_step(self):
+        device = self.device_combo.get()
+        nouveaux = self.follower.poll_arrays([device]) if device else {}
+        if device in nouveaux:
+            self.append_live(device, *nouveaux[device])
+        self.live_job = self.after(POLL_MS, self.live_step)
+
+    def append_live(self, device, times, valeurs):
+        jours = sorted({t.date() for t in times.astype(datetime)})
+        au_bout = self.current_date is not None and self.current_date >= self.max_date.date()
+        for jour in jours:
+            i = bisect.bisect_left(self.available_dates, jour)
+            if i == len(self.available_dates) or self.available_dates[i] != jour:
+                self.available_dates.insert(i, jour)
+        self.max_date = max(self.max_date, datetime.combine(jours[-1], datetime.min.time()))
+        self.no_data = False
+        if self.auto_scroll_job or self.current_date is None:
+            return
+
+        start = datetime.combine(self.current_date, datetime.min.time())
+        if au_bout and jours[-1] > self.current_date:
+            # Minuit est passé : on suit le nouveau jour
+            self.plot_for_date(jours[-1])
+        elif self.shown_view == (device, start, None) and self.current_date in jours:
+            dans_la_vue = (times >= np.datetime64(start, "s")) & (times < np.datetime64(start + timedelta(days=1), "s"))
+            if not self.day_plot.append(times[dans_la_vue], {v: a[dans_la_vue] for v, a in valeurs.items()}):
+                # Mesures en retard au milieu de la journée : relecture complète
+                self.plot_for_date(self.current_date)
+
     def select_today(self):
         today = datetime.now().date()
         self.plot_for_date(today)
@@ -263,8 +298,7 @@ class App(tk.Tk):
     def _auto_scroll_step(self, delta_days):
         if not self.current_date:
             return
-        speed_multipliers = [1, 5, 25]
-        multiplier = speed_multipliers[min(self.accel_speed, 2)]
+        multiplier = VITESSES[min(self.accel_speed, 2)]
 
         new_date = self.current_date + timedelta(days=delta_days * multiplier)
         # Clamp date between min_date and max_date
@@ -278,13 +312,21 @@ class App(tk.Tk):
 
         self.accel_speed = min(self.accel_speed + 1, 2)  # accélère à chaque appel
 
+        # Précharge les prochaines étapes du défilement, à la vitesse qu'elles auront
+        pas = timedelta(days=delta_days * VITESSES[self.accel_speed])
+        points_min = POINTS_DEFILEMENT if self.accel_speed >= 2 else POINTS_MIN
+        self.prefetch_days([new_date + pas * k for k in range(1, NB_PRECHARGEES + 1)], points_min)
+
         self.auto_scroll_job = self.after(500, self._auto_scroll_step, delta_days)
 
     def stop_auto_scroll(self):
         if self.auto_scroll_job:
             self.after_cancel(self.auto_scroll_job)
             self.auto_scroll_job = None
+            vue_agregee = self.accel_speed >= 2
             self.accel_speed = 0
+            if vue_agregee:
+                self.refresh_plot()
 
 if __name__ == "__main__":
     app = App()
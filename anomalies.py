@@ -0,0 +1,366 @@
+import argparse
+from datetime import datetime
+import math
+import time
+
+from db import DB_FILE, connect
+from partitions import iter_range
+from retention import horizon
+from schema import format_ts, migrate, parse_ts
+
+# Détection des pannes et anomalies, au fil de l'ingestion.
+#
+# Chaque appareil a un état de quelques nombres (table anomalies_etat), lu et
+# réécrit dans la transaction d'insertion, comme les agrégats : chaque ligne
+# reçue coûte O(1), sans relire l'historique. Les événements détectés vont
+# dans la table evenements :
+#  - trou : plus de TROU_S secondes sans mesure (ESP bloqué, WiFi coupé) ;
+#  - muet : au moins MUET_N lignes sans aucune valeur (BME280 mort : l'ESP
+#    envoie NaN, sérialisé en null) ;
+#  - plat : la même valeur exacte PLAT_N fois de suite sur une voie
+#    (capteur figé) ;
+#  - hors_plage : valeur hors de la plage de mesure du BME280 ;
+#  - pic : écart à la moyenne glissante supérieur à PIC_Z écarts-types.
+#
+# Moyenne et variance glissantes : algorithme de Welford sur les FENETRE
+# premières valeurs, puis moyenne exponentielle de même poids (1 / FENETRE),
+# pour suivre le cycle des saisons. Les valeurs hors plage n'y entrent pas.
+#
+# backfill() recalcule états et événements depuis les mesures brutes, en
+# NumPy, avec les mêmes règles (et le même résultat) que le calcul au fil de
+# l'eau.
+
+VOIES = ("temperature", "humidity", "pressure")
+TYPES = ("trou", "muet", "plat", "hors_plage", "pic")
+
+# intervalleMesure des ESP (logger_esp8266.ino, logger_esp32.ino)
+CADENCE_S = 600
+TROU_S = 3 * CADENCE_S
+MUET_N = 3
+PLAT_N = 18
+FENETRE = 144
+PIC_N_MIN = 36
+PIC_Z = 6.0
+# Plages de mesure du BME280
+PLAGES = {"temperature": (-40.0, 85.0), "humidity": (0.0, 100.0), "pressure": (300.0, 1100.0)}
+# Écart-type minimal, pour ne pas tout signaler sur un signal très stable
+ECART_MIN = {"temperature": 0.1, "humidity": 0.5, "pressure": 0.2}
+
+# Par voie : n, moyenne, variance, dernière valeur, début et longueur de la
+# suite de valeurs égales
+ETAT_VOIE = ("n", "moyenne", "variance", "derniere", "plat_depuis", "plat_n")
+COLONNES = ("dernier", "muet_depuis", "muet_n", *(f"{v}_{c}" for v in VOIES for c in ETAT_VOIE))
+
+
+def create_tables(conn):
+    types = {"n": "INTEGER NOT NULL", "moyenne": "REAL NOT NULL", "variance": "REAL NOT NULL",
+             "derniere": "REAL", "plat_depuis": "TEXT", "plat_n": "INTEGER NOT NULL"}
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS anomalies_etat (
+            device TEXT PRIMARY KEY,
+            dernier TEXT,
+            muet_depuis TEXT,
+            muet_n INTEGER NOT NULL,
+            {", ".join(f"{v}_{c} {types[c]}" for v in VOIES for c in ETAT_VOIE)}
+        ) WITHOUT ROWID
+    """)
+    # voie vide pour les événements de l'appareil (trou, muet)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS evenements (
+            device TEXT NOT NULL,
+            debut TEXT NOT NULL,
+            type TEXT NOT NULL,
+            voie TEXT NOT NULL,
+            fin TEXT NOT NULL,
+            n INTEGER NOT NULL,
+            valeur REAL,
+            PRIMARY KEY (device, debut, type, voie)
+        ) WITHOUT ROWID
+    """)
+
+
+UPSERT_ETAT = f"""
+    INSERT OR REPLACE INTO anomalies_etat (device, {", ".join(COLONNES)})
+    VALUES ({", ".join("?" * (len(COLONNES) + 1))})
+"""
+
+# Une suite (plat, muet) qui continue d'un lot à l'autre garde son début :
+# l'événement est prolongé
+UPSERT_EVENEMENT = """
+    INSERT INTO evenements (device, debut, type, voie, fin, n, valeur)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (device, debut, type, voie) DO UPDATE SET
+        fin = max(fin, excluded.fin), n = max(n, excluded.n), valeur = excluded.valeur
+"""
+
+
+# -- état d'un appareil ------------------------------------------------------
+
+def _etat_vide():
+    return [None, None, 0] + [[0, 0.0, 0.0, None, None, 0] for _ in VOIES]
+
+
+def _charger(ligne):
+    if ligne is None:
+        return _etat_vide()
+    k = len(ETAT_VOIE)
+    return [*ligne[:3]] + [list(ligne[3 + k * i:3 + k * (i + 1)]) for i in range(len(VOIES))]
+
+
+def _aplatir(etat):
+    return (*etat[:3], *(x for voie in etat[3:] for x in voie))
+
+
+# evenements : (device, debut, type, voie) -> [fin, n, valeur]
+def _ponctuel(evenements, cle, valeur):
+    e = evenements.get(cle)
+    if e is None:
+        evenements[cle] = [cle[1], 1, valeur]
+    else:
+        e[1] += 1
+        e[2] = valeur
+
+
+def _suite(evenements, cle, fin, n, valeur):
+    evenements[cle] = [fin, n, valeur]
+
+
+# -- au fil de l'ingestion ---------------------------------------------------
+
+def _analyser(device, etat, rows, evenements):
+    for _, t, h, p, ts in rows:
+        dernier = etat[0]
+        if dernier is None or ts > dernier:
+            if dernier is not None:
+                ecart = (datetime.fromisoformat(ts) - datetime.fromisoformat(dernier)).total_seconds()
+                if ecart > TROU_S:
+                    evenements[(device, dernier, "trou", "")] = [ts, 1, ecart]
+            etat[0] = ts
+
+        if t is None and h is None and p is None:
+            if etat[2] == 0:
+                etat[1] = ts
+            etat[2] += 1
+            if etat[2] >= MUET_N:
+                _suite(evenements, (device, etat[1], "muet", ""), ts, etat[2], None)
+            continue
+        etat[1], etat[2] = None, 0
+
+        for voie, x, s in zip(VOIES, (t, h, p), etat[3:]):
+            if x is None:
+                continue
+            bas, haut = PLAGES[voie]
+            if not bas <= x <= haut:
+                _ponctuel(evenements, (device, ts, "hors_plage", voie), x)
+                continue
+            n, moyenne, variance = s[0], s[1], s[2]
+            if n >= PIC_N_MIN and abs(x - moyenne) > PIC_Z * max(math.sqrt(variance), ECART_MIN[voie]):
+                _ponctuel(evenements, (device, ts, "pic", voie), x)
+            # Welford (pas 1 / n), puis moyenne exponentielle (pas 1 / FENETRE)
+            n += 1
+            a = 1.0 / min(n, FENETRE)
+            delta = x - moyenne
+            s[0], s[1], s[2] = n, moyenne + a * delta, (1.0 - a) * (variance + a * delta * delta)
+
+            if x == s[3]:
+                s[5] += 1
+            else:
+                s[3], s[4], s[5] = x, ts, 1
+            if s[5] >= PLAT_N:
+                _suite(evenements, (device, s[4], "plat", voie), ts, s[5], x)
+
+
+def _ecrire_evenements(conn, evenements):
+    conn.executemany(UPSERT_EVENEMENT, [(*cle, *e) for cle, e in evenements.items()])
+
+
+# Appelé par ingest.write_rows, dans la transaction d'insertion
+def update_events(conn, rows):
+    par_appareil = {}
+    for row in rows:
+        par_appareil.setdefault(row[0], []).append(row)
+    evenements = {}
+    for device, lignes in par_appareil.items():
+        ligne = conn.execute(f"SELECT {', '.join(COLONNES)} FROM anomalies_etat WHERE device = ?",
+                             (device,)).fetchone()
+        etat = _charger(ligne)
+        # Tri stable : à horodatage égal, l'ordre du lot est gardé
+        lignes.sort(key=lambda row: row[4])
+        _analyser(device, etat, lignes, evenements)
+        conn.execute(UPSERT_ETAT, (device, *_aplatir(etat)))
+    if evenements:
+        _ecrire_evenements(conn, evenements)
+    return len(evenements)
+
+
+# -- lectures ----------------------------------------------------------------
+
+# Événements qui chevauchent [start, end[ (bornes facultatives), les plus
+# récents d'abord : [(device, type, voie, debut, fin, n, valeur)]
+def list_events(conn, devices=None, start=None, end=None, types=None, limite=None):
+    filtre, params = ["1"], []
+    if devices is not None:
+        filtre.append(f"device IN ({', '.join('?' * len(devices))})")
+        params.extend(devices)
+    if types is not None:
+        filtre.append(f"type IN ({', '.join('?' * len(types))})")
+        params.extend(types)
+    if start is not None:
+        filtre.append("fin >= ?")
+        params.append(format_ts(start))
+    if end is not None:
+        filtre.append("debut < ?")
+        params.append(format_ts(end))
+    sql = f"""
+        SELECT device, type, voie, debut, fin, n, valeur FROM evenements
+        WHERE {" AND ".join(filtre)}
+        ORDER BY debut DESC, device, type, voie
+    """
+    if limite is not None:
+        sql += " LIMIT ?"
+        params.append(limite)
+    return conn.execute(sql, params).fetchall()
+
+
+# -- recalcul vectorisé ------------------------------------------------------
+
+BLOC = 1024
+
+
+def _recurrence(np, a, b, y0):
+    # y[i] = a * y[i - 1] + b[i], par blocs : a^-k ne déborde pas dans un bloc
+    y = np.empty(len(b))
+    puissances = a ** np.arange(1, BLOC + 1)
+    for i in range(0, len(b), BLOC):
+        bloc = b[i:i + BLOC]
+        p = puissances[:len(bloc)]
+        y[i:i + len(bloc)] = p * (y0 + np.cumsum(bloc / p))
+        y0 = y[i + len(bloc) - 1]
+    return y
+
+
+def _moyennes_variances(np, x):
+    # Moyenne et variance après chaque valeur, comme dans _analyser
+    m, v = np.empty(len(x)), np.empty(len(x))
+    k = min(len(x), FENETRE)
+    rang = np.arange(1, k + 1)
+    # Décalées de la première valeur : pas de perte de précision sur la pression
+    y = x[:k] - x[0]
+    s1, s2 = np.cumsum(y) / rang, np.cumsum(y * y) / rang
+    m[:k] = x[0] + s1
+    v[:k] = np.maximum(s2 - s1 * s1, 0.0)
+    if len(x) > k:
+        a = 1.0 - 1.0 / FENETRE
+        m[k:] = _recurrence(np, a, (1.0 - a) * x[k:], m[k - 1])
+        delta = x[k:] - m[k - 1:-1]
+        v[k:] = _recurrence(np, a, a * (1.0 - a) * delta * delta, v[k - 1])
+    return m, v
+
+
+def _plages(np, masque):
+    # (début, longueur) des suites de True
+    bords = np.diff(np.concatenate([[0], masque.astype(np.int8), [0]]))
+    debuts = np.flatnonzero(bords == 1)
+    return debuts, np.flatnonzero(bords == -1) - debuts
+
+
+def _analyser_historique(np, device, rows, evenements):
+    # rows : (timestamp, temperature, humidity, pressure) triées
+    ts = np.array([row[0] for row in rows], dtype=object)
+    secondes = ts.astype("datetime64[s]").astype(np.int64)
+    valeurs = np.array([row[1:] for row in rows], dtype=np.float64)
+    etat = _etat_vide()
+    etat[0] = ts[-1]
+
+    for i in np.flatnonzero(np.diff(secondes) > TROU_S):
+        evenements[(device, ts[i], "trou", "")] = [ts[i + 1], 1, float(secondes[i + 1] - secondes[i])]
+
+    muets = np.isnan(valeurs).all(axis=1)
+    debuts, longueurs = _plages(np, muets)
+    for d, n in zip(debuts, longueurs):
+        if n >= MUET_N:
+            _suite(evenements, (device, ts[d], "muet", ""), ts[d + n - 1], int(n), None)
+    if muets[-1]:
+        etat[1], etat[2] = ts[debuts[-1]], int(longueurs[-1])
+
+    for j, (voie, s) in enumerate(zip(VOIES, etat[3:])):
+        presentes = ~np.isnan(valeurs[:, j])
+        x, tv = valeurs[presentes, j], ts[presentes]
+        bas, haut = PLAGES[voie]
+        hors = (x < bas) | (x > haut)
+        for i in np.flatnonzero(hors):
+            _ponctuel(evenements, (device, tv[i], "hors_plage", voie), float(x[i]))
+        x, tv = x[~hors], tv[~hors]
+        if not len(x):
+            continue
+
+        m, v = _moyennes_variances(np, x)
+        i = np.arange(PIC_N_MIN, len(x))
+        ecart = np.maximum(np.sqrt(v[i - 1]), ECART_MIN[voie])
+        for k in i[np.abs(x[i] - m[i - 1]) > PIC_Z * ecart]:
+            _ponctuel(evenements, (device, tv[k], "pic", voie), float(x[k]))
+
+        debuts = np.flatnonzero(np.concatenate([[True], x[1:] != x[:-1]]))
+        longueurs = np.diff(np.append(debuts, len(x)))
+        for d, n in zip(debuts[longueurs >= PLAT_N], longueurs[longueurs >= PLAT_N]):
+            _suite(evenements, (device, tv[d], "plat", voie), tv[d + n - 1], int(n), float(x[d]))
+        s[:] = [len(x), float(m[-1]), float(v[-1]), float(x[-1]), tv[debuts[-1]], int(longueurs[-1])]
+    return etat
+
+
+def backfill(conn, devices=None):
+    # Import local : l'ingestion n'a pas besoin de NumPy
+    import numpy as np
+    from catalogue import list_devices
+
+    # Les événements d'avant la limite de rétention ne peuvent plus être
+    # recalculés : ils sont gardés, et le calcul repart de la limite
+    purge = horizon(conn, "brut")
+    filtre, params = "debut >= ?", [purge or ""]
+    if devices is None:
+        devices = list_devices(conn)
+        conn.execute("DELETE FROM anomalies_etat")
+    else:
+        marques = ", ".join("?" * len(devices))
+        conn.execute(f"DELETE FROM anomalies_etat WHERE device IN ({marques})", devices)
+        filtre += f" AND device IN ({marques})"
+        params.extend(devices)
+    conn.execute(f"DELETE FROM evenements WHERE {filtre}", params)
+    start = parse_ts(purge) if purge is not None else None
+    total = 0
+    for device in devices:
+        rows = list(iter_range(conn, ["timestamp", *VOIES], [device], start))
+        if not rows:
+            continue
+        evenements = {}
+        etat = _analyser_historique(np, device, rows, evenements)
+        conn.execute(UPSERT_ETAT, (device, *_aplatir(etat)))
+        _ecrire_evenements(conn, evenements)
+        total += len(evenements)
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recalcule les événements (trous, capteurs muets ou figés, pics)")
+    parser.add_argument("db", nargs="?", default=DB_FILE)
+    parser.add_argument("--appareil", action="append", help="limite le recalcul à cet appareil (répétable)")
+    parser.add_argument("--liste", action="store_true", help="affiche les événements sans les recalculer")
+    args = parser.parse_args()
+
+    conn = connect(args.db)
+    try:
+        migrate(conn, verbose=True)
+        if not args.liste:
+            t0 = time.perf_counter()
+            with conn:
+                n = backfill(conn, args.appareil)
+            print(f"Événements recalculés en {time.perf_counter() - t0:.1f} s : {n}")
+        for device, type_, voie, debut, fin, n, valeur in list_events(conn, args.appareil):
+            detail = f"{valeur:g}" if valeur is not None else ""
+            print(f"{device:<24} {type_:<10} {voie or '-':<12} {debut} → {fin}  {n:>5}  {detail}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import blocks
+from data_access import load_by_device, load_columns
+from db import connect
+from schema import format_ts, migrate
+
+# Mesures froides en lignes (table mesures et son index) contre blocs
+# colonnes compressés (blocks.py) : place occupée, puis lecture d'une vue
+# jour de tous les appareils et d'un mois d'un appareil, avant et après
+# compactage. Décodage d'un bloc seul en tableaux NumPy et en lignes.
+
+DEBUT = datetime(2025, 1, 1)
+PAS_SECONDES = 600  # intervalleMesure des ESP
+
+
+def remplir(conn, appareils, jours, pas):
+    nb = jours * 86400 // pas
+    for k in range(appareils):
+        device = f"esp{k}_BME1"
+        # Courbes lisses au centième, comme les BME280, avec un peu de bruit
+        conn.execute(f"""
+            WITH RECURSIVE n(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM n WHERE i + 1 < {nb})
+            INSERT INTO mesures (device, temperature, humidity, pressure, timestamp)
+            SELECT '{device}',
+                   round(20 + {k} + 4 * sin(i * {pas} / 86400.0 * 6.2832) + (i * 7919 % 13) / 100.0, 2),
+                   round(50 + 10 * cos(i * {pas} / 86400.0 * 6.2832) + (i * 104729 % 17) / 100.0, 2),
+                   round(1013 + 5 * sin(i * {pas} / 604800.0 * 6.2832) + (i * 31 % 7) / 100.0, 2),
+                   strftime('%Y-%m-%d %H:%M:%S', '{format_ts(DEBUT)}',
+                            '+' || (i * {pas} + i * 7 % 5) || ' seconds')
+            FROM n
+        """)
+        conn.execute("INSERT INTO device_watermark (device, max_timestamp) VALUES (?, ?)",
+                     (device, format_ts(DEBUT + timedelta(days=jours))))
+    conn.commit()
+    return appareils * nb
+
+
+def octets(conn, tables):
+    return conn.execute(f"""
+        SELECT IFNULL(SUM(pgsize), 0) FROM dbstat WHERE name IN ({", ".join("?" * len(tables))})
+    """, tables).fetchone()[0]
+
+
+def chronometrer(fonction, repetitions):
+    durees = []
+    for _ in range(repetitions):
+        t0 = time.perf_counter()
+        fonction()
+        durees.append((time.perf_counter() - t0) * 1000)
+    return statistics.median(durees)
+
+
+def lectures(conn, devices, jour, repetitions):
+    vue_jour = chronometrer(lambda: load_by_device(conn, devices, start=jour, end=jour + timedelta(days=1)),
+                            repetitions)
+    mois = chronometrer(lambda: load_columns(conn, devices[:1], start=jour, end=jour + timedelta(days=30)),
+                        repetitions)
+    return vue_jour, mois
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark des blocs colonnes compressés")
+    parser.add_argument("--appareils", type=int, default=6)
+    parser.add_argument("--jours", type=int, default=90)
+    parser.add_argument("--pas", type=int, default=PAS_SECONDES, help="secondes entre deux mesures")
+    parser.add_argument("--repetitions", type=int, default=20)
+    parser.add_argument("--dir", default=None, help="répertoire de la base temporaire")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        conn = connect(os.path.join(tmp, "mesures.db"))
+        migrate(conn)
+        nb = remplir(conn, args.appareils, args.jours, args.pas)
+        devices = [f"esp{k}_BME1" for k in range(args.appareils)]
+        jour = DEBUT + timedelta(days=args.jours // 2)
+        print(f"{nb} mesures : {args.appareils} appareils sur {args.jours} jours")
+
+        avant = octets(conn, ("mesures", "idx_mesures_device_ts"))
+        lignes_jour, lignes_mois = lectures(conn, devices, jour, args.repetitions)
+
+        t0 = time.perf_counter()
+        nb_jours, compactees = blocks.compact(conn, maintenant=DEBUT + timedelta(days=args.jours + 30),
+                                              pause_s=0)
+        duree = time.perf_counter() - t0
+        print(f"Compactage : {nb_jours} jours, {compactees} mesures en {duree:.1f} s")
+        apres = octets(conn, ("blocs", "sqlite_autoindex_blocs_1"))
+        blocs_jour, blocs_mois = lectures(conn, devices, jour, args.repetitions)
+
+        print()
+        print(f"{'stockage':<28} {'octets':>12} {'octets/mesure':>14}")
+        print(f"{'lignes (table + index)':<28} {avant:>12} {avant / nb:>14.1f}")
+        print(f"{'blocs':<28} {apres:>12} {apres / nb:>14.1f}")
+        print(f"{'rapport':<28} {avant / apres:>11.1f}x")
+
+        print()
+        print(f"{'lecture (médiane ms)':<28} {'lignes':>8} {'blocs':>8}")
+        print(f"{f'vue jour, {args.appareils} appareils':<28} {lignes_jour:>8.2f} {blocs_jour:>8.2f}")
+        print(f"{'30 jours, 1 appareil':<28} {lignes_mois:>8.2f} {blocs_mois:>8.2f}")
+
+        donnees = conn.execute("SELECT donnees FROM blocs WHERE device = ? AND jour = ?",
+                               (devices[0], jour.strftime("%Y-%m-%d"))).fetchone()[0]
+        n = len(blocks.decode_rows(donnees))
+        print()
+        print(f"Un bloc : {n} mesures, {len(donnees)} octets")
+        for nom, decoder in (("decode_arrays (NumPy)", blocks.decode_arrays),
+                             ("decode_rows (Python)", blocks.decode_rows)):
+            ms = chronometrer(lambda: decoder(donnees), args.repetitions * 10)
+            print(f"{nom:<28} {ms * 1000:>8.1f} µs")
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
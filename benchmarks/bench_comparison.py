@@ -0,0 +1,87 @@
+import argparse
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rendering import ComparisonPlot
+
+# Temps d'une image du mode comparaison de curseur selon le nombre
+# d'appareils superposés (backend Agg) : une Line2D par appareil, redessinée
+# à chaque jour, contre une seule LineCollection (ComparisonPlot).
+
+DEBUT = datetime(2025, 1, 1)
+
+
+def journees(nb_jours, nb_devices, points):
+    rng = np.random.default_rng(0)
+    devices = [f"esp{i:02d}_BME1" for i in range(nb_devices)]
+    pas = (np.arange(points) * (86400 // points)).astype("timedelta64[s]")
+    for k in range(nb_jours):
+        start = DEBUT + timedelta(days=k)
+        t = np.tile(np.datetime64(start, "s") + pas, nb_devices)
+        decalages = np.repeat(rng.normal(0, 2, nb_devices), points)
+        phase = np.tile(np.linspace(0, 2 * np.pi, points), nb_devices)
+        valeurs = (20 + decalages + 4 * np.sin(phase) + rng.normal(0, 0.3, t.size)).astype(np.float32)
+        bornes = np.arange(nb_devices + 1) * points
+        yield start, devices, t, valeurs, bornes
+
+
+def ancien(fig, ax, start, devices, t, valeurs, bornes):
+    ax.clear()
+    for device, a, b in zip(devices, bornes[:-1], bornes[1:]):
+        ax.plot(t[a:b], valeurs[a:b], label=device)
+    ax.legend(loc="upper left", bbox_to_anchor=(1.01, 1), fontsize="small", ncol=1 + len(devices) // 25)
+    ax.grid(True)
+    ax.set_title(f"Température - {start.date()}")
+    fig.canvas.draw()
+
+
+def mesurer(image, jours):
+    durees = []
+    for jour in jours:
+        t0 = time.perf_counter()
+        image(*jour)
+        durees.append((time.perf_counter() - t0) * 1000)
+    return statistics.mean(durees)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Temps d'image du mode comparaison (backend Agg)")
+    parser.add_argument("--devices", type=int, nargs="+", default=[5, 20, 50])
+    parser.add_argument("--jours", type=int, default=30)
+    parser.add_argument("--points", type=int, default=288, help="mesures par jour et par appareil")
+    args = parser.parse_args()
+
+    print(f"{'appareils':>9} {'N Line2D ms':>12} {'LineCollection ms':>18} {'blit':>6}")
+    for n in args.devices:
+        jours = list(journees(args.jours, n, args.points))
+
+        fig, ax = plt.subplots(figsize=(10, 6))
+        fig.subplots_adjust(right=0.78)
+        t_ancien = mesurer(lambda *j: ancien(fig, ax, *j), jours)
+        plt.close(fig)
+
+        fig, ax = plt.subplots(figsize=(10, 6))
+        fig.subplots_adjust(right=0.78)
+        plot = ComparisonPlot(fig.canvas, ax)
+        fig.canvas.draw()
+        # draw_idle est synchrone hors boucle d'événements avec Agg
+        fig.canvas.draw_idle = fig.canvas.draw
+        t_collection = mesurer(lambda s, d, t, v, b: plot.update(s, s + timedelta(days=1), "temperature",
+                                                                  d, t, v, b, f"Température - {s.date()}"),
+                               jours)
+        plt.close(fig)
+        print(f"{n:>9} {t_ancien:>12.2f} {t_collection:>18.2f} {plot.stats['images_blit']:>3}/{len(jours)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import ConnectionPool
+from ingest import ingest_batch
+from queries import latest_per_device
+from schema import migrate
+from simulation import build_payload
+
+# Test de charge : des écrivains (ESP) et des lecteurs (/data) concurrents
+# sur la même base, en journal rollback classique puis en WAL.
+
+
+def percentile(valeurs, p):
+    if not valeurs:
+        return float("nan")
+    valeurs = sorted(valeurs)
+    return valeurs[min(len(valeurs) - 1, int(len(valeurs) * p / 100))]
+
+
+def ecrivain(pool, index, duree, lignes, resultats, erreurs):
+    rng = random.Random(index)
+    debut = datetime(2025, 1, 1) + timedelta(days=index)
+    fin = time.monotonic() + duree
+    k = 0
+    while time.monotonic() < fin:
+        data = build_payload(f"esp{index}", debut + timedelta(hours=k), lignes // 2, rng=rng)
+        t0 = time.perf_counter()
+        try:
+            with pool.connection() as conn:
+                ingest_batch(conn, data)
+            resultats.append((time.perf_counter() - t0) * 1000)
+        except sqlite3.OperationalError:
+            erreurs.append(1)
+        k += 1
+
+
+def lecteur(pool, duree, resultats, erreurs):
+    fin = time.monotonic() + duree
+    while time.monotonic() < fin:
+        t0 = time.perf_counter()
+        try:
+            with pool.connection() as conn:
+                latest_per_device(conn)
+            resultats.append((time.perf_counter() - t0) * 1000)
+        except sqlite3.OperationalError:
+            erreurs.append(1)
+
+
+def scenario(db_path, args, **reglages):
+    pool = ConnectionPool(db_path, max_idle=args.ecrivains + args.lecteurs, **reglages)
+    with pool.connection() as conn:
+        migrate(conn)
+
+    ecritures, lectures, erreurs = [], [], []
+    threads = [threading.Thread(target=ecrivain, args=(pool, i, args.duree, args.lignes, ecritures, erreurs))
+               for i in range(args.ecrivains)]
+    threads += [threading.Thread(target=lecteur, args=(pool, args.duree, lectures, erreurs))
+                for _ in range(args.lecteurs)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    pool.close_all()
+
+    nom = ", ".join(f"{k}={v}" for k, v in reglages.items())
+    print(f"[{nom}]")
+    for libelle, durees in (("écritures", ecritures), ("lectures", lectures)):
+        print(f"  {libelle:<10} n={len(durees):6d}   p50 {percentile(durees, 50):8.2f} ms"
+              f"   p99 {percentile(durees, 99):8.2f} ms")
+    print(f"  erreurs « database is locked » : {len(erreurs)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test de charge lecteurs/écrivains concurrents")
+    parser.add_argument("--ecrivains", type=int, default=8)
+    parser.add_argument("--lecteurs", type=int, default=8)
+    parser.add_argument("--lignes", type=int, default=200, help="lignes par lot")
+    parser.add_argument("--duree", type=float, default=10.0, help="durée de chaque scénario (s)")
+    parser.add_argument("--busy-timeout-ms", type=int, default=5000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        scenario(os.path.join(tmp, "delete.db"), args, journal_mode="DELETE", synchronous="FULL",
+                 busy_timeout_ms=args.busy_timeout_ms)
+        scenario(os.path.join(tmp, "wal.db"), args, journal_mode="WAL", synchronous="NORMAL",
+                 busy_timeout_ms=args.busy_timeout_ms)
+
+
+if __name__ == "__main__":
+    main()
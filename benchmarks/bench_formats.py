@@ -0,0 +1,60 @@
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import binary_format
+from ingest import validate_batch
+from simulation import build_payload
+
+# Compare le format JSON et le format binaire de /receive_batch : taille sur
+# le réseau et temps de décodage côté serveur (json.loads + validation contre
+# décodage NumPy, et décodage struct quand NumPy est absent).
+
+
+def chronometrer(fonction, argument, repetitions):
+    durees = []
+    for _ in range(repetitions):
+        t0 = time.perf_counter()
+        fonction(argument)
+        durees.append((time.perf_counter() - t0) * 1000)
+    return statistics.median(durees)
+
+
+def decode_struct(corps):
+    return binary_format._decode_struct(corps, *binary_format._lire_en_tete(corps))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark JSON contre binaire")
+    parser.add_argument("--mesures", type=int, nargs="+", default=[24, 432, 3024],
+                        help="mesures par capteur dans un lot (3024 = MAX_MESURES de l'ESP32)")
+    parser.add_argument("--repetitions", type=int, default=20)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    print(f"{'mesures':>8} {'JSON (o)':>10} {'bin (o)':>9} {'ratio':>6}"
+          f" {'JSON ms':>8} {'numpy ms':>9} {'struct ms':>10}")
+    for n in args.mesures:
+        payload = build_payload("banane", datetime(2025, 6, 1), n, rng=rng)
+        corps_json = json.dumps(payload).encode("utf-8")
+        corps_bin = binary_format.encode_payload(payload)
+
+        t_json = chronometrer(lambda c: validate_batch(json.loads(c)), corps_json, args.repetitions)
+        t_numpy = float("nan")
+        if binary_format.np is not None:
+            t_numpy = chronometrer(binary_format.decode_batch, corps_bin, args.repetitions)
+        t_struct = chronometrer(decode_struct, corps_bin, args.repetitions)
+
+        print(f"{n:>8} {len(corps_json):>10} {len(corps_bin):>9} {len(corps_json) / len(corps_bin):>6.1f}"
+              f" {t_json:>8.2f} {t_numpy:>9.2f} {t_struct:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import argparse
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from schema import format_ts, migrate
+
+# Latence d'une requête « vue jour » (celle de affiche_base:plot_data) avant et
+# après l'index (device, timestamp), pour plusieurs tailles de table.
+
+NB_APPAREILS = 50
+DEBUT = datetime(2020, 1, 1)
+PAS_SECONDES = 600  # intervalleMesure des ESP
+
+REQUETE_JOUR = """
+    SELECT timestamp, temperature, humidity, pressure
+    FROM mesures
+    WHERE device=?
+      AND timestamp >= ?
+      AND timestamp < ?
+    ORDER BY timestamp
+"""
+
+
+def remplir(conn, nb_lignes):
+    # Génération dans SQLite : beaucoup plus rapide qu'un executemany Python
+    conn.execute(f"""
+        WITH RECURSIVE n(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM n WHERE i + 1 < {nb_lignes})
+        INSERT INTO mesures (device, temperature, humidity, pressure, timestamp)
+        SELECT 'esp' || (i % {NB_APPAREILS}) || '_BME1',
+               20 + (i % 97) / 10.0, 50 + (i % 53) / 10.0, 1000 + (i % 31),
+               strftime('%Y-%m-%d %H:%M:%S', '{format_ts(DEBUT)}',
+                        '+' || ((i / {NB_APPAREILS}) * {PAS_SECONDES}) || ' seconds')
+        FROM n
+    """)
+    conn.commit()
+
+
+def mesurer(conn, nb_lignes, repetitions):
+    jours = nb_lignes // NB_APPAREILS * PAS_SECONDES // 86400
+    durees = []
+    for k in range(repetitions):
+        jour = DEBUT + timedelta(days=(k * 37) % max(jours, 1))
+        params = (f"esp{k % NB_APPAREILS}_BME1", format_ts(jour), format_ts(jour + timedelta(days=1)))
+        t0 = time.perf_counter()
+        conn.execute(REQUETE_JOUR, params).fetchall()
+        durees.append((time.perf_counter() - t0) * 1000)
+    return statistics.median(durees), max(durees)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de la vue jour avec et sans index")
+    parser.add_argument("--tailles", type=int, nargs="+", default=[1_000_000, 10_000_000, 50_000_000])
+    parser.add_argument("--repetitions", type=int, default=20)
+    parser.add_argument("--dir", default=None, help="répertoire des bases temporaires")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        for taille in args.tailles:
+            conn = sqlite3.connect(os.path.join(tmp, f"bench_{taille}.db"))
+            migrate(conn, cible=2)
+            t0 = time.perf_counter()
+            remplir(conn, taille)
+            print(f"{taille:>11,} lignes générées en {time.perf_counter() - t0:.1f} s")
+
+            # Sans index, peu de répétitions suffisent : chaque requête est un scan complet
+            med, pire = mesurer(conn, taille, max(3, args.repetitions // 5))
+            print(f"{'':>11} sans index : médiane {med:9.2f} ms   max {pire:9.2f} ms")
+
+            t0 = time.perf_counter()
+            migrate(conn)
+            print(f"{'':>11} index créé en {time.perf_counter() - t0:.1f} s")
+            med, pire = mesurer(conn, taille, args.repetitions)
+            print(f"{'':>11} avec index : médiane {med:9.2f} ms   max {pire:9.2f} ms")
+            conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ingest
+from ingest import INSERT_MESURE, ingest_batch
+from schema import migrate
+from simulation import build_payload
+
+# Rejoue des lots de 10 000 lignes construits comme ceux du simulateur.
+# Insertion brute seule : l'ancien chemin (un execute par ligne) contre
+# executemany, à travail égal. Puis le chemin complet de /receive_batch
+# (ingest_batch : validation, filigranes, tables dérivées), avec le temps de
+# chaque table dérivée mesuré à part.
+
+# Étapes de ingest.write_rows qui tiennent les tables dérivées à jour
+DERIVEES = ("update_rollups", "update_catalogue", "update_events", "note_late_rows")
+
+
+def ancien_chemin(db_path, data):
+    conn = sqlite3.connect(db_path)
+    cur = conn.cursor()
+    for entry in data:
+        cur.execute(INSERT_MESURE, (
+            entry.get('device'),
+            entry.get('temperature'),
+            entry.get('humidity'),
+            entry.get('pressure'),
+            entry.get('timestamp')
+        ))
+    conn.commit()
+    conn.close()
+
+
+def executemany(db_path, data):
+    conn = sqlite3.connect(db_path)
+    # Même préparation que l'ancien chemin, sans validation
+    conn.executemany(INSERT_MESURE, [
+        (entry.get('device'), entry.get('temperature'), entry.get('humidity'),
+         entry.get('pressure'), entry.get('timestamp'))
+        for entry in data
+    ])
+    conn.commit()
+    conn.close()
+
+
+def complet(db_path, data):
+    conn = sqlite3.connect(db_path)
+    ingest_batch(conn, data)
+    conn.close()
+
+
+# Remplace les étapes dérivées de ingest par des versions chronométrées
+def chronometrer_derivees(durees):
+    for nom in DERIVEES:
+        def chrono(*args, _nom=nom, _fonction=getattr(ingest, nom)):
+            t0 = time.perf_counter()
+            try:
+                return _fonction(*args)
+            finally:
+                durees[_nom] += time.perf_counter() - t0
+        setattr(ingest, nom, chrono)
+
+
+def mesurer(nom, fonction, db_path, lots):
+    durees = []
+    for data in lots:
+        t0 = time.perf_counter()
+        fonction(db_path, data)
+        durees.append((time.perf_counter() - t0) * 1000)
+    lignes = sum(len(data) for data in lots)
+    total = sum(durees) / 1000
+    print(f"{nom:<22} médiane {statistics.median(durees):8.1f} ms/lot"
+          f"   max {max(durees):8.1f} ms   {lignes / total:10.0f} lignes/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de l'insertion par lots")
+    parser.add_argument("--lignes", type=int, default=10000, help="lignes par lot")
+    parser.add_argument("--lots", type=int, default=10)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    debut = datetime(2025, 1, 1)
+    # build_payload produit 2 lignes (BME1/BME2) par pas de temps
+    lots = [build_payload(f"esp{i}", debut, args.lignes // 2, rng=rng) for i in range(args.lots)]
+
+    derivees = dict.fromkeys(DERIVEES, 0.0)
+    with tempfile.TemporaryDirectory() as tmp:
+        print("Insertion brute (table mesures seule)")
+        for nom, fonction in (("par ligne", ancien_chemin), ("executemany", executemany)):
+            db_path = os.path.join(tmp, f"{nom.replace(' ', '_')}.db")
+            conn = sqlite3.connect(db_path)
+            migrate(conn)
+            conn.close()
+            mesurer(nom, fonction, db_path, lots)
+
+        print()
+        print("Chemin complet (ingest_batch)")
+        db_path = os.path.join(tmp, "complet.db")
+        conn = sqlite3.connect(db_path)
+        migrate(conn)
+        conn.close()
+        chronometrer_derivees(derivees)
+        mesurer("ingest_batch", complet, db_path, lots)
+        for nom, duree in derivees.items():
+            print(f"  dont {nom:<17} {duree * 1000 / len(lots):8.1f} ms/lot")
+
+
+if __name__ == "__main__":
+    main()
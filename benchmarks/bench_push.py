@@ -0,0 +1,134 @@
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import resource
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from datetime import datetime, timedelta
+
+from werkzeug.serving import make_server
+
+RACINE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RACINE)
+
+from schema import migrate
+from simulation import PAS_MESURE, build_payload
+
+# Test de charge du flux /stream : des centaines d'abonnés SSE inactifs
+# (filtrés sur un appareil muet) restent connectés pendant qu'un ESP envoie
+# des lots ; on mesure le délai entre l'envoi d'un lot et sa réception par un
+# abonné actif, et le coût d'une publication côté serveur.
+
+MESURES_PAR_LOT = 6
+
+
+def percentile(valeurs, p):
+    valeurs = sorted(valeurs)
+    return valeurs[min(len(valeurs) - 1, int(len(valeurs) * p / 100))]
+
+
+def abonne_inactif(port):
+    s = socket.create_connection(("127.0.0.1", port))
+    s.sendall(b"GET /stream?device=muet HTTP/1.1\r\nHost: bench\r\n\r\n")
+    reponse = b""
+    while b"\r\n\r\n" not in reponse:
+        reponse += s.recv(4096)
+    return s
+
+
+def abonne_actif(s, recus):
+    tampon = b""
+    while True:
+        try:
+            morceau = s.recv(65536)
+        except OSError:
+            return
+        if not morceau:
+            return
+        tampon += morceau
+        while b"\n\n" in tampon:
+            evenement, tampon = tampon.split(b"\n\n", 1)
+            for ligne in evenement.split(b"\n"):
+                if ligne.startswith(b"data: ["):
+                    mesures = json.loads(ligne[6:])
+                    recus[mesures[0]["timestamp"]] = time.perf_counter()
+
+
+def envoyer(port, payload):
+    requete = urllib.request.Request(f"http://127.0.0.1:{port}/receive_batch",
+                                     data=json.dumps(payload).encode(),
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(requete) as reponse:
+        reponse.read()
+
+
+def scenario(serveur, port, nb_inactifs, nb_lots, debut):
+    inactifs = [abonne_inactif(port) for _ in range(nb_inactifs)]
+    actif = socket.create_connection(("127.0.0.1", port))
+    actif.sendall(b"GET /stream?device=banane_BME1 HTTP/1.1\r\nHost: bench\r\n\r\n")
+    recus = {}
+    threading.Thread(target=abonne_actif, args=(actif, recus), daemon=True).start()
+    time.sleep(0.2)
+
+    envois, publications = {}, []
+    for k in range(nb_lots):
+        instant = debut + PAS_MESURE * MESURES_PAR_LOT * k
+        cle = instant.strftime("%Y-%m-%d %H:%M:%S")
+        envois[cle] = time.perf_counter()
+        envoyer(port, build_payload("banane", instant, MESURES_PAR_LOT))
+        fin = time.monotonic() + 5
+        while cle not in recus and time.monotonic() < fin:
+            time.sleep(0.001)
+        publications.append(serveur.broker.stats["publish_ms"])
+
+    delais = [(recus[c] - t) * 1000 for c, t in envois.items() if c in recus]
+    abonnes = serveur.broker.info()["abonnes"]
+    for s in inactifs + [actif]:
+        s.close()
+    return delais, publications, abonnes, len(envois) - len(delais)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test de charge de /stream (SSE)")
+    parser.add_argument("--inactifs", type=int, nargs="+", default=[0, 300, 800])
+    parser.add_argument("--lots", type=int, default=100)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        spec = importlib.util.spec_from_file_location("serveur", os.path.join(RACINE, "serveur-3.0.py"))
+        serveur = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(serveur)
+        with serveur.pool.connection() as conn:
+            migrate(conn)
+
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+        http = make_server("127.0.0.1", 0, serveur.app, threaded=True)
+        threading.Thread(target=http.serve_forever, daemon=True).start()
+        port = http.server_port
+
+        print(f"{'inactifs':>9} {'abonnés':>8} {'p50 ms':>8} {'p99 ms':>8} {'publish ms':>11}"
+              f" {'perdus':>7} {'threads':>8} {'RSS Mo':>7}")
+        for i, nb in enumerate(args.inactifs):
+            debut = datetime(2025, 1, 1) + timedelta(days=30 * i)
+            delais, publications, abonnes, perdus = scenario(serveur, port, nb, args.lots, debut)
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            print(f"{nb:>9} {abonnes:>8} {statistics.median(delais):>8.2f} {percentile(delais, 99):>8.2f}"
+                  f" {statistics.median(publications):>11.3f} {perdus:>7} {threading.active_count():>8}"
+                  f" {rss:>7.0f}")
+            time.sleep(0.5)
+
+        http.shutdown()
+        serveur.ingest_queue.stop()
+        os.chdir(RACINE)
+
+
+if __name__ == "__main__":
+    main()
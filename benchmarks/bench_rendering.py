@@ -0,0 +1,96 @@
+import argparse
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rendering import DayPlot
+
+# Temps d'une image de la vue jour d'affiche_base, sans écran (backend Agg) :
+# ancien rendu (ax.clear, plot, canvas.draw à chaque jour) contre DayPlot
+# (courbes persistantes, blit tant que les axes ne bougent pas).
+
+VOIES = ("temperature", "humidity", "pressure")
+DEBUT = datetime(2025, 1, 1)
+
+
+def journees(nb_jours, points):
+    rng = np.random.default_rng(0)
+    for k in range(nb_jours):
+        start = DEBUT + timedelta(days=k)
+        times = np.datetime64(start, "s") + (np.arange(points) * (86400 // points)).astype("timedelta64[s]")
+        phase = np.linspace(0, 2 * np.pi, points)
+        valeurs = {
+            "temperature": (20 + 4 * np.sin(phase) + rng.normal(0, 0.3, points)).astype(np.float32),
+            "humidity": (55 + 10 * np.cos(phase) + rng.normal(0, 1, points)).astype(np.float32),
+            "pressure": (1013 + 2 * np.sin(phase / 2) + rng.normal(0, 0.2, points)).astype(np.float32),
+        }
+        yield start, times, valeurs
+
+
+def figure():
+    fig, axes = plt.subplots(3, 1, figsize=(8, 6), sharex=True)
+    plt.subplots_adjust(top=0.88, bottom=0.1, left=0.1, right=0.95, hspace=0.35)
+    return fig, axes
+
+
+def ancien(fig, axes, start, times, valeurs):
+    fig.suptitle(f"esp - {start.date()}", fontsize=14)
+    for ax, voie in zip(axes, VOIES):
+        ax.clear()
+        ax.plot(times, valeurs[voie], label=voie)
+        ax.set_ylabel(voie)
+        ax.grid(True)
+        ax.set_xlabel("Heure")
+        ax.legend(loc="upper right")
+    fig.canvas.draw()
+
+
+def mesurer(image, jours):
+    durees = []
+    for start, times, valeurs in jours:
+        t0 = time.perf_counter()
+        image(start, times, valeurs)
+        durees.append((time.perf_counter() - t0) * 1000)
+    durees.sort()
+    return statistics.mean(durees), durees[int(len(durees) * 0.99) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Temps d'image de la vue jour (backend Agg)")
+    parser.add_argument("--jours", type=int, default=200)
+    parser.add_argument("--points", type=int, default=288, help="mesures par jour et par voie")
+    args = parser.parse_args()
+
+    jours = list(journees(args.jours, args.points))
+
+    fig, axes = figure()
+    moy, p99 = mesurer(lambda s, t, v: ancien(fig, axes, s, t, v), jours)
+    print(f"ancien rendu  : {moy:7.2f} ms/image (p99 {p99:7.2f})  {1000 / moy:6.1f} images/s")
+    plt.close(fig)
+
+    fig, axes = figure()
+    day_plot = DayPlot(fig.canvas, axes)
+    fig.canvas.draw()
+    # draw_idle est synchrone hors boucle d'événements avec Agg : chaque
+    # changement d'axes coûte donc ici un dessin complet, comme à l'écran
+    fig.canvas.draw_idle = fig.canvas.draw
+    moy, p99 = mesurer(lambda s, t, v: day_plot.update(s, s + timedelta(days=1), t, v,
+                                                       dict.fromkeys(VOIES, True), f"esp - {s.date()}"),
+                       jours)
+    print(f"DayPlot       : {moy:7.2f} ms/image (p99 {p99:7.2f})  {1000 / moy:6.1f} images/s")
+    print(f"                {day_plot.stats['images_blit']} images en blit,"
+          f" {day_plot.stats['images_completes']} dessins complets")
+    plt.close(fig)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import argparse
+import importlib.util
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+RACINE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RACINE)
+
+from db import connect
+from partitions import select_range
+from schema import format_ts, migrate
+
+# Une année de mesures d'un appareil : lignes brutes (ce que lisent les
+# afficheurs aujourd'hui, sérialisées en JSON) contre /api/series réduite
+# côté serveur (LTTB et min-max), puis revalidation par ETag (304).
+
+DEVICE = "esp0_BME1"
+DEBUT = datetime(2024, 1, 1)
+FIN = datetime(2025, 1, 1)
+PAS_SECONDES = 600  # intervalleMesure des ESP
+
+
+def remplir(conn, pas):
+    nb = int((FIN - DEBUT).total_seconds()) // pas
+    conn.execute(f"""
+        WITH RECURSIVE n(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM n WHERE i + 1 < {nb})
+        INSERT INTO mesures (device, temperature, humidity, pressure, timestamp)
+        SELECT '{DEVICE}',
+               20 + 8 * sin(i / 144.0 * 6.2832) + (i % 97) / 50.0,
+               50 + (i % 53) / 10.0, 1000 + (i % 31),
+               strftime('%Y-%m-%d %H:%M:%S', '{format_ts(DEBUT)}', '+' || (i * {pas}) || ' seconds')
+        FROM n
+    """)
+    conn.execute("INSERT INTO device_watermark (device, max_timestamp) VALUES (?, ?)",
+                 (DEVICE, format_ts(FIN)))
+    conn.commit()
+    return nb
+
+
+def chronometrer(fonction, repetitions):
+    durees = []
+    for _ in range(repetitions):
+        t0 = time.perf_counter()
+        resultat = fonction()
+        durees.append((time.perf_counter() - t0) * 1000)
+    return statistics.median(durees), resultat
+
+
+def brut(conn):
+    rows = select_range(conn, ["timestamp", "temperature", "humidity", "pressure"],
+                        [DEVICE], DEBUT, FIN)
+    return json.dumps(rows).encode("utf-8")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de /api/series sur un an")
+    parser.add_argument("--points", type=int, nargs="+", default=[500, 1000, 5000])
+    parser.add_argument("--pas", type=int, default=PAS_SECONDES, help="secondes entre deux mesures")
+    parser.add_argument("--repetitions", type=int, default=10)
+    parser.add_argument("--dir", default=None, help="répertoire de la base temporaire")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        # Le serveur ouvre sa base dans le répertoire courant
+        os.chdir(tmp)
+        conn = connect("mesures_bme280.db")
+        migrate(conn)
+        nb = remplir(conn, args.pas)
+        print(f"{nb} lignes pour {DEVICE} du {DEBUT:%Y-%m-%d} au {FIN:%Y-%m-%d}")
+
+        spec = importlib.util.spec_from_file_location("serveur", os.path.join(RACINE, "serveur-3.0.py"))
+        serveur = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(serveur)
+        client = serveur.app.test_client()
+
+        print(f"{'requête':<24} {'octets':>10} {'médiane ms':>11}")
+        ms, corps = chronometrer(lambda: brut(conn), args.repetitions)
+        print(f"{'lignes brutes (JSON)':<24} {len(corps):>10} {ms:>11.1f}")
+
+        for points in args.points:
+            for methode in ("lttb", "minmax"):
+                url = (f"/api/series?device={DEVICE}&debut={DEBUT:%Y-%m-%d}&fin={FIN:%Y-%m-%d}"
+                       f"&points={points}&methode={methode}")
+                ms, reponse = chronometrer(lambda: client.get(url), args.repetitions)
+                print(f"{f'{methode} {points} pts':<24} {len(reponse.data):>10} {ms:>11.1f}")
+
+        etag = reponse.headers["ETag"]
+        ms, reponse = chronometrer(lambda: client.get(url, headers={"If-None-Match": etag}),
+                                   args.repetitions)
+        print(f"{f'revalidation ({reponse.status_code})':<24} {len(reponse.data):>10} {ms:>11.1f}")
+
+        conn.close()
+        serveur.pool.close_all()
+        os.chdir(RACINE)
+
+
+if __name__ == "__main__":
+    main()
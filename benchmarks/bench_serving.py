@@ -0,0 +1,133 @@
+import argparse
+import json
+import os
+import signal
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime
+
+RACINE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RACINE)
+
+from simulation import PAS_MESURE, build_payload
+
+# Débit de /receive_batch avec des ESP simulés concurrents : serveur de
+# développement (python serveur-3.0.py) puis gunicorn avec plusieurs workers
+# (wsgi.py). Chaque mode tourne sur une base neuve ; à la fin, le nombre de
+# lignes en base est comparé au nombre de lignes acquittées.
+
+MESURES_PAR_LOT = 6
+# Le serveur de développement écoute sur le port 5000, codé en dur
+PORT_DEV = 5000
+PORT_GUNICORN = 5077
+
+
+def percentile(valeurs, p):
+    if not valeurs:
+        return float("nan")
+    valeurs = sorted(valeurs)
+    return valeurs[min(len(valeurs) - 1, int(len(valeurs) * p / 100))]
+
+
+def esp(url, index, duree, resultats, erreurs, lignes):
+    debut = datetime(2025, 1, 1)
+    fin = time.monotonic() + duree
+    k = 0
+    while time.monotonic() < fin:
+        payload = build_payload(f"esp{index}", debut + PAS_MESURE * MESURES_PAR_LOT * k, MESURES_PAR_LOT)
+        requete = urllib.request.Request(f"{url}/receive_batch",
+                                         data=json.dumps(payload).encode(),
+                                         headers={"Content-Type": "application/json"})
+        t0 = time.perf_counter()
+        try:
+            with urllib.request.urlopen(requete, timeout=30) as reponse:
+                reponse.read()
+            resultats.append((time.perf_counter() - t0) * 1000)
+            lignes.append(len(payload))
+        except (urllib.error.URLError, OSError):
+            erreurs.append(1)
+        k += 1
+
+
+def attendre_pret(url, processus, delai=30):
+    fin = time.monotonic() + delai
+    while time.monotonic() < fin:
+        if processus.poll() is not None:
+            raise RuntimeError("Le serveur s'est arrêté au démarrage")
+        try:
+            with urllib.request.urlopen(f"{url}/health", timeout=1) as reponse:
+                if reponse.status == 200:
+                    return
+        except (urllib.error.URLError, OSError):
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("Le serveur ne répond pas sur /health")
+
+
+def compter_lignes(db_path, attendu, delai=30):
+    # Acquitté ne veut pas dire écrit : on laisse les files se vider
+    fin = time.monotonic() + delai
+    while True:
+        conn = sqlite3.connect(db_path)
+        try:
+            n = conn.execute("SELECT COUNT(*) FROM mesures").fetchone()[0]
+        finally:
+            conn.close()
+        if n >= attendu or time.monotonic() > fin:
+            return n
+        time.sleep(0.2)
+
+
+def scenario(nom, commande, port, args):
+    url = f"http://127.0.0.1:{port}"
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, PYTHONPATH=RACINE, LOGGER_BIND=f"127.0.0.1:{port}",
+                   LOGGER_WORKERS=str(args.workers))
+        with open(os.path.join(tmp, "serveur.log"), "w") as log:
+            processus = subprocess.Popen(commande, cwd=tmp, env=env, stdout=log, stderr=log,
+                                         start_new_session=True)
+            try:
+                attendre_pret(url, processus)
+                resultats, erreurs, lignes = [], [], []
+                threads = [threading.Thread(target=esp, args=(url, i, args.duree, resultats, erreurs, lignes))
+                           for i in range(args.esp)]
+                t0 = time.perf_counter()
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+                ecoule = time.perf_counter() - t0
+                en_base = compter_lignes(os.path.join(tmp, "mesures_bme280.db"), sum(lignes))
+            finally:
+                os.killpg(processus.pid, signal.SIGTERM)
+                processus.wait(30)
+
+    print(f"{nom:<24} {len(resultats) / ecoule:>8.0f} {statistics.median(resultats):>8.2f}"
+          f" {percentile(resultats, 99):>8.2f} {len(erreurs):>8} {sum(lignes):>9} {en_base:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Débit du serveur : développement contre gunicorn")
+    parser.add_argument("--esp", type=int, default=32, help="ESP simulés concurrents")
+    parser.add_argument("--duree", type=float, default=10.0, help="secondes par mode")
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    print(f"{args.esp} ESP, {args.duree:.0f} s par mode, lots de {MESURES_PAR_LOT * 2} lignes")
+    print(f"{'mode':<24} {'lots/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'erreurs':>8} {'acquittées':>9} {'en base':>9}")
+    scenario("développement (Flask)", [sys.executable, os.path.join(RACINE, "serveur-3.0.py")],
+             PORT_DEV, args)
+    scenario(f"gunicorn ({args.workers} workers)",
+             [sys.executable, "-m", "gunicorn", "-c", os.path.join(RACINE, "gunicorn.conf.py"), "wsgi:app"],
+             PORT_GUNICORN, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+import calendar
+import struct
+from datetime import datetime, timedelta
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from ingest import BatchError
+from schema import FORMAT_TIMESTAMP
+
+# Format binaire compact pour /receive_batch (Content-Type: application/octet-stream),
+# alternative au tableau JSON. Tout est en petit-boutiste (ESP8266/ESP32).
+#
+# En-tête (12 octets + nom) :
+#   4s  magic "MESB"
+#   B   version (1)
+#   B   longueur du nom de l'ESP en octets (UTF-8)
+#   H   nombre d'enregistrements
+#   I   horodatage de base, secondes depuis 1970-01-01 en heure locale de l'ESP
+#   ... nom de l'ESP, ex. "banane"
+#
+# Enregistrements (13 octets chacun) :
+#   I   décalage en secondes depuis l'horodatage de base
+#   B   numéro du capteur : n -> appareil "<nom>_BMEn", 0 -> "<nom>"
+#   h   température en centièmes de °C
+#   H   humidité en centièmes de %
+#   I   pression en centièmes de hPa
+# Valeur absente (NaN côté ESP) : valeur réservée -32768 pour h, maximum du type sinon.
+
+MAGIC = b"MESB"
+VERSION = 1
+CONTENT_TYPE = "application/octet-stream"
+
+EN_TETE = struct.Struct("<4sBBHI")
+ENREGISTREMENT = struct.Struct("<IBhHI")
+ECHELLE = 100
+
+ABSENT_T = -32768
+ABSENT_H = 0xFFFF
+ABSENT_P = 0xFFFFFFFF
+
+if np is not None:
+    DTYPE = np.dtype([("offset", "<u4"), ("capteur", "u1"), ("temperature", "<i2"),
+                      ("humidity", "<u2"), ("pressure", "<u4")])
+    assert DTYPE.itemsize == ENREGISTREMENT.size
+
+
+class BinaryFormatError(BatchError):
+    pass
+
+
+def _device(nom, capteur):
+    return f"{nom}_BME{capteur}" if capteur else nom
+
+
+def _split_device(device):
+    nom, _, suffixe = device.rpartition("_BME")
+    if nom and suffixe.isdigit():
+        return nom, int(suffixe)
+    return device, 0
+
+
+def _echelle(v, absent):
+    return absent if v is None else int(round(v * ECHELLE))
+
+
+def encode_payload(payload):
+    # payload : liste de dicts au format JSON de /receive_batch, un seul ESP
+    if not payload:
+        raise BinaryFormatError("Lot vide")
+    noms = {_split_device(e["device"])[0] for e in payload}
+    if len(noms) != 1:
+        raise BinaryFormatError("Un lot binaire ne peut contenir qu'un seul ESP")
+    nom = noms.pop().encode("utf-8")
+
+    instants = [datetime.strptime(e["timestamp"], FORMAT_TIMESTAMP) for e in payload]
+    base = min(instants)
+    base_s = calendar.timegm(base.timetuple())
+
+    parties = [EN_TETE.pack(MAGIC, VERSION, len(nom), len(payload), base_s), nom]
+    for e, instant in zip(payload, instants):
+        parties.append(ENREGISTREMENT.pack(
+            int((instant - base).total_seconds()),
+            _split_device(e["device"])[1],
+            _echelle(e.get("temperature"), ABSENT_T),
+            _echelle(e.get("humidity"), ABSENT_H),
+            _echelle(e.get("pressure"), ABSENT_P),
+        ))
+    return b"".join(parties)
+
+
+def _lire_en_tete(data):
+    if len(data) < EN_TETE.size:
+        raise BinaryFormatError("Lot binaire tronqué")
+    magic, version, nom_len, nb, base_s = EN_TETE.unpack_from(data)
+    if magic != MAGIC:
+        raise BinaryFormatError("Lot binaire : signature invalide")
+    if version != VERSION:
+        raise BinaryFormatError(f"Lot binaire : version {version} non gérée")
+    debut = EN_TETE.size + nom_len
+    if len(data) != debut + nb * ENREGISTREMENT.size:
+        raise BinaryFormatError("Lot binaire : taille incohérente")
+    if nb == 0:
+        raise BinaryFormatError("Aucune donnée reçue ou format incorrect")
+    try:
+        nom = data[EN_TETE.size:debut].decode("utf-8")
+    except UnicodeDecodeError:
+        raise BinaryFormatError("Lot binaire : nom d'ESP invalide")
+    if not nom:
+        raise BinaryFormatError("Lot binaire : nom d'ESP manquant")
+    return nom, nb, base_s, debut
+
+
+def _decode_numpy(data, nom, nb, base_s, debut):
+    rec = np.frombuffer(data, dtype=DTYPE, count=nb, offset=debut)
+
+    instants = (np.int64(base_s) + rec["offset"].astype(np.int64)).astype("datetime64[s]")
+    horodatages = np.char.replace(np.datetime_as_string(instants, unit="s"), "T", " ").tolist()
+
+    colonnes = []
+    for voie, absent in (("temperature", ABSENT_T), ("humidity", ABSENT_H), ("pressure", ABSENT_P)):
+        brut = rec[voie]
+        valeurs = (brut / ECHELLE).astype(object)
+        valeurs[brut == absent] = None
+        colonnes.append(valeurs.tolist())
+
+    noms = {c: _device(nom, c) for c in np.unique(rec["capteur"]).tolist()}
+    devices = [noms[c] for c in rec["capteur"].tolist()]
+    return list(zip(devices, *colonnes, horodatages))
+
+
+def _decode_struct(data, nom, nb, base_s, debut):
+    base = datetime(1970, 1, 1) + timedelta(seconds=base_s)
+    rows = []
+    for offset, capteur, t, h, p in ENREGISTREMENT.iter_unpack(data[debut:]):
+        rows.append((
+            _device(nom, capteur),
+            None if t == ABSENT_T else t / ECHELLE,
+            None if h == ABSENT_H else h / ECHELLE,
+            None if p == ABSENT_P else p / ECHELLE,
+            (base + timedelta(seconds=offset)).strftime(FORMAT_TIMESTAMP),
+        ))
+    return rows
+
+
+# Renvoie des lignes au même format que ingest.validate_batch
+def decode_batch(data):
+    nom, nb, base_s, debut = _lire_en_tete(data)
+    if np is not None:
+        return _decode_numpy(data, nom, nb, base_s, debut)
+    return _decode_struct(data, nom, nb, base_s, debut)
@@ -0,0 +1,429 @@
+import argparse
+from array import array
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+import heapq
+from itertools import accumulate, groupby
+import math
+from operator import itemgetter, xor
+import sqlite3
+import struct
+import sys
+import time
+import zlib
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from db import DB_FILE, connect
+from schema import format_ts, migrate
+
+# Stockage en colonnes compressées des mesures froides.
+#
+# Une fois qu'un ESP ne peut plus renvoyer de mesures d'un jour, les lignes
+# de ce jour (une par mesure, ~130 octets avec l'index) sont regroupées en un
+# bloc par appareil et par jour dans la table blocs :
+#  - horodatages : premier horodatage, puis écarts en secondes (uint32) ;
+#  - chaque voie en centièmes entiers (comme le format binaire des ESP), codés
+#    par écart avec la valeur précédente, avec un champ de bits des valeurs
+#    présentes ; une voie dont une valeur n'est pas exacte au centième passe
+#    en flottants 64 bits XOR la valeur précédente (sans perte, façon Gorilla) ;
+#  - chaque colonne est découpée en plans d'octets (tous les octets de poids
+#    faible, puis les suivants...) : les écarts, petits, laissent des plans
+#    presque constants que zlib réduit à rien.
+# Un jour tient en quelques centaines d'octets au lieu de ~20 Ko.
+#
+# partitions.iter_range lit les blocs comme une partition de plus (lignes
+# décodées en Python) ; data_access les décode directement en tableaux NumPy,
+# un bloc par appel. Les mesures arrivées en retard pour un jour compacté
+# restent dans la table mesures jusqu'au compactage suivant, qui les fond dans
+# le bloc. Le jour le plus récent de chaque appareil n'est jamais compacté :
+# /data et /latest trouvent presque toujours leurs lignes dans la table
+# mesures (sinon partitions.latest_rows complète depuis les blocs). Les
+# mesures compactées perdent leur identifiant (id NULL à l'export).
+
+MAGIC = b"MESC"
+VERSION = 1
+# magic, version, codage de chaque voie, nombre de mesures, premier horodatage
+EN_TETE = struct.Struct("<4sB3BIq")
+ECHELLE = 100
+
+ABSENTE, ENTIERS, FLOTTANTS = 0, 1, 2
+
+VOIES = ("temperature", "humidity", "pressure")
+COLONNES = ("id", "device", "timestamp", *VOIES)
+
+# Les ESP gardent jusqu'à 7 jours de mesures : un jour n'est compacté qu'après ce délai
+DELAI_JOURS = 8
+PAUSE_S = 0.01
+NIVEAU_ZLIB = 6
+
+EPOQUE = datetime(1970, 1, 1)
+PETIT_BOUTISTE = sys.byteorder == "little"
+
+
+def create_table(conn):
+    # Table à rowid : des lignes de plusieurs centaines d'octets ne vont pas
+    # dans une table WITHOUT ROWID
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS blocs (
+            device TEXT NOT NULL,
+            jour TEXT NOT NULL,
+            n INTEGER NOT NULL,
+            premier TEXT NOT NULL,
+            dernier TEXT NOT NULL,
+            donnees BLOB NOT NULL,
+            PRIMARY KEY (device, jour)
+        )
+    """)
+
+
+# -- codage ------------------------------------------------------------------
+
+def _octets(tableau):
+    if not PETIT_BOUTISTE:
+        tableau = array(tableau.typecode, tableau)
+        tableau.byteswap()
+    return tableau.tobytes()
+
+
+def _tableau(typecode, octets):
+    tableau = array(typecode)
+    tableau.frombytes(octets)
+    if not PETIT_BOUTISTE:
+        tableau.byteswap()
+    return tableau
+
+
+def _en_plans(octets, largeur):
+    return b"".join(octets[i::largeur] for i in range(largeur))
+
+
+def _depuis_plans(octets, largeur):
+    n = len(octets) // largeur
+    resultat = bytearray(len(octets))
+    for i in range(largeur):
+        resultat[i::largeur] = octets[i * n:(i + 1) * n]
+    return bytes(resultat)
+
+
+def _champ_de_bits(presentes):
+    octets = bytearray((len(presentes) + 7) // 8)
+    for i, present in enumerate(presentes):
+        if present:
+            octets[i >> 3] |= 1 << (i & 7)
+    return bytes(octets)
+
+
+def _entiers(valeurs):
+    entiers = []
+    for v in valeurs:
+        if v is None:
+            continue
+        # ±inf (ou NaN) n'a pas d'écriture en centièmes : flottants, comme
+        # une valeur inexacte, plutôt qu'une OverflowError qui bloquerait le jour
+        if not math.isfinite(v * ECHELLE):
+            return None
+        e = round(v * ECHELLE)
+        if e / ECHELLE != v or not -2 ** 31 < e < 2 ** 31:
+            return None
+        entiers.append(e)
+    return entiers
+
+
+def _coder_voie(valeurs):
+    if all(v is None for v in valeurs):
+        return ABSENTE, b""
+    entiers = _entiers(valeurs)
+    if entiers is not None and max(entiers) - min(entiers) < 2 ** 31:
+        # Valeur absente : écart nul, le champ de bits la distingue
+        ecarts, precedent, it = [], 0, iter(entiers)
+        for v in valeurs:
+            if v is not None:
+                e = next(it)
+                ecarts.append(e - precedent)
+                precedent = e
+            else:
+                ecarts.append(0)
+        presentes = _champ_de_bits([v is not None for v in valeurs])
+        return ENTIERS, presentes + _en_plans(_octets(array("i", ecarts)), 4)
+    bits = _tableau("Q", _octets(array("d", (float("nan") if v is None else v for v in valeurs))))
+    xors = array("Q", (a ^ b for a, b in zip(bits, [0, *bits[:-1]])))
+    return FLOTTANTS, _en_plans(_octets(xors), 8)
+
+
+# rows : [(horodatage, température, humidité, pression)] triées par horodatage
+def encode_block(rows):
+    secondes = [(datetime.fromisoformat(r[0]) - EPOQUE) // timedelta(seconds=1) for r in rows]
+    ecarts = array("I", (b - a for a, b in zip(secondes, secondes[1:])))
+    codages, morceaux = [], [_en_plans(_octets(ecarts), 4)]
+    for j in range(1, 4):
+        codage, octets = _coder_voie([r[j] for r in rows])
+        codages.append(codage)
+        morceaux.append(octets)
+    en_tete = EN_TETE.pack(MAGIC, VERSION, *codages, len(rows), secondes[0])
+    return en_tete + zlib.compress(b"".join(morceaux), NIVEAU_ZLIB)
+
+
+def _lire(blob):
+    magic, version, *codages, n, t0 = EN_TETE.unpack_from(blob)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Bloc de mesures invalide")
+    corps = zlib.decompress(blob[EN_TETE.size:])
+    # (codage, champ de bits, plans) de chaque voie
+    fin = 4 * (n - 1)
+    ecarts, voies = corps[:fin], []
+    for codage in codages:
+        if codage == ENTIERS:
+            debut, fin = fin, fin + (n + 7) // 8
+            voies.append((codage, corps[debut:fin], corps[fin:fin + 4 * n]))
+            fin += 4 * n
+        elif codage == FLOTTANTS:
+            voies.append((codage, None, corps[fin:fin + 8 * n]))
+            fin += 8 * n
+        else:
+            voies.append((codage, None, None))
+    return n, t0, ecarts, voies
+
+
+# Décodage sans NumPy : [(horodatage, température, humidité, pression)]
+def decode_rows(blob):
+    n, t0, ecarts, voies = _lire(blob)
+    secondes = accumulate(_tableau("I", _depuis_plans(ecarts, 4)), initial=t0)
+    horodatages = [format_ts(EPOQUE + timedelta(seconds=s)) for s in secondes]
+    colonnes = [horodatages]
+    for codage, presentes, plans in voies:
+        if codage == ENTIERS:
+            cumul = accumulate(_tableau("i", _depuis_plans(plans, 4)))
+            colonnes.append([e / ECHELLE if presentes[i >> 3] >> (i & 7) & 1 else None
+                             for i, e in enumerate(cumul)])
+        elif codage == FLOTTANTS:
+            bits = array("Q", accumulate(_tableau("Q", _depuis_plans(plans, 8)), xor))
+            colonnes.append([None if v != v else v for v in _tableau("d", _octets(bits))])
+        else:
+            colonnes.append([None] * n)
+    return list(zip(*colonnes))
+
+
+def _plans_numpy(plans, dtype):
+    largeur = np.dtype(dtype).itemsize
+    octets = np.frombuffer(plans, dtype=np.uint8).reshape(largeur, -1)
+    return np.ascontiguousarray(octets.T).view(dtype).ravel()
+
+
+# Décodage d'un bloc entier en tableaux : (t en datetime64[s], [valeurs de
+# chaque voie], NaN si absente)
+def decode_arrays(blob, dtype=None):
+    dtype = dtype or np.float32
+    n, t0, ecarts, voies = _lire(blob)
+    secondes = np.zeros(n, dtype=np.int64)
+    np.cumsum(_plans_numpy(ecarts, "<u4"), dtype=np.int64, out=secondes[1:])
+    secondes += t0
+    valeurs = []
+    for codage, presentes, plans in voies:
+        if codage == ENTIERS:
+            v = np.cumsum(_plans_numpy(plans, "<i4"), dtype=np.int64) / ECHELLE
+            masque = np.unpackbits(np.frombuffer(presentes, dtype=np.uint8), count=n, bitorder="little")
+            v[masque == 0] = np.nan
+        elif codage == FLOTTANTS:
+            v = np.bitwise_xor.accumulate(_plans_numpy(plans, "<u8")).view(np.float64)
+        else:
+            v = np.full(n, np.nan)
+        valeurs.append(v.astype(dtype, copy=False))
+    return secondes.view("datetime64[s]"), valeurs
+
+
+# -- lecture -----------------------------------------------------------------
+
+def _blocs(conn, devices, start, end, ordre):
+    filtre, params = "1", []
+    if devices is not None:
+        filtre += f" AND device IN ({', '.join('?' * len(devices))})"
+        params.extend(devices)
+    if start is not None:
+        filtre += " AND jour >= ? AND dernier >= ?"
+        params.extend((format_ts(start)[:10], format_ts(start)))
+    if end is not None:
+        filtre += " AND premier < ?"
+        params.append(format_ts(end))
+    try:
+        return conn.execute(f"SELECT device, jour, donnees FROM blocs WHERE {filtre} ORDER BY {ordre}",
+                            params)
+    except sqlite3.OperationalError:
+        # Base pas encore migrée : aucun bloc
+        return iter(())
+
+
+# Lignes des blocs (colonnes demandées) sur [start, end[, triées par
+# horodatage : une source de plus pour partitions.iter_range. Un jour est
+# décodé à la fois, tous appareils confondus.
+def iter_rows(conn, colonnes, devices, start=None, end=None):
+    inconnues = set(colonnes) - set(COLONNES)
+    if inconnues:
+        raise ValueError(f"Colonnes absentes des blocs : {', '.join(sorted(inconnues))}")
+    debut = format_ts(start) if start is not None else ""
+    fin = format_ts(end) if end is not None else "~"
+    # Lignes (id, device, timestamp, voies...) projetées sur les colonnes demandées
+    indices = [COLONNES.index(c) for c in colonnes]
+    i = colonnes.index("timestamp")
+    blocs = _blocs(conn, devices, start, end, "jour, device")
+    for _, du_jour in groupby(blocs, key=itemgetter(1)):
+        sources = []
+        for device, _, donnees in du_jour:
+            sources.append([tuple((None, device, *r)[j] for j in indices)
+                            for r in decode_rows(donnees) if debut <= r[0] < fin])
+        yield from heapq.merge(*sources, key=itemgetter(i))
+
+
+# {appareil: (t, {voie: valeurs})} des blocs sur [start, end[, décodés en
+# tableaux NumPy ; seuls les appareils ayant des blocs dans la plage y figurent
+def load_arrays(conn, devices, voies=VOIES, start=None, end=None, dtype=None):
+    morceaux = {}
+    for device, _, donnees in _blocs(conn, devices, start, end, "device, jour"):
+        t, valeurs = decode_arrays(donnees, dtype)
+        garde = np.ones(len(t), dtype=bool)
+        if start is not None:
+            garde &= t >= np.datetime64(start, "s")
+        if end is not None:
+            garde &= t < np.datetime64(end, "s")
+        morceaux.setdefault(device, []).append((t[garde], [v[garde] for v in valeurs]))
+    resultat = {}
+    for device, blocs in morceaux.items():
+        t = np.concatenate([b[0] for b in blocs])
+        resultat[device] = (t, {v: np.concatenate([b[1][VOIES.index(v)] for b in blocs])
+                                for v in voies})
+    return resultat
+
+
+# [(appareil, dernier horodatage compacté)] (d'un seul appareil si device)
+def last_seen(conn, device=None):
+    filtre, params = "", ()
+    if device is not None:
+        filtre, params = "WHERE device = ?", (device,)
+    try:
+        return conn.execute(f"SELECT device, MAX(dernier) FROM blocs {filtre} GROUP BY device",
+                            params).fetchall()
+    except sqlite3.OperationalError:
+        return []
+
+
+# n dernières mesures compactées de l'appareil, au format de
+# queries.latest_per_device : (device, température, humidité, pression, horodatage)
+def latest_rows(conn, device, n):
+    rows = []
+    for (donnees,) in conn.execute("SELECT donnees FROM blocs WHERE device = ? ORDER BY jour DESC",
+                                   (device,)):
+        rows[:0] = [(device, t, h, p, ts) for ts, t, h, p in decode_rows(donnees)]
+        if len(rows) >= n:
+            break
+    return rows[-n:]
+
+
+# -- compactage --------------------------------------------------------------
+
+# [(appareil, jour, lignes)] de la table mesures à compacter : jours finis
+# depuis delai_jours, sauf le plus récent de chaque appareil
+def cold_days(conn, maintenant=None, delai_jours=DELAI_JOURS):
+    limite = ((maintenant or datetime.now()) - timedelta(days=delai_jours)).strftime("%Y-%m-%d")
+    return conn.execute("""
+        SELECT device, substr(timestamp, 1, 10) AS jour, COUNT(*)
+        FROM mesures m
+        WHERE device IS NOT NULL AND timestamp IS NOT NULL AND timestamp < ?
+        GROUP BY device, jour
+        HAVING jour < (SELECT substr(max_timestamp, 1, 10) FROM device_watermark
+                       WHERE device = m.device)
+        ORDER BY jour, device
+    """, (limite,)).fetchall()
+
+
+# Déplace les mesures d'un appareil pour un jour dans son bloc (fondues avec
+# celles déjà compactées), en une transaction. Renvoie le nombre de lignes.
+def pack_day(conn, device, jour):
+    debut = jour + " 00:00:00"
+    fin = format_ts(datetime.fromisoformat(jour) + timedelta(days=1))
+    # IMMEDIATE : aucune mesure de ce jour ne peut arriver entre lecture et suppression
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        rows = conn.execute("""
+            SELECT timestamp, temperature, humidity, pressure FROM mesures
+            WHERE device = ? AND timestamp >= ? AND timestamp < ?
+            ORDER BY timestamp, id
+        """, (device, debut, fin)).fetchall()
+        if rows:
+            row = conn.execute("SELECT donnees FROM blocs WHERE device = ? AND jour = ?",
+                               (device, jour)).fetchone()
+            if row is not None:
+                # À horodatage égal, les mesures déjà compactées restent devant
+                rows = list(heapq.merge(decode_rows(row[0]), rows, key=itemgetter(0)))
+            conn.execute("""
+                INSERT OR REPLACE INTO blocs (device, jour, n, premier, dernier, donnees)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (device, jour, len(rows), rows[0][0], rows[-1][0], encode_block(rows)))
+            conn.execute("DELETE FROM mesures WHERE device = ? AND timestamp >= ? AND timestamp < ?",
+                         (device, debut, fin))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(rows)
+
+
+# Une passe complète ; verrou : verrou d'écriture commun des workers, pris
+# pour chaque jour. Renvoie (jours, lignes) compactés.
+def compact(conn, maintenant=None, delai_jours=DELAI_JOURS, verrou=None, pause_s=PAUSE_S,
+            verbose=False):
+    jours = lignes = 0
+    for device, jour, _ in cold_days(conn, maintenant, delai_jours):
+        with verrou or nullcontext():
+            n = pack_day(conn, device, jour)
+        jours += 1
+        lignes += n
+        if verbose and jours % 100 == 0:
+            print(f"{jours} jours compactés ({lignes} lignes)")
+        if pause_s:
+            time.sleep(pause_s)
+    return jours, lignes
+
+
+# (blocs, lignes, octets des blocs)
+def block_stats(conn):
+    blocs, lignes, octets = conn.execute(
+        "SELECT COUNT(*), IFNULL(SUM(n), 0), IFNULL(SUM(length(donnees)), 0) FROM blocs").fetchone()
+    return blocs, lignes, octets
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compacte les jours froids en blocs colonnes compressés")
+    parser.add_argument("db", nargs="?", default=DB_FILE)
+    parser.add_argument("--delai-jours", type=int, default=DELAI_JOURS,
+                        help="un jour est compacté ce nombre de jours après sa fin")
+    parser.add_argument("--dry-run", action="store_true", help="compte les jours sans compacter")
+    parser.add_argument("--vacuum", action="store_true", help="VACUUM de la base ensuite")
+    args = parser.parse_args()
+    if args.delai_jours < DELAI_JOURS:
+        parser.error(f"--delai-jours : au moins {DELAI_JOURS} (renvois des ESP)")
+
+    conn = connect(args.db)
+    try:
+        migrate(conn, verbose=True)
+        if args.dry_run:
+            froids = cold_days(conn, delai_jours=args.delai_jours)
+            print(f"{len(froids)} jours à compacter ({sum(r[2] for r in froids)} lignes)")
+            return
+        t0 = time.perf_counter()
+        jours, lignes = compact(conn, delai_jours=args.delai_jours, verbose=True)
+        print(f"{jours} jours ({lignes} lignes) compactés en {time.perf_counter() - t0:.1f} s")
+        blocs, n, octets = block_stats(conn)
+        if n:
+            print(f"Blocs : {blocs} ({n} mesures), {octets / 1e6:.2f} Mo, {octets / n:.1f} octets par mesure")
+        if args.vacuum and jours:
+            conn.execute("VACUUM")
+            print("VACUUM terminé")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
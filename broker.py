@@ -0,0 +1,162 @@
+from collections import deque
+import threading
+import time
+
+# Diffusion en direct des mesures validées (SSE et long-poll).
+#
+# Le rédacteur de la file d'ingestion publie les lignes de chaque commit.
+# Chaque publication reçoit un numéro de séquence et est gardée dans un
+# historique court, qui sert au long-poll (« tout ce qui suit le numéro n »)
+# et à la reprise d'un flux SSE après reconnexion (Last-Event-ID).
+#
+# Sous plusieurs workers (wsgi.py), chacun publie les lignes relues en base :
+# le numéro est alors le plus grand mesures.id relayé, et chaque ligne garde
+# son id. Un curseur reçu d'un worker vaut pour tous les autres : la reprise
+# ne renvoie que les lignes d'id supérieur, même si les workers ont découpé
+# les publications différemment. Seul, le serveur numérote 1, 2, 3...
+#
+# Un abonné SSE a son propre tampon borné : un client lent perd les plus
+# anciennes publications (comptées, et signalées au client) au lieu de faire
+# grossir la mémoire du serveur. Un abonné inactif ne coûte qu'un thread
+# endormi sur son Event : publier ne réveille que les abonnés concernés.
+
+HISTORIQUE = 1024
+TAMPON = 256
+MAX_ABONNES = 1000
+
+
+class TooManySubscribers(Exception):
+    pass
+
+
+def _apres(rows, ids, depuis):
+    # Lignes d'id supérieur au curseur (toutes si la publication n'a pas d'id)
+    if ids is None:
+        return rows
+    return [row for row, i in zip(rows, ids) if i > depuis]
+
+
+def _filtrer(rows, devices):
+    if devices is None:
+        return rows
+    return [row for row in rows if row[0] in devices]
+
+
+class Subscription:
+    def __init__(self, devices, taille):
+        self.devices = devices
+        self._tampon = deque(maxlen=taille)
+        self._lock = threading.Lock()
+        self._signal = threading.Event()
+        self.perdues = 0
+
+    def _pousser(self, seq, rows):
+        with self._lock:
+            if len(self._tampon) == self._tampon.maxlen:
+                self.perdues += 1
+            self._tampon.append((seq, rows))
+        self._signal.set()
+
+    # ([(seq, lignes)], publications perdues depuis le dernier appel)
+    def get(self, timeout):
+        self._signal.wait(timeout)
+        with self._lock:
+            evenements = list(self._tampon)
+            self._tampon.clear()
+            perdues, self.perdues = self.perdues, 0
+            self._signal.clear()
+        return evenements, perdues
+
+
+class Broker:
+    def __init__(self, historique=HISTORIQUE, tampon=TAMPON, max_abonnes=MAX_ABONNES):
+        self.tampon = tampon
+        self.max_abonnes = max_abonnes
+        self._dernier = 0
+        self._historique = deque(maxlen=historique)
+        self._abonnes = set()
+        self._lock = threading.Lock()
+        self._nouveau = threading.Condition(self._lock)
+
+        self.stats = {"publications": 0, "lignes": 0, "envois": 0, "publish_ms": 0.0}
+
+    # Numéro de départ d'un worker : le dernier mesures.id déjà en base
+    def start_at(self, seq):
+        with self._lock:
+            if not self._historique:
+                self._dernier = seq
+
+    # Abonné de IngestQueue : lignes insérées, après le commit. seq et ids :
+    # plus grand id relayé et id de chaque ligne (wsgi.py), sinon numéro suivant
+    def publish(self, rows, seq=None, ids=None):
+        t0 = time.perf_counter()
+        with self._lock:
+            precedent = self._dernier
+            if seq is None:
+                seq = precedent + 1
+            self._dernier = seq
+            # precedent : numéro qui précède, pour détecter un historique dépassé
+            self._historique.append((seq, precedent, rows, ids))
+            abonnes = list(self._abonnes)
+            self._nouveau.notify_all()
+        envois = 0
+        for sub in abonnes:
+            filtrees = _filtrer(rows, sub.devices)
+            if filtrees:
+                sub._pousser(seq, filtrees)
+                envois += 1
+        self.stats["publications"] += 1
+        self.stats["lignes"] += len(rows)
+        self.stats["envois"] += envois
+        self.stats["publish_ms"] = round((time.perf_counter() - t0) * 1000, 3)
+        return seq
+
+    # -- SSE ---------------------------------------------------------------
+
+    # depuis : dernier numéro reçu avant une reconnexion, rejoué depuis l'historique
+    def subscribe(self, devices=None, depuis=None):
+        sub = Subscription(set(devices) if devices else None, self.tampon)
+        with self._lock:
+            if len(self._abonnes) >= self.max_abonnes:
+                raise TooManySubscribers(f"Trop d'abonnés ({self.max_abonnes})")
+            self._abonnes.add(sub)
+            rejeu = [(s, _apres(r, ids, depuis)) for s, _, r, ids in self._historique
+                     if depuis is not None and s > depuis]
+        for seq, rows in rejeu:
+            filtrees = _filtrer(rows, sub.devices)
+            if filtrees:
+                sub._pousser(seq, filtrees)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._abonnes.discard(sub)
+
+    # -- long-poll ---------------------------------------------------------
+
+    # Publications postérieures à « depuis » pour ces appareils, en attendant
+    # au plus timeout secondes s'il n'y en a pas encore.
+    # Renvoie (dernier numéro, [(seq, lignes)], historique dépassé ?)
+    def poll(self, depuis, devices=None, timeout=25.0):
+        devices = set(devices) if devices else None
+        limite = time.monotonic() + timeout
+        with self._lock:
+            while True:
+                depasse = bool(self._historique) and depuis < self._historique[0][1]
+                evenements = [(s, _filtrer(_apres(r, ids, depuis), devices))
+                              for s, _, r, ids in self._historique if s > depuis]
+                evenements = [(s, r) for s, r in evenements if r]
+                reste = limite - time.monotonic()
+                if evenements or depasse or reste <= 0:
+                    return self._dernier, evenements, depasse
+                # Rien pour ces appareils : on avance le curseur et on attend
+                depuis = max(depuis, self._dernier)
+                self._nouveau.wait(reste)
+
+    def last_seq(self):
+        with self._lock:
+            return self._dernier
+
+    def info(self):
+        with self._lock:
+            return dict(self.stats, abonnes=len(self._abonnes), dernier=self._dernier)
@@ -0,0 +1,249 @@
+import argparse
+from datetime import date, timedelta
+import sqlite3
+import time
+
+from blocks import decode_rows
+from db import DB_FILE, connect
+from partitions import archived_months
+from retention import horizon
+from schema import migrate
+
+# Catalogue des appareils : une ligne par appareil, tenue à jour dans la
+# transaction d'ingestion (comme les agrégats). Listes d'appareils, bornes de
+# dates et jours couverts deviennent des lectures de quelques lignes au lieu
+# de parcours de la table des mesures.
+#
+# Les jours couverts sont un champ de bits : le bit i de days vaut 1 si
+# l'appareil a au moins une mesure le jour days_start + i (octets petit-boutistes).
+# Dix ans de mesures tiennent en moins de 500 octets.
+
+VOIES = ("temperature", "humidity", "pressure")
+
+COLONNES = ("first_seen", "last_seen", "n", *VOIES, "days_start", "days")
+
+
+def create_table(conn):
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS devices (
+            device TEXT PRIMARY KEY,
+            first_seen TEXT NOT NULL,
+            last_seen TEXT NOT NULL,
+            n INTEGER NOT NULL,
+            {", ".join(f"{v} REAL" for v in VOIES)},
+            days_start TEXT NOT NULL,
+            days BLOB NOT NULL
+        ) WITHOUT ROWID
+    """)
+
+
+UPSERT = f"""
+    INSERT OR REPLACE INTO devices (device, {", ".join(COLONNES)})
+    VALUES ({", ".join("?" * (len(COLONNES) + 1))})
+"""
+
+
+# -- champ de bits des jours -------------------------------------------------
+
+def _ajouter_jours(debut, bits, jours):
+    # debut : jour du bit 0 (YYYY-MM-DD) ou None ; jours : ensemble de YYYY-MM-DD
+    premier = min(jours)
+    if debut is None:
+        debut = premier
+    elif premier < debut:
+        bits <<= (date.fromisoformat(debut) - date.fromisoformat(premier)).days
+        debut = premier
+    origine = date.fromisoformat(debut)
+    for jour in jours:
+        bits |= 1 << (date.fromisoformat(jour) - origine).days
+    return debut, bits
+
+
+def _en_octets(bits):
+    return bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+
+
+def days_of(days_start, days):
+    bits = int.from_bytes(days, "little")
+    origine = date.fromisoformat(days_start)
+    return [origine + timedelta(days=i) for i in range(bits.bit_length()) if bits >> i & 1]
+
+
+# -- mise à jour à l'ingestion -----------------------------------------------
+
+def _fusionner(ligne, premier, dernier, n, valeurs, jours):
+    if ligne is None:
+        debut, bits = _ajouter_jours(None, 0, jours)
+        return premier, dernier, n, *valeurs, debut, _en_octets(bits)
+    ancien_premier, ancien_dernier, ancien_n, t, h, p, debut, octets = ligne
+    if dernier < ancien_dernier:
+        dernier, valeurs = ancien_dernier, (t, h, p)
+    debut, bits = _ajouter_jours(debut, int.from_bytes(octets, "little"), jours)
+    return min(premier, ancien_premier), dernier, ancien_n + n, *valeurs, debut, _en_octets(bits)
+
+
+def _resumer(rows):
+    # device -> [premier, dernier, n, valeurs du dernier, jours]
+    acc = {}
+    for device, t, h, p, ts in rows:
+        a = acc.get(device)
+        if a is None:
+            a = acc[device] = [ts, ts, 0, (t, h, p), set()]
+        if ts < a[0]:
+            a[0] = ts
+        # À horodatage égal, la dernière ligne du lot l'emporte
+        if ts >= a[1]:
+            a[1], a[3] = ts, (t, h, p)
+        a[2] += 1
+        a[4].add(ts[:10])
+    return acc
+
+
+# Appelé par ingest.write_rows, dans la transaction d'insertion
+def update_catalogue(conn, rows):
+    for device, (premier, dernier, n, valeurs, jours) in _resumer(rows).items():
+        ligne = conn.execute(f"SELECT {', '.join(COLONNES)} FROM devices WHERE device = ?",
+                             (device,)).fetchone()
+        conn.execute(UPSERT, (device, *_fusionner(ligne, premier, dernier, n, valeurs, jours)))
+
+
+# -- lectures ----------------------------------------------------------------
+
+def list_devices(conn):
+    return [row[0] for row in conn.execute("SELECT device FROM devices ORDER BY device")]
+
+
+# Jours ayant au moins une mesure pour l'un des appareils, triés
+def days_for(conn, devices):
+    jours = set()
+    rows = conn.execute(f"""
+        SELECT days_start, days FROM devices WHERE device IN ({", ".join("?" * len(devices))})
+    """, devices)
+    for debut, octets in rows:
+        jours.update(days_of(debut, octets))
+    return sorted(jours)
+
+
+# [{device, first_seen, last_seen, n, temperature, humidity, pressure, jours}]
+def catalogue(conn):
+    rows = conn.execute(f"SELECT device, {', '.join(COLONNES)} FROM devices ORDER BY device")
+    resultat = []
+    for device, premier, dernier, n, t, h, p, debut, octets in rows:
+        resultat.append({
+            "device": device, "first_seen": premier, "last_seen": dernier, "n": n,
+            "temperature": t, "humidity": h, "pressure": p,
+            "jours": bin(int.from_bytes(octets, "little")).count("1"),
+        })
+    return resultat
+
+
+# -- recalcul complet --------------------------------------------------------
+
+def _sources(conn):
+    yield conn
+    for chemin, _ in archived_months(conn).values():
+        source = sqlite3.connect(f"file:{chemin}?mode=ro", uri=True)
+        try:
+            yield source
+        finally:
+            source.close()
+
+
+def _resumes_purges(conn, purge):
+    # Avant la limite de rétention, seuls restent les agrégats journaliers :
+    # bornes à la journée près, pas de dernières valeurs
+    jours = {}
+    for device, jour in conn.execute("""
+        SELECT device, substr(bucket, 1, 10) FROM rollup_jour WHERE bucket < ?
+    """, (purge,)):
+        jours.setdefault(device, set()).add(jour)
+    resumes = {}
+    for device, premier, dernier, n in conn.execute("""
+        SELECT device, MIN(bucket), MAX(bucket), SUM(n) FROM rollup_jour
+        WHERE bucket < ? GROUP BY device
+    """, (purge,)):
+        resumes[device] = _fusionner(None, premier, dernier, n, (None, None, None), jours[device])
+    return resumes
+
+
+def _resumes_blocs(conn, purge, resumes):
+    # Jours compactés : bornes et nombres dans les colonnes de la table blocs,
+    # dernières valeurs dans le bloc le plus récent de chaque appareil
+    depuis = (purge or "")[:10]
+    jours = {}
+    try:
+        for device, jour in conn.execute("SELECT device, jour FROM blocs WHERE jour >= ?", (depuis,)):
+            jours.setdefault(device, set()).add(jour)
+    except sqlite3.OperationalError:
+        # Table pas encore créée (migration 8)
+        return resumes
+    for device, premier, dernier, n in conn.execute("""
+        SELECT device, MIN(premier), MAX(dernier), SUM(n) FROM blocs
+        WHERE jour >= ? GROUP BY device
+    """, (depuis,)).fetchall():
+        donnees = conn.execute("""
+            SELECT donnees FROM blocs WHERE device = ? ORDER BY jour DESC LIMIT 1
+        """, (device,)).fetchone()[0]
+        valeurs = decode_rows(donnees)[-1][1:]
+        resumes[device] = _fusionner(resumes.get(device), premier, dernier, n, valeurs, jours[device])
+    return resumes
+
+
+def rebuild(conn):
+    # Depuis les mesures brutes, base chaude et archives mensuelles
+    filtre = "device IS NOT NULL AND timestamp IS NOT NULL"
+    params = ()
+    purge = horizon(conn, "brut")
+    resumes = {}
+    if purge is not None:
+        resumes = _resumes_purges(conn, purge)
+        # Mesures d'un mois archivé à cheval sur la limite : déjà dans les agrégats
+        filtre += " AND timestamp >= ?"
+        params = (purge,)
+    resumes = _resumes_blocs(conn, purge, resumes)
+    for source in _sources(conn):
+        # Colonnes nues avec MAX() : SQLite renvoie celles de la ligne du maximum
+        bornes = source.execute(f"""
+            SELECT device, MIN(timestamp), MAX(timestamp), COUNT(*), {", ".join(VOIES)}
+            FROM mesures
+            WHERE {filtre}
+            GROUP BY device
+        """, params).fetchall()
+        jours = {}
+        for device, jour in source.execute(f"""
+            SELECT DISTINCT device, substr(timestamp, 1, 10)
+            FROM mesures
+            WHERE {filtre}
+        """, params):
+            jours.setdefault(device, set()).add(jour)
+        for device, premier, dernier, n, t, h, p in bornes:
+            ligne = resumes.get(device)
+            resumes[device] = _fusionner(ligne, premier, dernier, n, (t, h, p), jours[device])
+    conn.execute("DELETE FROM devices")
+    conn.executemany(UPSERT, [(device, *ligne) for device, ligne in resumes.items()])
+    return len(resumes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recalcule le catalogue des appareils")
+    parser.add_argument("db", nargs="?", default=DB_FILE)
+    parser.add_argument("--liste", action="store_true", help="affiche le catalogue sans le recalculer")
+    args = parser.parse_args()
+
+    conn = connect(args.db)
+    try:
+        migrate(conn, verbose=True)
+        if not args.liste:
+            t0 = time.perf_counter()
+            with conn:
+                n = rebuild(conn)
+            print(f"Catalogue recalculé en {time.perf_counter() - t0:.1f} s : {n} appareils")
+        for d in catalogue(conn):
+            print(f"{d['device']:<24} {d['first_seen']} → {d['last_seen']}"
+                  f"  {d['n']:>9} mesures  {d['jours']:>5} jours")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,31 @@
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
 from tkcalendar import Calendar
-import sqlite3
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from matplotlib.figure import Figure
 from datetime import datetime, timedelta
 import matplotlib.dates as mdates
+import numpy as np
 import sys
-import csv
 import os
+import bisect
+import queue
+import threading
+
+from data_access import VOIES, DeviceCatalogue, available_dates, load_comparison, load_day_by_device, load_events
+from day_cache import DayLoader
+from db import ConnectionPool
+from export import ExportError, export_range, format_for
+from live import POLL_MS, TailFollower
+from rendering import STYLES, ComparisonPlot
+from schema import SchemaError, check_schema
 
 DB_FILE = 'mesures_bme280.db'
 CAPTEURS = ["abricot", "pêche", "prune"]
-VOIES = ["temperature", "humidity", "pressure"]
+# Événements détectés à l'ingestion, superposés aux courbes : les trous et
+# capteurs muets sur les trois voies, les autres sur leur voie
+COULEURS_EVENEMENTS = {"trou": "gray", "muet": "orange", "plat": "gold", "hors_plage": "red", "pic": "purple"}
 
 class App(tk.Tk):
     def __init__(self):
@@ -21,9 +34,18 @@ class App(tk.Tk):
         self.geometry("1200x700")
         self.selected_device = tk.StringVar(value=CAPTEURS[0])
         self.available_dates = []
-        self.timestamps = []
+        self.pool = ConnectionPool(DB_FILE)
+        # Mode direct : journée affichée (capteurs, date, données) et suiveur de la base
+        self.shown_day = None
+        self.live = tk.BooleanVar(value=False)
+        self.follower = None
+        self.live_job = None
 
         self.create_widgets()
+        # Journées lues en arrière-plan, voisines du jour choisi préchargées
+        self.loader = DayLoader(self, self.pool, self.load_day)
+        self.catalogue = DeviceCatalogue(self.pool)
+        self.check_schema()
         self.load_data()
 
     def create_widgets(self):
@@ -35,7 +57,10 @@ class App(tk.Tk):
 
         ttk.Button(top_frame, text="Choisir une date", command=self.open_calendar).pack(side=tk.LEFT, padx=5)
         ttk.Button(top_frame, text="Aujourd'hui", command=self.select_today).pack(side=tk.LEFT, padx=5)
-        ttk.Button(top_frame, text="Export CSV", command=self.export_csv).pack(side=tk.LEFT, padx=5)
+        ttk.Button(top_frame, text="Exporter", command=self.export_data).pack(side=tk.LEFT, padx=5)
+        ttk.Button(top_frame, text="Comparer", command=lambda: ComparisonWindow(self)).pack(side=tk.LEFT, padx=5)
+        ttk.Checkbutton(top_frame, text="Direct", variable=self.live,
+                        command=self.toggle_live).pack(side=tk.LEFT, padx=5)
         ttk.Button(top_frame, text="Quitter", command=self.close_app).pack(side=tk.LEFT, padx=5)
 
         self.fig, self.axes = plt.subplots(3, 1, figsize=(10, 6), sharex=True)
@@ -43,7 +68,18 @@ class App(tk.Tk):
         self.canvas = FigureCanvasTkAgg(self.fig, master=self)
         self.canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
 
+    def check_schema(self):
+        try:
+            with self.pool.connection() as conn:
+                check_schema(conn)
+        except SchemaError as e:
+            messagebox.showwarning("Schéma de la base", str(e))
+
     def close_app(self):
+        if self.follower:
+            self.follower.close()
+        self.loader.close()
+        self.pool.close_all()
         self.quit()
         self.destroy()
         sys.exit(0)
@@ -92,16 +128,12 @@ class App(tk.Tk):
         device = self.selected_device.get()
         capteurs = [f"{device}_BME1", f"{device}_BME2"]
 
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-
-        cursor.execute("SELECT timestamp FROM mesures WHERE device IN (?, ?) ORDER BY timestamp", capteurs)
-        self.timestamps = [datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S") for row in cursor.fetchall()]
-        self.available_dates = sorted(set(dt.date() for dt in self.timestamps))
+        with self.pool.connection() as conn:
+            self.available_dates = available_dates(conn, capteurs)
 
-        if self.timestamps:
-            self.min_date = self.timestamps[0]
-            self.max_date = self.timestamps[-1]
+        if self.available_dates:
+            self.min_date = datetime.combine(self.available_dates[0], datetime.min.time())
+            self.max_date = datetime.combine(self.available_dates[-1], datetime.min.time())
             self.plot_for_date(self.min_date.date())
             self.no_data = False
         else:
@@ -113,85 +145,199 @@ class App(tk.Tk):
                 ax.set_title("Aucune donnée")
             self.canvas.draw()
 
-        conn.close()
-
     def plot_for_date(self, selected_date):
         device = self.selected_device.get()
-        capteurs = [f"{device}_BME1", f"{device}_BME2"]
-        start = datetime.combine(selected_date, datetime.min.time())
+        capteurs = (f"{device}_BME1", f"{device}_BME2")
+        self.loader.get((capteurs, selected_date),
+                        lambda valeur: self.draw_day(device, capteurs, selected_date, *valeur),
+                        erreur=lambda e: messagebox.showerror("Lecture de la base", str(e)),
+                        frais=selected_date >= datetime.now().date())
+        i = bisect.bisect_left(self.available_dates, selected_date)
+        voisins = self.available_dates[max(i - 1, 0):i] + self.available_dates[i + 1:i + 2]
+        self.loader.prefetch([(capteurs, d) for d in voisins])
+
+    def load_day(self, conn, cle):
+        # Thread de chargement
+        capteurs, jour = cle
+        start = datetime.combine(jour, datetime.min.time())
         end = start + timedelta(days=1)
+        return (load_day_by_device(conn, list(capteurs), start, end),
+                load_events(conn, list(capteurs), start, end))
 
-        conn = sqlite3.connect(DB_FILE)
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT device, timestamp, temperature, humidity, pressure
-            FROM mesures
-            WHERE device IN (?, ?) AND timestamp BETWEEN ? AND ?
-            ORDER BY timestamp
-        """, (*capteurs, start.isoformat(), end.isoformat()))
-        rows = cur.fetchall()
-        conn.close()
-
-        data = {voie: {c: [] for c in capteurs} for voie in VOIES}
-
-        for dev, ts, temp, hum, pres in rows:
-            dt = datetime.strptime(ts, "%Y-%m-%d %H:%M:%S")
-            data["temperature"][dev].append((dt, temp))
-            data["humidity"][dev].append((dt, hum))
-            data["pressure"][dev].append((dt, pres))
-
+    def draw_day(self, device, capteurs, selected_date, data, evenements=()):
+        self.shown_day = (capteurs, selected_date, data, evenements)
         for i, voie in enumerate(VOIES):
             ax = self.axes[i]
             ax.clear()
             added = False
             for capteur in capteurs:
-                points = data[voie][capteur]
-                if points:
-                    x, y = zip(*points)
-                    ax.plot(x, y, label=capteur)
+                x, valeurs = data[capteur]
+                if len(x):
+                    ax.plot(x, valeurs[voie], label=capteur)
                     added = True
             ax.set_ylabel(voie.capitalize())
             if added:
                 ax.legend()
             ax.grid(True)
 
+        self.draw_events(selected_date, evenements)
         self.axes[-1].xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
         self.axes[-1].set_xlabel("Heure")
-        self.fig.suptitle(f"{device} - {selected_date}")
+        titre = f"{device} - {selected_date}"
+        if evenements:
+            titre += f" ({len(evenements)} événement(s) : {', '.join(sorted({e[1] for e in evenements}))})"
+        self.fig.suptitle(titre)
         self.canvas.draw()
 
-    def export_csv(self):
-        def do_export(start_date, end_date):
-            conn = sqlite3.connect(DB_FILE)
-            cur = conn.cursor()
-            cur.execute("""
-                SELECT id, device, timestamp, temperature, humidity, pressure
-                FROM mesures
-                WHERE timestamp BETWEEN ? AND ?
-                ORDER BY timestamp
-            """, (start_date.isoformat(), (end_date + timedelta(days=1)).isoformat()))
-            rows = cur.fetchall()
-            conn.close()
-
-            if not rows:
-                messagebox.showinfo("Aucune donnée", "Aucune donnée dans l'intervalle spécifié.")
+    def draw_events(self, jour, evenements):
+        start = datetime.combine(jour, datetime.min.time())
+        end = start + timedelta(days=1)
+        for _, type_, voie, debut, fin, _, valeur in evenements:
+            couleur = COULEURS_EVENEMENTS[type_]
+            axes = [self.axes[VOIES.index(voie)]] if voie else self.axes
+            debut = max(datetime.fromisoformat(debut), start)
+            fin = min(datetime.fromisoformat(fin), end)
+            for ax in axes:
+                if type_ == "pic":
+                    ax.plot([debut], [valeur], marker="x", color=couleur, markersize=8, linestyle="none")
+                elif type_ == "hors_plage":
+                    # Valeur hors de l'échelle des courbes : trait vertical seulement
+                    ax.axvline(debut, color=couleur, linestyle="--", linewidth=1)
+                else:
+                    ax.axvspan(debut, fin, color=couleur, alpha=0.25, linewidth=0)
+
+    def toggle_live(self):
+        if self.live.get():
+            self.follower = TailFollower(DB_FILE)
+            self.live_job = self.after(POLL_MS, self.live_step)
+        else:
+            if self.live_job:
+                self.after_cancel(self.live_job)
+                self.live_job = None
+            if self.follower:
+                self.follower.close()
+                self.follower = None
+
+    def live_step(self):
+        device = self.selected_device.get()
+        capteurs = (f"{device}_BME1", f"{device}_BME2")
+        nouveaux = self.follower.poll_arrays(capteurs)
+        if nouveaux:
+            self.append_live(device, capteurs, nouveaux)
+        self.live_job = self.after(POLL_MS, self.live_step)
+
+    def append_live(self, device, capteurs, nouveaux):
+        jours = sorted({t.date() for times, _ in nouveaux.values() for t in times.astype(datetime)})
+        au_bout = not self.available_dates or (
+            self.shown_day is not None and self.shown_day[1] >= self.available_dates[-1])
+        for jour in jours:
+            i = bisect.bisect_left(self.available_dates, jour)
+            if i == len(self.available_dates) or self.available_dates[i] != jour:
+                self.available_dates.insert(i, jour)
+        self.min_date = datetime.combine(self.available_dates[0], datetime.min.time())
+        self.max_date = datetime.combine(self.available_dates[-1], datetime.min.time())
+        self.no_data = False
+
+        if au_bout and (self.shown_day is None or jours[-1] > self.shown_day[1]):
+            # Premier jour ou minuit passé : on suit le nouveau jour
+            self.plot_for_date(jours[-1])
+            return
+        if self.shown_day is None or self.shown_day[0] != capteurs or self.shown_day[1] not in jours:
+            return
+
+        jour, data = self.shown_day[1], dict(self.shown_day[2])
+        start = np.datetime64(datetime.combine(jour, datetime.min.time()), "s")
+        end = start + np.timedelta64(1, "D")
+        for capteur, (times, valeurs) in nouveaux.items():
+            dans_la_vue = (times >= start) & (times < end)
+            x, anciennes = data[capteur]
+            if len(x) and dans_la_vue.any() and times[dans_la_vue][0] < x[-1]:
+                # Mesures en retard au milieu de la journée : relecture complète
+                self.plot_for_date(jour)
                 return
+            data[capteur] = (np.concatenate([x, times[dans_la_vue]]),
+                             {v: np.concatenate([anciennes[v], valeurs[v][dans_la_vue]]) for v in VOIES})
+        self.draw_day(device, capteurs, jour, data, self.shown_day[3])
 
-            file_path = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=[("CSV files", "*.csv")])
+    def export_data(self):
+        def do_export(start_date, end_date):
+            file_path = filedialog.asksaveasfilename(
+                defaultextension=".csv.gz",
+                filetypes=[("CSV gzip", "*.csv.gz"), ("Parquet", "*.parquet"),
+                           ("Arrow IPC", "*.arrow"), ("CSV", "*.csv")])
             if not file_path:
                 return
+            try:
+                format_for(file_path)
+            except ExportError as e:
+                messagebox.showerror("Export", str(e))
+                return
 
-            with open(file_path, mode='w', newline='', encoding='utf-8') as f:
-                writer = csv.writer(f)
-                writer.writerow(["id", "device", "timestamp", "temperature", "humidity", "pressure"])
-                for row in rows:
-                    writer.writerow(row)
+            device = self.selected_device.get()
+            devices = None
+            if messagebox.askyesno("Export", f"Exporter uniquement {device} (BME1 et BME2) ?\n"
+                                             "Non : tous les appareils."):
+                devices = [f"{device}_BME1", f"{device}_BME2"]
 
-            self.log_action(f"Export CSV : {file_path} ({start_date} → {end_date})")
-            messagebox.showinfo("Export terminé", f"{len(rows)} lignes exportées dans :\n{file_path}")
+            start = datetime.combine(start_date, datetime.min.time())
+            end = datetime.combine(end_date + timedelta(days=1), datetime.min.time())
+            self.start_export(file_path, start, end, devices,
+                              f"Export : {file_path} ({start_date} → {end_date})")
 
         self.open_date_range_dialog(do_export)
 
+    def start_export(self, file_path, start, end, devices, log_message):
+        # L'export tourne dans un thread : le thread Tk ne fait que relever
+        # la progression dans une file via after()
+        events = queue.Queue()
+        annulation = threading.Event()
+
+        top = tk.Toplevel(self)
+        top.title("Export en cours")
+        status = tk.Label(top, text="Démarrage…", width=40)
+        status.pack(padx=10, pady=5)
+        bar = ttk.Progressbar(top, length=300, maximum=1.0)
+        bar.pack(padx=10, pady=5)
+        ttk.Button(top, text="Annuler", command=annulation.set).pack(pady=5)
+        top.protocol("WM_DELETE_WINDOW", annulation.set)
+
+        def worker():
+            try:
+                with self.pool.connection() as conn:
+                    n = export_range(conn, file_path, start, end, devices,
+                                     progress=lambda lignes, fraction: events.put(("progres", lignes, fraction)),
+                                     annulation=annulation)
+                events.put(("fini", n))
+            except Exception as e:
+                events.put(("erreur", str(e)))
+
+        def poll():
+            try:
+                while True:
+                    event = events.get_nowait()
+                    if event[0] == "progres":
+                        status.config(text=f"{event[1]} lignes exportées")
+                        bar["value"] = event[2]
+                        continue
+                    top.destroy()
+                    if event[0] == "erreur":
+                        if os.path.exists(file_path):
+                            os.remove(file_path)
+                        messagebox.showerror("Export interrompu", event[1])
+                    elif event[1] == 0:
+                        os.remove(file_path)
+                        messagebox.showinfo("Aucune donnée", "Aucune donnée dans l'intervalle spécifié.")
+                    else:
+                        self.log_action(log_message)
+                        messagebox.showinfo("Export terminé", f"{event[1]} lignes exportées dans :\n{file_path}")
+                    return
+            except queue.Empty:
+                pass
+            self.after(100, poll)
+
+        threading.Thread(target=worker, name="export", daemon=True).start()
+        self.after(100, poll)
+
     def open_date_range_dialog(self, callback):
         top = tk.Toplevel(self)
         top.title("Choisir une plage de dates")
@@ -223,6 +369,109 @@ class App(tk.Tk):
         with open(log_path, 'a', encoding='utf-8') as f:
             f.write(f"[{now}] {message}\n")
 
+# Mode comparaison : une voie de plusieurs appareils du catalogue, superposés
+# sur un seul graphique (une seule requête par journée, une seule
+# LineCollection quel que soit le nombre d'appareils). La fenêtre a son propre
+# chargeur sur le pool commun : DayLoader ne sert que la dernière demande et
+# abandonne les préchargements de la génération précédente, un chargeur
+# partagé ferait perdre ses journées à l'autre fenêtre.
+class ComparisonWindow(tk.Toplevel):
+    def __init__(self, app):
+        super().__init__(app)
+        self.app = app
+        self.loader = DayLoader(self, app.pool, self.load_day)
+        self.title("Comparaison d'appareils")
+        self.geometry("1200x650")
+        self.voie = tk.StringVar(value=VOIES[0])
+        self.devices = ()
+        self.dates = []
+        self.jour = None
+
+        gauche = tk.Frame(self)
+        gauche.pack(side=tk.LEFT, fill=tk.Y, padx=5, pady=5)
+        tk.Label(gauche, text="Appareils (Ctrl/Maj pour plusieurs) :").pack(anchor="w")
+        self.liste = tk.Listbox(gauche, selectmode=tk.EXTENDED, exportselection=False, width=28)
+        self.liste.pack(fill=tk.Y, expand=True)
+        ttk.Button(gauche, text="Actualiser la liste",
+                   command=lambda: self.fill_devices(rafraichir=True)).pack(fill=tk.X, pady=2)
+
+        haut = tk.Frame(self)
+        haut.pack(pady=5)
+        ttk.OptionMenu(haut, self.voie, VOIES[0], *VOIES).pack(side=tk.LEFT, padx=5)
+        ttk.Button(haut, text="Comparer", command=self.compare).pack(side=tk.LEFT, padx=5)
+        ttk.Button(haut, text="◀", width=3, command=lambda: self.step(-1)).pack(side=tk.LEFT, padx=5)
+        self.label_jour = tk.Label(haut, text="", width=12)
+        self.label_jour.pack(side=tk.LEFT)
+        ttk.Button(haut, text="▶", width=3, command=lambda: self.step(1)).pack(side=tk.LEFT, padx=5)
+
+        fig = Figure(figsize=(10, 6))
+        fig.subplots_adjust(right=0.78)
+        self.canvas = FigureCanvasTkAgg(fig, master=self)
+        self.canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
+        self.plot = ComparisonPlot(self.canvas, fig.add_subplot(1, 1, 1))
+
+        self.fill_devices()
+
+    def fill_devices(self, rafraichir=False):
+        choisis = {self.liste.get(i) for i in self.liste.curselection()}
+        self.liste.delete(0, tk.END)
+        for i, device in enumerate(self.app.catalogue.devices(rafraichir)):
+            self.liste.insert(tk.END, device)
+            if device in choisis:
+                self.liste.selection_set(i)
+
+    def compare(self):
+        devices = tuple(self.liste.get(i) for i in self.liste.curselection())
+        if not devices:
+            messagebox.showinfo("Comparaison", "Choisissez au moins un appareil.", parent=self)
+            return
+        with self.app.pool.connection() as conn:
+            self.dates = available_dates(conn, list(devices))
+        if not self.dates:
+            messagebox.showinfo("Comparaison", "Aucune donnée pour ces appareils.", parent=self)
+            return
+        self.devices = devices
+        jour = self.jour if self.jour in self.dates else self.dates[-1]
+        self.show(jour)
+
+    def step(self, sens):
+        if self.jour is None:
+            return
+        i = bisect.bisect_left(self.dates, self.jour) + sens
+        if 0 <= i < len(self.dates):
+            self.show(self.dates[i])
+
+    def load_day(self, conn, cle):
+        # Thread de chargement
+        devices, voie, jour = cle
+        start = datetime.combine(jour, datetime.min.time())
+        return load_comparison(conn, list(devices), voie, start, start + timedelta(days=1))
+
+    def show(self, jour):
+        self.jour = jour
+        self.label_jour.config(text=str(jour))
+        voie = self.voie.get()
+        self.loader.get((self.devices, voie, jour),
+                        lambda data: self.draw(jour, voie, data),
+                        erreur=lambda e: messagebox.showerror("Lecture de la base", str(e), parent=self),
+                        frais=jour >= datetime.now().date())
+        i = bisect.bisect_left(self.dates, jour)
+        voisins = self.dates[max(i - 1, 0):i] + self.dates[i + 1:i + 2]
+        self.loader.prefetch([(self.devices, voie, d) for d in voisins])
+
+    def draw(self, jour, voie, data):
+        if not self.winfo_exists():
+            return
+        devices, t, valeurs, bornes = data
+        start = datetime.combine(jour, datetime.min.time())
+        self.plot.update(start, start + timedelta(days=1), voie, devices, t, valeurs, bornes,
+                         f"{STYLES[voie][0]} - {len(devices)} appareils - {jour}")
+
+    def destroy(self):
+        # Fermeture de la fenêtre ou de l'application : le thread s'arrête
+        self.loader.close()
+        super().destroy()
+
 if __name__ == "__main__":
     app = App()
     app.mainloop()
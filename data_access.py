@@ -0,0 +1,159 @@
+from datetime import date
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from anomalies import list_events
+from blocks import load_arrays
+import catalogue
+from partitions import iter_range, list_devices
+from retention import horizon
+from rollups import POINTS_MIN, query_series
+from schema import format_ts
+
+# Accès aux données partagé par les afficheurs (et /api/series) : les colonnes
+# arrivent directement en tableaux NumPy, horodatages en datetime64[s] (analysés
+# en C, sans strptime ligne à ligne) et valeurs en float32 (NaN si absente).
+# matplotlib trace ces tableaux tels quels. Les jours compactés (blocks.py)
+# sont décodés un bloc par appel, sans passer par des lignes.
+
+VOIES = ("temperature", "humidity", "pressure")
+CATALOGUE_TTL_S = 300
+
+
+def rows_to_arrays(rows, nb_valeurs, dtype=np.float32):
+    # rows : (horodatage, valeur1, valeur2...) -> (t, [valeurs...])
+    if not rows:
+        return np.empty(0, dtype="datetime64[s]"), [np.empty(0, dtype=dtype) for _ in range(nb_valeurs)]
+    colonnes = list(zip(*rows))
+    t = np.array(colonnes[0], dtype="datetime64[s]")
+    # None (valeur absente) devient NaN
+    return t, [np.array(c, dtype=dtype) for c in colonnes[1:]]
+
+
+def load_columns(conn, devices, voies=VOIES, start=None, end=None, dtype=np.float32):
+    rows = list(iter_range(conn, ["timestamp", *voies], devices, start, end, blocs=False))
+    t, valeurs = rows_to_arrays(rows, len(voies), dtype)
+    blocs = load_arrays(conn, devices, voies, start, end, dtype)
+    if not blocs:
+        return t, dict(zip(voies, valeurs))
+    return _fusionner([(t, dict(zip(voies, valeurs))), *blocs.values()], voies)
+
+
+def _fusionner(morceaux, voies):
+    # Morceaux (t, {voie: valeurs}) triés chacun : concaténés puis remis dans
+    # l'ordre chronologique (tri stable, les mesures de la table d'abord)
+    morceaux = [m for m in morceaux if len(m[0])] or morceaux[:1]
+    if len(morceaux) == 1:
+        return morceaux[0]
+    t = np.concatenate([m[0] for m in morceaux])
+    ordre = np.argsort(t, kind="stable")
+    return t[ordre], {v: np.concatenate([m[1][v] for m in morceaux])[ordre] for v in voies}
+
+
+# {appareil: (t, {voie: valeurs})} en une seule requête pour tous les appareils ;
+# les jours compactés sont décodés bloc par bloc directement en tableaux
+def load_by_device(conn, devices, voies=VOIES, start=None, end=None, dtype=np.float32):
+    rows = list(iter_range(conn, ["device", "timestamp", *voies], devices, start, end, blocs=False))
+    blocs = load_arrays(conn, devices, voies, start, end, dtype)
+    if not rows:
+        vide = rows_to_arrays([], len(voies), dtype)
+        vide = (vide[0], dict(zip(voies, vide[1])))
+        return {d: blocs.get(d, vide) for d in devices}
+    noms = np.array([row[0] for row in rows], dtype=object)
+    t, valeurs = rows_to_arrays([row[1:] for row in rows], len(voies), dtype)
+    resultat = {}
+    for device in devices:
+        masque = noms == device
+        resultat[device] = (t[masque], {v: a[masque] for v, a in zip(voies, valeurs)})
+        if device in blocs:
+            resultat[device] = _fusionner([resultat[device], blocs[device]], voies)
+    return resultat
+
+
+# Comme load_by_device pour une vue jour ; si la rétention a supprimé les
+# mesures brutes de la période, moyennes des agrégats (5 min ou heure)
+def load_day_by_device(conn, devices, start, end, dtype=np.float32):
+    purge = horizon(conn, "brut")
+    if purge is None or format_ts(start) >= purge:
+        return load_by_device(conn, devices, VOIES, start, end, dtype)
+    return {device: load_series(conn, device, start, end, POINTS_MIN, dtype)[1:] for device in devices}
+
+
+# Plusieurs appareils, une voie, en une seule requête : (appareils, t,
+# valeurs, bornes), les mesures de appareils[i] étant t[bornes[i]:bornes[i + 1]]
+# par ordre chronologique (tranche vide si l'appareil n'a rien).
+def load_comparison(conn, devices, voie, start=None, end=None, dtype=np.float32):
+    if voie not in VOIES:
+        raise ValueError(f"Voie inconnue : {voie}")
+    rows = list(iter_range(conn, ["device", "timestamp", voie], devices, start, end))
+    t, (valeurs,) = rows_to_arrays([row[1:] for row in rows], 1, dtype)
+    index = {device: i for i, device in enumerate(devices)}
+    codes = np.fromiter((index[row[0]] for row in rows), dtype=np.int32, count=len(rows))
+    # Tri stable : dans chaque appareil, l'ordre chronologique de la requête est gardé
+    ordre = np.argsort(codes, kind="stable")
+    bornes = np.searchsorted(codes[ordre], np.arange(len(devices) + 1))
+    return list(devices), t[ordre], valeurs[ordre], bornes
+
+
+# Comme rollups.query_series, en tableaux : (résolution, t, {voie: valeurs})
+def load_series(conn, device, start, end, points_min, dtype=np.float32):
+    resolution, rows = query_series(conn, device, start, end, points_min)
+    t, valeurs = rows_to_arrays(rows, len(VOIES), dtype)
+    return resolution, t, dict(zip(VOIES, valeurs))
+
+
+# Jours ayant au moins une mesure, lus dans le champ de bits du catalogue
+# (une ligne par appareil). Sur une base pas encore migrée, repli sur la table
+# d'agrégats par jour, puis sur un DISTINCT date(timestamp).
+def available_dates(conn, devices):
+    try:
+        return catalogue.days_for(conn, devices)
+    except sqlite3.OperationalError:
+        pass
+    marques = ", ".join("?" * len(devices))
+    try:
+        rows = conn.execute(f"""
+            SELECT DISTINCT substr(bucket, 1, 10) FROM rollup_jour
+            WHERE device IN ({marques}) ORDER BY 1
+        """, devices).fetchall()
+    except sqlite3.OperationalError:
+        rows = conn.execute(f"""
+            SELECT DISTINCT date(timestamp) FROM mesures
+            WHERE device IN ({marques}) AND timestamp IS NOT NULL ORDER BY 1
+        """, devices).fetchall()
+    return [date.fromisoformat(row[0]) for row in rows]
+
+
+# Événements détectés (anomalies.py) qui chevauchent [start, end[ ; aucun
+# sur une base pas encore migrée
+def load_events(conn, devices, start, end):
+    try:
+        return list_events(conn, devices, start, end)
+    except sqlite3.OperationalError:
+        return []
+
+
+# Liste des appareils pour les afficheurs, lue dans le catalogue et gardée
+# ttl_s secondes. Sur une base pas encore migrée, repli sur
+# partitions.list_devices (parcours de l'index de la base et des archives).
+class DeviceCatalogue:
+    def __init__(self, pool, ttl_s=CATALOGUE_TTL_S):
+        self.pool = pool
+        self.ttl_s = ttl_s
+        self._lock = threading.Lock()
+        self._devices = None
+        self._lu = 0.0
+
+    def devices(self, rafraichir=False):
+        with self._lock:
+            if rafraichir or self._devices is None or time.monotonic() - self._lu > self.ttl_s:
+                with self.pool.connection() as conn:
+                    try:
+                        self._devices = catalogue.list_devices(conn)
+                    except sqlite3.OperationalError:
+                        self._devices = list_devices(conn)
+                self._lu = time.monotonic()
+            return list(self._devices)
@@ -0,0 +1,158 @@
+from collections import OrderedDict
+import itertools
+import queue
+import threading
+
+import numpy as np
+
+# Chargement des journées en arrière-plan pour les afficheurs.
+#
+# Un thread lit les journées demandées (et celles qu'on s'attend à voir
+# ensuite) ; le thread Tk relève les résultats toutes les POLL_MS via after()
+# et ne touche donc jamais au disque. Les journées chargées restent dans un
+# cache LRU dont la taille en mémoire est plafonnée.
+
+POLL_MS = 20
+MAX_OCTETS = 64 * 1024 * 1024
+
+PRIORITE_DEMANDE = 0
+PRIORITE_PREFETCH = 1
+
+
+def taille_de(valeur):
+    # Octets occupés par les tableaux NumPy d'une valeur (tuples, dicts imbriqués)
+    if isinstance(valeur, np.ndarray):
+        return valeur.nbytes
+    if isinstance(valeur, dict):
+        return sum(taille_de(v) for v in valeur.values())
+    if isinstance(valeur, (tuple, list)):
+        return sum(taille_de(v) for v in valeur)
+    return 64
+
+
+class DayLoader:
+    # charger(conn, cle) -> valeur, appelé dans le thread de chargement
+    def __init__(self, widget, pool, charger, max_octets=MAX_OCTETS):
+        self.widget = widget
+        self.pool = pool
+        self.charger = charger
+        self.max_octets = max_octets
+
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._octets = 0
+        self._demandes = queue.PriorityQueue()
+        self._resultats = queue.Queue()
+        self._ordre = itertools.count()
+        # Les préchargements d'une génération précédente sont abandonnés
+        self._generation = 0
+        self._attendu = None
+        self._arret = threading.Event()
+
+        self.stats = {"hits": 0, "misses": 0, "prechargees": 0, "evictions": 0}
+
+        self._thread = threading.Thread(target=self._run, name="day-loader", daemon=True)
+        self._thread.start()
+        self.widget.after(POLL_MS, self._poll)
+
+    # -- côté Tk -----------------------------------------------------------
+
+    # callback(valeur) est appelé dans le thread Tk : tout de suite si la
+    # journée est en cache, sinon dès qu'elle est chargée. Seule la dernière
+    # demande est servie ; les précédentes finissent quand même en cache.
+    def get(self, cle, callback, erreur=None, frais=False):
+        with self._lock:
+            if frais:
+                self._retirer(cle)
+            valeur = self._cache.get(cle)
+            if valeur is not None:
+                self._cache.move_to_end(cle)
+                self.stats["hits"] += 1
+        if valeur is not None:
+            self._attendu = None
+            callback(valeur)
+            return
+        self.stats["misses"] += 1
+        self._attendu = (cle, callback, erreur)
+        self._demandes.put((PRIORITE_DEMANDE, next(self._ordre), self._generation, cle))
+
+    def prefetch(self, cles):
+        self._generation += 1
+        for cle in cles:
+            with self._lock:
+                if cle in self._cache:
+                    continue
+            self._demandes.put((PRIORITE_PREFETCH, next(self._ordre), self._generation, cle))
+
+    def discard(self, cle):
+        with self._lock:
+            self._retirer(cle)
+
+    def close(self):
+        self._arret.set()
+
+    def _poll(self):
+        if self._arret.is_set():
+            return
+        while True:
+            try:
+                cle, valeur, exc = self._resultats.get_nowait()
+            except queue.Empty:
+                break
+            if self._attendu is None or self._attendu[0] != cle:
+                continue
+            _, callback, erreur = self._attendu
+            self._attendu = None
+            if exc is None:
+                callback(valeur)
+            elif erreur is not None:
+                erreur(exc)
+            else:
+                print(f"Erreur de chargement de {cle} : {exc}")
+        self.widget.after(POLL_MS, self._poll)
+
+    # -- cache -------------------------------------------------------------
+
+    def _retirer(self, cle):
+        valeur = self._cache.pop(cle, None)
+        if valeur is not None:
+            self._octets -= taille_de(valeur)
+
+    def _ranger(self, cle, valeur):
+        with self._lock:
+            self._retirer(cle)
+            self._cache[cle] = valeur
+            self._octets += taille_de(valeur)
+            while self._octets > self.max_octets and len(self._cache) > 1:
+                _, ancienne = self._cache.popitem(last=False)
+                self._octets -= taille_de(ancienne)
+                self.stats["evictions"] += 1
+
+    def info(self):
+        with self._lock:
+            return dict(self.stats, journees=len(self._cache), octets=self._octets)
+
+    # -- thread de chargement ----------------------------------------------
+
+    def _run(self):
+        while not self._arret.is_set():
+            try:
+                priorite, _, generation, cle = self._demandes.get(timeout=0.2)
+            except queue.Empty:
+                continue
+            if priorite == PRIORITE_PREFETCH and generation < self._generation:
+                continue
+            with self._lock:
+                valeur = self._cache.get(cle)
+            exc = None
+            if valeur is None:
+                try:
+                    with self.pool.connection() as conn:
+                        valeur = self.charger(conn, cle)
+                    self._ranger(cle, valeur)
+                    if priorite == PRIORITE_PREFETCH:
+                        self.stats["prechargees"] += 1
+                except Exception as e:
+                    exc = e
+            if priorite == PRIORITE_DEMANDE:
+                self._resultats.put((cle, valeur, exc))
@@ -0,0 +1,126 @@
+from contextlib import contextmanager
+import queue
+import sqlite3
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Windows : pas de verrou entre processus, l'application n'y tourne
+    # que dans un seul processus (serveur de développement, waitress)
+    fcntl = None
+
+# Fabrique de connexions SQLite réglées et pool partagé par le serveur.
+#
+# Le serveur de développement de Flask crée un thread par requête : un
+# threading.local ouvrirait donc une connexion par requête. Le pool garde
+# plutôt des connexions inactives dans une file ; chaque thread en emprunte
+# une pour la durée de sa requête et la rend ensuite.
+
+DB_FILE = "mesures_bme280.db"
+
+SYNCHRONOUS = ("OFF", "NORMAL", "FULL", "EXTRA")
+JOURNAL_MODES = ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF")
+
+# WAL : les lecteurs ne bloquent plus les écritures des ESP (et inversement).
+# synchronous=NORMAL suffit en WAL : une coupure peut perdre les dernières
+# transactions, jamais corrompre la base.
+REGLAGES_DEFAUT = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout_ms": 5000,
+    "mmap_size": 256 * 1024 * 1024,
+}
+
+
+def connect(path=DB_FILE, **reglages):
+    r = dict(REGLAGES_DEFAUT, **reglages)
+    synchronous = r["synchronous"].upper()
+    journal_mode = r["journal_mode"].upper()
+    if synchronous not in SYNCHRONOUS:
+        raise ValueError(f"synchronous invalide : {r['synchronous']}")
+    if journal_mode not in JOURNAL_MODES:
+        raise ValueError(f"journal_mode invalide : {r['journal_mode']}")
+
+    conn = sqlite3.connect(path, timeout=r["busy_timeout_ms"] / 1000, check_same_thread=False)
+    conn.execute(f"PRAGMA busy_timeout = {int(r['busy_timeout_ms'])}")
+    # Sans effet sur une base existante avant son prochain VACUUM : une base
+    # neuve naît en vacuum incrémental (place rendue par retention.py)
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute(f"PRAGMA journal_mode = {journal_mode}")
+    conn.execute(f"PRAGMA synchronous = {synchronous}")
+    conn.execute(f"PRAGMA mmap_size = {int(r['mmap_size'])}")
+    return conn
+
+
+class ConnectionPool:
+    def __init__(self, path=DB_FILE, max_idle=8, **reglages):
+        self.path = path
+        self.reglages = reglages
+        self._idle = queue.LifoQueue(maxsize=max_idle)
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return connect(self.path, **self.reglages)
+
+    def _release(self, conn):
+        # Une requête interrompue ne doit pas laisser de transaction ouverte
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+# Verrou exclusif entre processus (flock sur un fichier) et entre threads
+# d'un même processus. Sert à n'avoir qu'un rédacteur à la fois quand
+# plusieurs workers partagent la base.
+class FileLock:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._fichier = None
+
+    def acquire(self, bloquant=True):
+        if not self._lock.acquire(bloquant):
+            return False
+        if fcntl is None:
+            return True
+        if self._fichier is None:
+            self._fichier = open(self.path, "a")
+        try:
+            fcntl.flock(self._fichier, fcntl.LOCK_EX if bloquant else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock.release()
+            return False
+        return True
+
+    def release(self):
+        if self._fichier is not None:
+            fcntl.flock(self._fichier, fcntl.LOCK_UN)
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
@@ -0,0 +1,92 @@
+import argparse
+import time
+
+import anomalies
+import catalogue
+from db import DB_FILE, connect
+import rollups
+from schema import migrate
+
+# Compactage ponctuel des doublons déjà présents dans mesures (lots insérés
+# deux fois avant la déduplication à l'ingestion). Une ligne est un doublon
+# si une ligne d'id plus petit a exactement le même appareil, horodatage et
+# valeurs ; la plus ancienne est conservée.
+#
+# Chaque suppression incrémente un compteur (ingest_etat) dans la même
+# transaction : la version des données de /api/series (series.data_version)
+# en dépend, une plage close n'est donc plus servie depuis un ETag périmé.
+
+CLE_GENERATION = "doublons_generation"
+
+DOUBLONS = """
+    SELECT id FROM mesures
+    WHERE id NOT IN (
+        SELECT MIN(id) FROM mesures
+        GROUP BY device, timestamp, temperature, humidity, pressure
+    )
+"""
+
+
+def count_duplicates(conn):
+    return conn.execute(f"SELECT COUNT(*) FROM ({DOUBLONS})").fetchone()[0]
+
+
+def generation(conn):
+    row = conn.execute("SELECT valeur FROM ingest_etat WHERE cle = ?", (CLE_GENERATION,)).fetchone()
+    return row[0] if row else 0
+
+
+def compact_duplicates(conn, taille_lot=10000):
+    conn.execute(f"CREATE TEMP TABLE doublons AS {DOUBLONS}")
+    ids = [row[0] for row in conn.execute("SELECT id FROM doublons ORDER BY id")]
+    conn.execute("DROP TABLE doublons")
+    # Petites transactions : le serveur peut continuer d'écrire pendant ce temps
+    for i in range(0, len(ids), taille_lot):
+        lot = ids[i:i + taille_lot]
+        with conn:
+            conn.execute(f"DELETE FROM mesures WHERE id IN ({', '.join('?' * len(lot))})", lot)
+            conn.execute("""
+                INSERT INTO ingest_etat (cle, valeur) VALUES (?, 1)
+                ON CONFLICT (cle) DO UPDATE SET valeur = valeur + 1
+            """, (CLE_GENERATION,))
+    return len(ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Supprime les mesures en double")
+    parser.add_argument("db", nargs="?", default=DB_FILE)
+    parser.add_argument("--dry-run", action="store_true", help="compte sans supprimer")
+    parser.add_argument("--vacuum", action="store_true", help="VACUUM après suppression")
+    args = parser.parse_args()
+
+    conn = connect(args.db)
+    try:
+        migrate(conn)
+        t0 = time.perf_counter()
+        if args.dry_run:
+            print(f"{count_duplicates(conn)} doublons trouvés")
+            return
+        n = compact_duplicates(conn)
+        print(f"{n} doublons supprimés en {time.perf_counter() - t0:.1f} s")
+        if n:
+            # Agrégats, catalogue (n, jours) et détection des anomalies
+            # comptaient les doublons : recalculés ensemble
+            with conn:
+                rollups.backfill(conn)
+                catalogue.rebuild(conn)
+                try:
+                    anomalies.backfill(conn)
+                    detail = ", catalogue et anomalies"
+                except ImportError:
+                    # Sans NumPy : python anomalies.py recalculera l'historique
+                    detail = " et catalogue (anomalies : NumPy absent)"
+            print(f"Agrégats{detail} recalculés")
+        if args.vacuum and n:
+            conn.execute("VACUUM")
+            print("VACUUM terminé")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+import argparse
+import csv
+from datetime import datetime, timedelta
+import gzip
+from itertools import islice
+import time
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pa = None
+
+from db import DB_FILE, connect
+from partitions import iter_range
+from schema import parse_ts
+
+# Export en flux d'une plage de mesures : les lignes sont lues par blocs
+# (curseurs des partitions, jamais de fetchall) et écrites au fil de l'eau.
+# Formats : Parquet et Arrow IPC (pyarrow) en colonnes, CSV gzip ou CSV brut.
+
+COLONNES = ["id", "device", "timestamp", "temperature", "humidity", "pressure"]
+TAILLE_BLOC = 50000
+
+FORMATS = {
+    ".parquet": "parquet",
+    ".arrow": "arrow",
+    ".feather": "arrow",
+    ".csv.gz": "csv.gz",
+    ".csv": "csv",
+}
+
+
+class ExportError(RuntimeError):
+    pass
+
+
+def format_for(path):
+    for extension, fmt in FORMATS.items():
+        if path.lower().endswith(extension):
+            return fmt
+    raise ExportError(f"Format d'export inconnu : {path}")
+
+
+def _schema_arrow():
+    return pa.schema([
+        ("id", pa.int64()),
+        ("device", pa.string()),
+        ("timestamp", pa.timestamp("s")),
+        ("temperature", pa.float64()),
+        ("humidity", pa.float64()),
+        ("pressure", pa.float64()),
+    ])
+
+
+class _EcrivainCSV:
+    def __init__(self, path, compresse):
+        if compresse:
+            self.f = gzip.open(path, "wt", newline="", encoding="utf-8")
+        else:
+            self.f = open(path, "w", newline="", encoding="utf-8")
+        self.writer = csv.writer(self.f)
+        self.writer.writerow(COLONNES)
+
+    def write(self, bloc):
+        self.writer.writerows(bloc)
+
+    def close(self):
+        self.f.close()
+
+
+class _EcrivainArrow:
+    def __init__(self, path, fmt):
+        self.schema = _schema_arrow()
+        if fmt == "parquet":
+            self.writer = pa.parquet.ParquetWriter(path, self.schema, compression="zstd")
+        else:
+            self.writer = pa.ipc.new_file(path, self.schema)
+
+    def write(self, bloc):
+        colonnes = list(zip(*bloc))
+        colonnes[2] = [parse_ts(ts) for ts in colonnes[2]]
+        batch = pa.record_batch([pa.array(c, type=f.type) for c, f in zip(colonnes, self.schema)],
+                                schema=self.schema)
+        if isinstance(self.writer, pa.parquet.ParquetWriter):
+            self.writer.write_table(pa.Table.from_batches([batch]))
+        else:
+            self.writer.write_batch(batch)
+
+    def close(self):
+        self.writer.close()
+
+
+def _ecrivain(path, fmt):
+    if fmt in ("parquet", "arrow"):
+        if pa is None:
+            raise ExportError("pyarrow n'est pas installé : exporter en .csv.gz")
+        return _EcrivainArrow(path, fmt)
+    return _EcrivainCSV(path, compresse=(fmt == "csv.gz"))
+
+
+# Exporte [start, end[ (tous les appareils si devices est None) vers path.
+# progress(lignes, fraction) est appelé après chaque bloc ; fraction est
+# estimée d'après l'horodatage atteint. annulation : threading.Event optionnel.
+def export_range(conn, path, start, end, devices=None, progress=None, annulation=None,
+                 taille_bloc=TAILLE_BLOC):
+    fmt = format_for(path)
+    ecrivain = _ecrivain(path, fmt)
+    lignes = 0
+    duree = (end - start).total_seconds() or 1
+    try:
+        rows = iter_range(conn, COLONNES, devices, start, end)
+        while True:
+            if annulation is not None and annulation.is_set():
+                raise ExportError("Export annulé")
+            bloc = list(islice(rows, taille_bloc))
+            if not bloc:
+                break
+            ecrivain.write(bloc)
+            lignes += len(bloc)
+            if progress is not None:
+                atteint = (parse_ts(bloc[-1][2]) - start).total_seconds()
+                progress(lignes, min(atteint / duree, 1.0))
+    finally:
+        ecrivain.close()
+    return lignes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export d'une plage de mesures")
+    parser.add_argument("sortie", help="fichier .parquet, .arrow, .csv.gz ou .csv")
+    parser.add_argument("--debut", required=True, help="YYYY-MM-DD")
+    parser.add_argument("--fin", required=True, help="YYYY-MM-DD (inclus)")
+    parser.add_argument("--device", action="append", help="appareil à exporter (répétable)")
+    parser.add_argument("--db", default=DB_FILE)
+    args = parser.parse_args()
+
+    start = datetime.strptime(args.debut, "%Y-%m-%d")
+    end = datetime.strptime(args.fin, "%Y-%m-%d") + timedelta(days=1)
+
+    def afficher(lignes, fraction):
+        print(f"\r{lignes} lignes ({fraction:.0%})", end="", flush=True)
+
+    conn = connect(args.db)
+    try:
+        t0 = time.perf_counter()
+        n = export_range(conn, args.sortie, start, end, args.device, progress=afficher)
+        print(f"\n{n} lignes exportées dans {args.sortie} en {time.perf_counter() - t0:.1f} s")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
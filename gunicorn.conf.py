@@ -0,0 +1,18 @@
+import os
+
+# gunicorn -c gunicorn.conf.py wsgi:app
+#
+# Workers à threads (gthread) : les flux /stream et /api/poll gardent leur
+# connexion ouverte, il faut de quoi servir les ESP pendant ce temps.
+# Pas de preload_app : chaque worker ouvre ses propres connexions SQLite et
+# lance ses propres threads (file d'ingestion, relais), voir wsgi.py.
+
+bind = os.environ.get("LOGGER_BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("LOGGER_WORKERS", 4))
+worker_class = "gthread"
+threads = int(os.environ.get("LOGGER_THREADS", 32))
+preload_app = False
+# Les flux SSE envoient un commentaire toutes les HEARTBEAT_S (15 s)
+timeout = 60
+graceful_timeout = 30
+accesslog = None
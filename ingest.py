@@ -0,0 +1,160 @@
+from datetime import datetime
+import hashlib
+import math
+import re
+import time
+
+from anomalies import update_events
+from catalogue import update_catalogue
+from partitions import note_late_rows
+from rollups import update_rollups
+from schema import FORMAT_TIMESTAMP
+
+# Moteur d'insertion en masse pour /receive_batch : le lot est validé en une
+# seule passe, puis inséré avec un unique executemany dans une transaction.
+
+INSERT_MESURE = """
+    INSERT INTO mesures (device, temperature, humidity, pressure, timestamp)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+UPSERT_WATERMARK = """
+    INSERT INTO device_watermark (device, max_timestamp) VALUES (?, ?)
+    ON CONFLICT (device) DO UPDATE SET max_timestamp = max(max_timestamp, excluded.max_timestamp)
+"""
+
+TIMESTAMP_RE = re.compile(r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}")
+VOIES = ("temperature", "humidity", "pressure")
+
+
+class BatchError(ValueError):
+    pass
+
+
+def batch_id_for(body, header=None):
+    # Un ESP qui renvoie un lot après un délai dépassé renvoie exactement le
+    # même corps : son empreinte sert d'identifiant si le client n'en fournit pas
+    if header:
+        return header
+    return "sha1:" + hashlib.sha1(body).hexdigest()
+
+
+def _valeur(entry, voie, index):
+    v = entry.get(voie)
+    if v is None:
+        return None
+    # bool est un int en Python, mais ce n'est pas une mesure
+    if isinstance(v, bool) or not isinstance(v, (int, float)):
+        raise BatchError(f"Entrée {index} : '{voie}' n'est pas un nombre")
+    v = float(v)
+    # l'ESP sérialise NaN en null, mais on reste prudent
+    if math.isnan(v) or math.isinf(v):
+        return None
+    return v
+
+
+def validate_batch(data):
+    if not isinstance(data, list) or not data:
+        raise BatchError("Aucune donnée reçue ou format incorrect")
+
+    maintenant = None
+    rows = []
+    for index, entry in enumerate(data):
+        if not isinstance(entry, dict):
+            raise BatchError(f"Entrée {index} : objet JSON attendu")
+
+        device = entry.get("device")
+        if not isinstance(device, str) or not device:
+            raise BatchError(f"Entrée {index} : 'device' manquant")
+
+        ts = entry.get("timestamp")
+        if ts is None:
+            # même comportement que DEFAULT CURRENT_TIMESTAMP, mais une seule
+            # horloge pour tout le lot
+            if maintenant is None:
+                maintenant = datetime.now().strftime(FORMAT_TIMESTAMP)
+            ts = maintenant
+        elif not isinstance(ts, str) or not TIMESTAMP_RE.fullmatch(ts):
+            raise BatchError(f"Entrée {index} : horodatage invalide ({ts!r})")
+
+        rows.append((
+            device,
+            _valeur(entry, "temperature", index),
+            _valeur(entry, "humidity", index),
+            _valeur(entry, "pressure", index),
+            ts
+        ))
+    return rows
+
+
+def _filtrer_watermark(conn, rows):
+    devices = list({r[0] for r in rows})
+    marques = dict(conn.execute(f"""
+        SELECT device, max_timestamp FROM device_watermark
+        WHERE device IN ({", ".join("?" * len(devices))})
+    """, devices))
+    if not marques:
+        return rows
+    # Horodatage égal au filigrane conservé : le firmware date toutes les
+    # mesures d'un envoi de l'heure d'envoi. Les renvois à l'identique sont
+    # écartés par l'identifiant de lot.
+    return [r for r in rows if r[4] >= marques.get(r[0], "")]
+
+
+def _avancer_watermark(conn, rows):
+    maxima = {}
+    for device, _, _, _, ts in rows:
+        if ts > maxima.get(device, ""):
+            maxima[device] = ts
+    conn.executemany(UPSERT_WATERMARK, maxima.items())
+
+
+# Tout ce qui doit se faire dans la transaction d'insertion passe par ici :
+# appelé aussi bien par insert_batch que par le rédacteur de la file.
+# Renvoie les lignes réellement insérées. filigrane=False garde les lignes
+# plus anciennes que le filigrane (rejeu d'un lot mis en quarantaine, que les
+# lots suivants de l'appareil ont dépassé).
+def write_rows(conn, rows, batch_id=None, filigrane=True):
+    if batch_id is not None:
+        cur = conn.execute("INSERT OR IGNORE INTO lots_recus (batch_id, recu_le) VALUES (?, ?)",
+                           (batch_id, datetime.now().strftime(FORMAT_TIMESTAMP)))
+        if cur.rowcount == 0:
+            return []
+    if filigrane:
+        rows = _filtrer_watermark(conn, rows)
+    if rows:
+        conn.executemany(INSERT_MESURE, rows)
+        _avancer_watermark(conn, rows)
+        update_rollups(conn, rows)
+        update_catalogue(conn, rows)
+        update_events(conn, rows)
+        note_late_rows(conn, rows)
+    return rows
+
+
+def insert_batch(conn, rows, batch_id=None):
+    t0 = time.perf_counter()
+    try:
+        inserees = write_rows(conn, rows, batch_id)
+        t1 = time.perf_counter()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    t2 = time.perf_counter()
+    return {
+        "lignes_inserees": len(inserees),
+        "execute_ms": round((t1 - t0) * 1000, 3),
+        "commit_ms": round((t2 - t1) * 1000, 3),
+    }
+
+
+def ingest_batch(conn, data, batch_id=None):
+    t0 = time.perf_counter()
+    rows = validate_batch(data)
+    t1 = time.perf_counter()
+    stats = insert_batch(conn, rows, batch_id)
+    stats["lignes"] = len(rows)
+    stats["validation_ms"] = round((t1 - t0) * 1000, 3)
+    stats["total_ms"] = round((time.perf_counter() - t0) * 1000, 3)
+    return stats
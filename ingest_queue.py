@@ -0,0 +1,427 @@
+import argparse
+import atexit
+from contextlib import nullcontext
+import json
+import math
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from db import DB_FILE, FileLock, connect
+from ingest import write_rows
+from metrics import ECRITURE_ATTENTE, ECRITURE_COMMIT, ECRITURE_EXECUTE, GROUPE_LIGNES
+from schema import migrate
+
+# File d'ingestion asynchrone derrière /receive_batch.
+#
+# Le thread HTTP valide le lot, l'ajoute au journal (spool) sur disque puis à
+# une file bornée, et répond aussitôt : l'ESP peut couper sa radio. Un unique
+# thread rédacteur vide la file et valide les lots de plusieurs ESP dans une
+# seule transaction (group commit). Le numéro du dernier lot du journal
+# intégré en base est écrit dans cette même transaction ; au redémarrage, les
+# lots du journal postérieurs à ce numéro sont rejoués.
+#
+# Sous plusieurs workers (wsgi.py), chaque processus a sa propre file et un
+# verrou de fichier commun garantit qu'un seul groupe est écrit à la fois.
+# L'ESP n'y est acquitté qu'une fois son lot en base (attendre_commit) :
+# sinon son lot suivant, reçu par un autre worker, pourrait être validé avant
+# et le filigrane de l'appareil écarterait le premier. Le journal n'a alors
+# plus d'utilité : un lot non acquitté est renvoyé par l'ESP.
+#
+# Un groupe en erreur est retenté MAX_ESSAIS fois, à intervalles croissants.
+# Au-delà, ses lots sont écrits un par un. Seul un lot dont l'erreur se
+# reproduira à l'identique (ERREURS_DEFINITIVES, ex. ligne invalide passée au
+# travers de la validation) est mis en quarantaine : ajouté au fichier des
+# rejets (<journal>.rejets, une ligne JSON par lot), puis sauté. Les lots
+# suivants ne restent pas bloqués derrière, et un client qui attend son
+# commit reçoit une erreur. Une base verrouillée ou un disque plein
+# (OperationalError, OSError) ne rejette rien : le lot reste en tête de file
+# et est retenté après une pause.
+#
+# Un lot corrigé (ou dont la cause est réglée) est rejoué depuis les rejets :
+#
+#   python ingest_queue.py mesures_bme280.db.rejets [--seq N]
+
+CLE_SPOOL = "spool_seq"
+ATTENTE_COMMIT_S = 30
+MAX_ESSAIS = 5
+PAUSE_MAX_S = 8
+ERREURS_DEFINITIVES = (ValueError, TypeError, LookupError, sqlite3.IntegrityError,
+                       sqlite3.InterfaceError, sqlite3.ProgrammingError)
+
+
+class QueueFull(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"File d'ingestion pleine, réessayer dans {retry_after} s")
+        self.retry_after = retry_after
+
+
+class BatchQuarantined(Exception):
+    pass
+
+
+class IngestQueue:
+    def __init__(self, pool, spool_path=None, maxsize=256, max_lignes_groupe=50000,
+                 attente_groupe_s=0.0, fsync=True, verrou=None, attendre_commit=False,
+                 rejets_path=None):
+        self.pool = pool
+        self.spool_path = spool_path
+        self.rejets_path = rejets_path or (spool_path or pool.path) + ".rejets"
+        self.verrou = verrou
+        self.attendre_commit = attendre_commit
+        self.max_lignes_groupe = max_lignes_groupe
+        self.attente_groupe_s = attente_groupe_s
+        self.fsync = fsync
+
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._arret = threading.Event()
+        self._spool = None
+        self._seq = 0
+        self._seq_valide = 0
+        self._valide = threading.Condition()
+        self._lignes_en_file = 0
+        self._groupe_en_cours = []
+        self._essais = 0
+        # Lots mis en quarantaine qu'un client attend encore (attendre_commit)
+        self._rejetes = set()
+        # Moyenne glissante du temps d'écriture d'une ligne, pour Retry-After
+        self._s_par_ligne = 0.0
+        self._abonnes = []
+
+        self.stats = {"lots_recus": 0, "lots_refuses": 0, "groupes": 0,
+                      "lignes": 0, "lignes_ignorees": 0, "erreurs": 0, "lots_quarantaine": 0}
+
+    # -- côté requêtes HTTP ------------------------------------------------
+
+    def submit(self, rows, batch_id=None):
+        self.start()
+        with self._lock:
+            # Seuls les producteurs remplissent la file, sous ce verrou :
+            # si elle n'est pas pleine ici, put_nowait ne peut pas échouer.
+            if self._queue.full():
+                self.stats["lots_refuses"] += 1
+                raise QueueFull(self.retry_after())
+            self._seq += 1
+            seq = self._seq
+            self._journaliser(seq, rows, batch_id)
+            self._queue.put_nowait((seq, rows, batch_id))
+            self._lignes_en_file += len(rows)
+            self.stats["lots_recus"] += 1
+        if self.attendre_commit:
+            self.wait(seq)
+            with self._valide:
+                if seq in self._rejetes:
+                    self._rejetes.discard(seq)
+                    raise BatchQuarantined(f"Lot {seq} non écrit, mis en quarantaine dans {self.rejets_path}")
+        return seq
+
+    # Attend que le lot seq soit en base. Au-delà du délai, il reste en file
+    # et sera écrit : l'appelant peut quand même l'acquitter.
+    def wait(self, seq, timeout=ATTENTE_COMMIT_S):
+        with self._valide:
+            return self._valide.wait_for(lambda: self._seq_valide >= seq, timeout)
+
+    def retry_after(self):
+        return max(1, math.ceil(self._lignes_en_file * self._s_par_ligne))
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def is_full(self):
+        return self._queue.full()
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    # callback(lignes) est appelé par le rédacteur après chaque commit, avec
+    # les lignes réellement insérées (caches, diffusion aux clients...)
+    def on_commit(self, callback):
+        self._abonnes.append(callback)
+
+    # -- cycle de vie ------------------------------------------------------
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            if self.spool_path:
+                self._seq_valide = self._lire_seq_valide()
+                self._seq = self._seq_valide
+                for seq, rows, batch_id in self._relire_spool():
+                    # Rejoué sans limite de taille : ces lots étaient déjà acceptés
+                    self._queue.queue.append((seq, rows, batch_id))
+                    self._lignes_en_file += len(rows)
+                    self._seq = seq
+                self._spool = open(self.spool_path, "a", encoding="utf-8")
+            self._arret.clear()
+            self._thread = threading.Thread(target=self._run, name="ingest-writer", daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self, timeout=30):
+        if self._thread is None:
+            return True
+        self._arret.set()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            print("Arrêt de la file d'ingestion : le rédacteur ne répond pas")
+            return False
+        self._thread = None
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+        vide = not self._groupe_en_cours and self._queue.empty()
+        if not vide:
+            print("Arrêt de la file d'ingestion : lots restants conservés dans le journal")
+        return vide
+
+    # -- journal -----------------------------------------------------------
+
+    def _journaliser(self, seq, rows, batch_id):
+        if self._spool is None:
+            return
+        self._spool.write(json.dumps({"seq": seq, "batch_id": batch_id, "rows": rows}) + "\n")
+        self._spool.flush()
+        if self.fsync:
+            os.fsync(self._spool.fileno())
+
+    def _relire_spool(self):
+        if not os.path.exists(self.spool_path):
+            return
+        with open(self.spool_path, encoding="utf-8") as f:
+            for ligne in f:
+                try:
+                    lot = json.loads(ligne)
+                except ValueError:
+                    # Dernière ligne tronquée par un arrêt brutal : jamais acquittée
+                    break
+                if lot["seq"] > self._seq_valide:
+                    yield lot["seq"], [tuple(r) for r in lot["rows"]], lot.get("batch_id")
+
+    def _purger_spool(self):
+        # Tout ce qui a été journalisé est en base : le journal peut repartir de zéro
+        with self._lock:
+            if self._spool is not None and self._seq_valide == self._seq and self._queue.empty():
+                self._spool.truncate(0)
+                self._spool.seek(0)
+
+    def _lire_seq_valide(self):
+        with self.pool.connection() as conn:
+            row = conn.execute("SELECT valeur FROM ingest_etat WHERE cle = ?", (CLE_SPOOL,)).fetchone()
+        return row[0] if row else 0
+
+    # -- rédacteur ---------------------------------------------------------
+
+    def _prochain_groupe(self):
+        try:
+            groupe = [self._queue.get(timeout=0.2)]
+        except queue.Empty:
+            return []
+        lignes = len(groupe[0][1])
+        limite = time.monotonic() + self.attente_groupe_s
+        while lignes < self.max_lignes_groupe:
+            try:
+                reste = limite - time.monotonic()
+                lot = self._queue.get(timeout=reste) if reste > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            groupe.append(lot)
+            lignes += len(lot[1])
+        with self._lock:
+            self._lignes_en_file -= lignes
+        return groupe
+
+    def _ecrire_groupe(self, groupe):
+        dernier = groupe[-1][0]
+        recues = sum(len(rows) for _, rows, _ in groupe)
+        inserees = []
+        t0 = time.perf_counter()
+        with self.verrou or nullcontext(), self.pool.connection() as conn:
+            t1 = time.perf_counter()
+            try:
+                # Un lot après l'autre (déduplication), mais une seule transaction
+                for _, rows, batch_id in groupe:
+                    inserees.extend(write_rows(conn, rows, batch_id))
+                if self.spool_path:
+                    conn.execute("INSERT OR REPLACE INTO ingest_etat (cle, valeur) VALUES (?, ?)",
+                                 (CLE_SPOOL, dernier))
+                t2 = time.perf_counter()
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            t3 = time.perf_counter()
+        duree = t3 - t0
+        ECRITURE_ATTENTE.observe(t1 - t0)
+        ECRITURE_EXECUTE.observe(t2 - t1)
+        ECRITURE_COMMIT.observe(t3 - t2)
+        GROUPE_LIGNES.observe(recues)
+        self._s_par_ligne = 0.8 * self._s_par_ligne + 0.2 * duree / max(recues, 1)
+        with self._valide:
+            self._seq_valide = dernier
+            self._valide.notify_all()
+        self.stats["groupes"] += 1
+        self.stats["lignes"] += len(inserees)
+        self.stats["lignes_ignorees"] += recues - len(inserees)
+        if inserees:
+            self._notifier(inserees)
+
+    # Avec journal, les numéros ne repartent jamais en arrière (repris de
+    # ingest_etat au démarrage) : un lot déjà dans les rejets, dont le numéro
+    # n'a pas pu être avancé ensuite, n'y est pas ajouté une seconde fois
+    def _deja_rejete(self, seq):
+        if not self.spool_path or not os.path.exists(self.rejets_path):
+            return False
+        with open(self.rejets_path, encoding="utf-8") as f:
+            for ligne in f:
+                try:
+                    if json.loads(ligne)["seq"] == seq:
+                        return True
+                except ValueError:
+                    continue
+        return False
+
+    # Lot qui échoue seul : gardé dans le fichier des rejets, puis sauté
+    def _mettre_en_quarantaine(self, lot, erreur):
+        seq, rows, batch_id = lot
+        # Sous le verrou d'écriture : le rejeu (main) réécrit ce fichier
+        with self.verrou or nullcontext():
+            # Rejet écrit avant d'avancer le numéro du journal : rien ne se perd
+            if not self._deja_rejete(seq):
+                with open(self.rejets_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({"seq": seq, "batch_id": batch_id, "erreur": str(erreur),
+                                        "rows": rows}) + "\n")
+                    f.flush()
+                    if self.fsync:
+                        os.fsync(f.fileno())
+            if self.spool_path:
+                with self.pool.connection() as conn:
+                    with conn:
+                        conn.execute("INSERT OR REPLACE INTO ingest_etat (cle, valeur) VALUES (?, ?)",
+                                     (CLE_SPOOL, seq))
+        with self._valide:
+            if self.attendre_commit:
+                self._rejetes.add(seq)
+            self._seq_valide = seq
+            self._valide.notify_all()
+        self.stats["lots_quarantaine"] += 1
+        print(f"Lot {seq} ({len(rows)} lignes) mis en quarantaine dans {self.rejets_path} : {erreur}")
+
+    def _isoler(self):
+        # Lot par lot : les lots écrits ou écartés quittent le groupe. Toute
+        # autre erreur (base verrouillée, disque plein) remonte à _run, qui
+        # fait une pause et reprend là où elle s'est arrêtée
+        while self._groupe_en_cours:
+            lot = self._groupe_en_cours[0]
+            try:
+                self._ecrire_groupe([lot])
+            except ERREURS_DEFINITIVES as e:
+                self._mettre_en_quarantaine(lot, e)
+            self._groupe_en_cours.pop(0)
+
+    def _notifier(self, rows):
+        for callback in self._abonnes:
+            try:
+                callback(rows)
+            except Exception as e:
+                # Déjà en base : un abonné en erreur ne doit pas faire rejouer le groupe
+                print(f"Erreur d'un abonné de la file d'ingestion : {e}")
+
+    def _run(self):
+        while True:
+            if not self._groupe_en_cours:
+                self._groupe_en_cours = self._prochain_groupe()
+            groupe = self._groupe_en_cours
+            if not groupe:
+                if self._arret.is_set():
+                    return
+                continue
+            try:
+                if self._essais < MAX_ESSAIS:
+                    self._ecrire_groupe(groupe)
+                else:
+                    self._isoler()
+            except Exception as e:
+                # Le groupe est conservé et retenté : rien n'est perdu
+                self.stats["erreurs"] += 1
+                self._essais += 1
+                print(f"Erreur dans la file d'ingestion (essai {self._essais}/{MAX_ESSAIS}) : {e}")
+                if self._arret.wait(min(2 ** (self._essais - 1), PAUSE_MAX_S)):
+                    # Arrêt demandé : le journal rejouera ce groupe au prochain démarrage
+                    return
+                continue
+            self._groupe_en_cours = []
+            self._essais = 0
+            if self._queue.empty():
+                self._purger_spool()
+
+
+def _lire_rejets(chemin):
+    with open(chemin, encoding="utf-8") as f:
+        return [json.loads(ligne) for ligne in f if ligne.strip()]
+
+
+# Rejoue les lots du fichier des rejets (tous, ou ceux de --seq) : chacun est
+# écrit par write_rows dans sa propre transaction, comme par le rédacteur, et
+# retiré du fichier s'il passe. Sous le verrou d'écriture des workers
+# (wsgi.py) ; avec le serveur de développement, l'arrêter avant. Les caches
+# d'un serveur de développement ne voient pas les lignes rejouées, ceux des
+# workers si (live.TailFollower).
+def main():
+    parser = argparse.ArgumentParser(description="Rejoue les lots mis en quarantaine par la file d'ingestion")
+    parser.add_argument("rejets", help="fichier des rejets (<journal>.rejets)")
+    parser.add_argument("--db", default=DB_FILE)
+    parser.add_argument("--seq", type=int, action="append", help="numéro du lot à rejouer (répétable)")
+    parser.add_argument("--dry-run", action="store_true", help="liste les lots sans rien écrire")
+    args = parser.parse_args()
+
+    conn = connect(args.db)
+    try:
+        migrate(conn, verbose=True)
+        with FileLock(args.db + ".ecriture.lock"):
+            lots = _lire_rejets(args.rejets)
+            restants = []
+            for lot in lots:
+                if args.seq and lot["seq"] not in args.seq:
+                    restants.append(lot)
+                    continue
+                rows = [tuple(r) for r in lot["rows"]]
+                if args.dry_run:
+                    print(f"Lot {lot['seq']} ({len(rows)} lignes, {lot['batch_id']}) : {lot['erreur']}")
+                    restants.append(lot)
+                    continue
+                try:
+                    with conn:
+                        # Les lots suivants de l'appareil ont avancé son
+                        # filigrane : celui-ci serait écarté en entier
+                        inserees = write_rows(conn, rows, lot["batch_id"], filigrane=False)
+                except Exception as e:
+                    print(f"Lot {lot['seq']} toujours en échec : {e}")
+                    restants.append(lot)
+                    continue
+                print(f"Lot {lot['seq']} rejoué : {len(inserees)}/{len(rows)} lignes insérées")
+            if len(restants) == len(lots):
+                return
+            # Réécriture atomique : un arrêt en cours de route garde l'ancien
+            # fichier ; un lot déjà rejoué y est alors écarté par son
+            # identifiant (lots_recus) s'il en a un
+            temporaire = args.rejets + ".tmp"
+            with open(temporaire, "w", encoding="utf-8") as f:
+                for lot in restants:
+                    f.write(json.dumps(lot) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporaire, args.rejets)
+            print(f"{len(lots) - len(restants)} lot(s) rejoué(s), {len(restants)} restant(s) dans {args.rejets}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
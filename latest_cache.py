@@ -0,0 +1,156 @@
+from collections import deque
+import threading
+import time
+
+from partitions import latest_rows
+
+# Cache en mémoire des dernières mesures de chaque appareil, pour /data et
+# /latest : un tampon circulaire (deque bornée) par appareil, rempli depuis la
+# base au premier usage puis alimenté par le rédacteur de la file d'ingestion
+# après chaque commit. Les lectures ne touchent plus SQLite. Le remplissage
+# lit aussi les archives mensuelles et les blocs (partitions.latest_rows) :
+# un appareil muet depuis un mois archivé garde ses dernières mesures.
+#
+# La mémoire est bornée : au plus max_devices tampons de taille lignes. Un
+# appareil muet depuis inactivite_s (ou le moins récent quand la limite est
+# atteinte) est évincé ; ses lignes sont alors relues en base à la demande
+# (compté comme un défaut de cache) sans le réintégrer. Un appareil nouveau,
+# ou évincé qui émet de nouveau, retrouve son tampon au commit suivant,
+# rempli depuis la base et non des seules lignes de ce commit.
+
+TAILLE = 24
+MAX_DEVICES = 1000
+INACTIVITE_S = 7 * 24 * 3600
+
+
+class LatestCache:
+    def __init__(self, pool, taille=TAILLE, max_devices=MAX_DEVICES, inactivite_s=INACTIVITE_S):
+        self.pool = pool
+        self.taille = taille
+        self.max_devices = max_devices
+        self.inactivite_s = inactivite_s
+
+        self._lock = threading.Lock()
+        self._tampons = {}
+        self._activite = {}
+        self._evinces = set()
+        # Appareil -> plus grand id de mesures lors du remplissage de son
+        # tampon : les lignes relayées d'id inférieur y sont déjà
+        self._lu_jusqua = {}
+        self._pret = False
+
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    # -- remplissage -------------------------------------------------------
+
+    def warm(self):
+        with self.pool.connection() as conn:
+            appareils = latest_rows(conn, self.taille)
+        maintenant = time.monotonic()
+        with self._lock:
+            self._tampons = {device: deque(rows, maxlen=self.taille) for device, rows in appareils}
+            self._activite = dict.fromkeys(self._tampons, maintenant)
+            self._evinces.clear()
+            self._lu_jusqua.clear()
+            self._pret = True
+            self._evincer(maintenant)
+
+    def _assurer(self):
+        if not self._pret:
+            self.warm()
+            return True
+        return False
+
+    # Dernières lignes en base de ces appareils, lues dans un même instantané
+    # que le plus grand id : toute ligne d'id inférieur y figure
+    def _lire(self, devices):
+        with self.pool.connection() as conn:
+            conn.execute("BEGIN")
+            try:
+                max_id = conn.execute("SELECT IFNULL(MAX(id), 0) FROM mesures").fetchone()[0]
+                lignes = {device: latest_rows(conn, self.taille, device) for device in devices}
+            finally:
+                conn.rollback()
+        return max_id, lignes
+
+    # Abonné de IngestQueue : lignes insérées, après le commit. ids : leurs
+    # id dans mesures, quand elles sont relayées depuis la base (wsgi.py)
+    def append(self, rows, ids=None):
+        if self._assurer():
+            # Le remplissage vient de relire la base, ces lignes comprises
+            return
+        with self._lock:
+            absents = {row[0] for row in rows} - self._tampons.keys()
+        if absents:
+            # Hors verrou : les lectures continuent pendant la requête
+            max_id, lus = self._lire(absents)
+        maintenant = time.monotonic()
+        # Tri stable : à horodatage égal, l'ordre d'insertion (id) est gardé
+        lignes = sorted(zip(rows, ids or [None] * len(rows)), key=lambda ligne: ligne[0][4])
+        with self._lock:
+            for device in absents:
+                self._tampons[device] = deque(lus[device], maxlen=self.taille)
+                self._evinces.discard(device)
+                self._lu_jusqua[device] = max_id
+                self._activite[device] = maintenant
+            for row, id_ in lignes:
+                device = row[0]
+                if id_ is None:
+                    # File d'ingestion : le commit précède cet appel, la
+                    # lecture ci-dessus contient déjà les lignes des absents
+                    if device in absents:
+                        continue
+                elif id_ <= self._lu_jusqua.get(device, 0):
+                    # Relais : la base lue au remplissage pouvait être en avance
+                    continue
+                self._tampons[device].append(row)
+                self._activite[device] = maintenant
+            self._evincer(maintenant)
+
+    def _evincer(self, maintenant):
+        limite = maintenant - self.inactivite_s
+        inactifs = [d for d, t in self._activite.items() if t < limite]
+        surplus = len(self._activite) - len(inactifs) - self.max_devices
+        if surplus > 0:
+            actifs = sorted((t, d) for d, t in self._activite.items() if t >= limite)
+            inactifs.extend(d for _, d in actifs[:surplus])
+        for device in inactifs:
+            del self._tampons[device]
+            del self._activite[device]
+            self._lu_jusqua.pop(device, None)
+            self._evinces.add(device)
+        self.stats["evictions"] += len(inactifs)
+
+    # -- lecture -----------------------------------------------------------
+
+    # n dernières mesures de l'appareil, au format de queries.latest_per_device
+    def latest(self, device, n=None):
+        n = min(n or self.taille, self.taille)
+        self._assurer()
+        with self._lock:
+            tampon = self._tampons.get(device)
+            if tampon is not None:
+                self.stats["hits"] += 1
+                return list(tampon)[-n:]
+            self.stats["misses"] += 1
+        with self.pool.connection() as conn:
+            return latest_rows(conn, n, device)
+
+    # [(appareil, lignes)] pour tous les appareils, comme latest_per_device
+    def snapshot(self, n=None):
+        n = min(n or self.taille, self.taille)
+        self._assurer()
+        with self._lock:
+            appareils = {device: list(tampon)[-n:] for device, tampon in self._tampons.items()}
+            evinces = sorted(self._evinces)
+            self.stats["misses" if evinces else "hits"] += 1
+        if evinces:
+            with self.pool.connection() as conn:
+                for device in evinces:
+                    appareils[device] = latest_rows(conn, n, device)
+        return sorted(appareils.items())
+
+    def info(self):
+        with self._lock:
+            return dict(self.stats, appareils=len(self._tampons), evinces=len(self._evinces),
+                        lignes=sum(len(t) for t in self._tampons.values()), taille=self.taille)
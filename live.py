@@ -0,0 +1,70 @@
+from data_access import VOIES, rows_to_arrays
+from db import DB_FILE, connect
+
+# Mode direct des afficheurs : ne lit que les mesures arrivées depuis le
+# dernier passage.
+#
+# PRAGMA data_version ne change que si une autre connexion a validé une
+# transaction : tant qu'il ne bouge pas, un passage ne coûte qu'un PRAGMA.
+# Sinon, les nouvelles lignes sont lues par id croissant à partir du dernier
+# vu (parcours de la clé primaire, pas de l'historique). Le coût d'un passage
+# dépend du nombre de nouvelles lignes, pas de la taille de la base.
+#
+# data_version est propre à une connexion : le suiveur garde donc la sienne
+# au lieu d'emprunter celles du pool.
+
+POLL_MS = 2000
+
+
+class TailFollower:
+    def __init__(self, path=DB_FILE):
+        self.conn = connect(path)
+        self._version = self._data_version()
+        self.dernier_id = self.conn.execute("SELECT MAX(id) FROM mesures").fetchone()[0] or 0
+
+    def _data_version(self):
+        return self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    # Nouvelles lignes (device, timestamp, voies...) des appareils (de tous
+    # si devices vaut None), par id croissant ; ids=True : id en tête de ligne
+    def poll(self, devices=None, ids=False):
+        version = self._data_version()
+        if version == self._version:
+            return []
+        self._version = version
+        filtre, params = "", ()
+        if devices is not None:
+            filtre = f"AND +device IN ({', '.join('?' * len(devices))})"
+            params = tuple(devices)
+        # Un seul instantané : aucune ligne validée entre les deux lectures n'est sautée.
+        # « +device » écarte l'index (device, timestamp), qui parcourrait tout
+        # l'historique de l'appareil : seule la plage d'id est lue.
+        self.conn.execute("BEGIN")
+        try:
+            max_id = self.conn.execute("SELECT MAX(id) FROM mesures").fetchone()[0] or 0
+            rows = self.conn.execute(f"""
+                SELECT {"id, " if ids else ""}device, timestamp, {", ".join(VOIES)}
+                FROM mesures
+                WHERE id > ? AND id <= ? {filtre}
+                ORDER BY id
+            """, (self.dernier_id, max_id, *params)).fetchall()
+        finally:
+            self.conn.rollback()
+        self.dernier_id = max(self.dernier_id, max_id)
+        return rows
+
+    # {appareil: (t, {voie: valeurs})} pour les seuls appareils ayant du neuf
+    def poll_arrays(self, devices):
+        par_device = {}
+        for row in self.poll(devices):
+            par_device.setdefault(row[0], []).append(row[1:])
+        resultat = {}
+        for device, rows in par_device.items():
+            # Les ESP envoient leurs mesures en lot : on remet l'ordre chronologique
+            rows.sort(key=lambda r: r[0])
+            t, valeurs = rows_to_arrays(rows, len(VOIES))
+            resultat[device] = (t, dict(zip(VOIES, valeurs)))
+        return resultat
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,118 @@
+from bisect import bisect_left
+import math
+import threading
+
+# Métriques du serveur au format texte de Prometheus (/metrics).
+#
+# Les histogrammes sont des objets de module, comme avec
+# prometheus_client : le code instrumenté les importe et les alimente
+# directement. Une observation ne coûte qu'un bisect et quelques additions
+# sous un verrou. Les valeurs qui existent déjà ailleurs (taille de la file,
+# statistiques du cache, taille de la base...) sont lues au moment de la
+# collecte par des fonctions enregistrées avec collector().
+#
+# Sous gunicorn, chaque worker a ses propres métriques ; la jauge
+# logger_process_pid indique celui qui a répondu.
+
+DUREES = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+TAILLES = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000, 10000, 50000)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_metriques = []
+_collecteurs = []
+
+
+def _etiquettes(noms, valeurs, extra=""):
+    paires = [f'{n}="{_echapper(v)}"' for n, v in zip(noms, valeurs)]
+    if extra:
+        paires.append(extra)
+    return "{" + ",".join(paires) + "}" if paires else ""
+
+
+def _echapper(valeur):
+    return str(valeur).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _nombre(valeur):
+    if math.isinf(valeur):
+        return "+Inf" if valeur > 0 else "-Inf"
+    return repr(float(valeur)) if isinstance(valeur, float) else str(valeur)
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, nom, aide, etiquettes=(), seuils=DUREES):
+        self.nom = nom
+        self.aide = aide
+        self.etiquettes = tuple(etiquettes)
+        self.seuils = tuple(seuils)
+        self._lock = threading.Lock()
+        # valeurs d'étiquettes -> [effectifs par seau (+ dernier : au-delà), somme]
+        self._series = {}
+        _metriques.append(self)
+
+    def observe(self, valeur, *valeurs):
+        i = bisect_left(self.seuils, valeur)
+        with self._lock:
+            serie = self._series.get(valeurs)
+            if serie is None:
+                serie = self._series[valeurs] = [[0] * (len(self.seuils) + 1), 0.0]
+            serie[0][i] += 1
+            serie[1] += valeur
+
+    def lignes(self):
+        with self._lock:
+            series = [(cle, list(effectifs), somme) for cle, (effectifs, somme) in self._series.items()]
+        for cle, effectifs, somme in series:
+            cumul = 0
+            for seuil, n in zip(self.seuils + (math.inf,), effectifs):
+                cumul += n
+                le = 'le="' + _nombre(seuil) + '"'
+                yield f"{self.nom}_bucket{_etiquettes(self.etiquettes, cle, le)} {cumul}"
+            yield f"{self.nom}_sum{_etiquettes(self.etiquettes, cle)} {_nombre(somme)}"
+            yield f"{self.nom}_count{_etiquettes(self.etiquettes, cle)} {cumul}"
+
+
+# fonction() -> [(nom, type, aide, [(étiquettes dict, valeur)])], appelée à
+# chaque collecte
+def collector(fonction):
+    _collecteurs.append(fonction)
+    return fonction
+
+
+def exposition():
+    lignes = []
+    for m in _metriques:
+        lignes.append(f"# HELP {m.nom} {m.aide}")
+        lignes.append(f"# TYPE {m.nom} {m.type}")
+        lignes.extend(m.lignes())
+    for fonction in _collecteurs:
+        try:
+            familles = fonction()
+        except Exception as e:
+            lignes.append(f"# Erreur du collecteur {fonction.__name__} : {_echapper(e)}")
+            continue
+        for nom, type_, aide, echantillons in familles:
+            lignes.append(f"# HELP {nom} {aide}")
+            lignes.append(f"# TYPE {nom} {type_}")
+            for etiquettes, valeur in echantillons:
+                if valeur is None:
+                    continue
+                lignes.append(f"{nom}{_etiquettes(etiquettes.keys(), etiquettes.values())} {_nombre(valeur)}")
+    return "\n".join(lignes) + "\n"
+
+
+# -- métriques du chemin d'ingestion -----------------------------------------
+
+HTTP_DUREE = Histogram("logger_http_request_duration_seconds",
+                       "Durée de traitement des requêtes HTTP", ("route", "methode", "statut"))
+LOT_LIGNES = Histogram("logger_ingest_batch_rows", "Lignes par lot reçu", ("format",), seuils=TAILLES)
+LOT_DECODAGE = Histogram("logger_ingest_parse_seconds", "Décodage et validation d'un lot", ("format",))
+ECRITURE_ATTENTE = Histogram("logger_ingest_lock_wait_seconds",
+                             "Attente du verrou d'écriture et d'une connexion avant un groupe")
+ECRITURE_EXECUTE = Histogram("logger_ingest_execute_seconds", "Exécution SQL d'un groupe de lots")
+ECRITURE_COMMIT = Histogram("logger_ingest_commit_seconds", "Commit d'un groupe de lots")
+GROUPE_LIGNES = Histogram("logger_ingest_group_rows", "Lignes par groupe écrit (group commit)",
+                          seuils=TAILLES)
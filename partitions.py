@@ -0,0 +1,446 @@
+import argparse
+from collections import Counter
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+import heapq
+from itertools import chain
+from operator import itemgetter
+import os
+import sqlite3
+import stat
+import threading
+import time
+
+import blocks
+from db import DB_FILE, FileLock, connect
+from queries import latest_for_device, latest_per_device
+from schema import format_ts, migrate
+
+# Stockage partitionné par mois.
+#
+# La table mesures de la base principale est la partition « chaude » : toutes
+# les insertions y arrivent. Les mois clos sont déplacés dans des archives
+# mensuelles en lecture seule (archives/mesures_AAAA-MM.db), compactées et
+# indexées, et recensés dans la table partitions. Une mesure qui arrive en
+# retard pour un mois déjà archivé reste dans la partition chaude et
+# incrémente partitions.retard ; l'archivage suivant la rapatrie.
+#
+# select_range / iter_range ne lisent que les partitions qu'une plage couvre :
+# une vue jour d'un mois archivé n'ouvre que l'archive de ce mois. Les jours
+# compactés en blocs (blocks.py) sont une source de plus, dans la base principale.
+
+ARCHIVE_DIR = "archives"
+# Les ESP gardent jusqu'à 7 jours de mesures : un mois n'est clos qu'après ce délai
+DELAI_JOURS = 8
+TAILLE_SUPPRESSION = 5000
+
+ARCHIVE_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS mesures (
+        id INTEGER PRIMARY KEY,
+        device TEXT,
+        temperature REAL,
+        humidity REAL,
+        pressure REAL,
+        timestamp DATETIME
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_mesures_device_ts
+    ON mesures (device, timestamp, temperature, humidity, pressure)
+    """,
+]
+
+_archives = {}
+_archives_lock = threading.Lock()
+
+
+def create_table(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS partitions (
+            mois TEXT PRIMARY KEY,
+            fichier TEXT NOT NULL,
+            lignes INTEGER NOT NULL,
+            retard INTEGER NOT NULL DEFAULT 0,
+            archive_le TEXT NOT NULL
+        )
+    """)
+
+
+def mois_de(ts):
+    return ts[:7]
+
+
+def _debut_mois(mois):
+    return datetime.strptime(mois, "%Y-%m")
+
+
+def _mois_suivant(mois):
+    d = _debut_mois(mois)
+    return (d.replace(day=28) + timedelta(days=4)).replace(day=1).strftime("%Y-%m")
+
+
+def _mois_entre(start, end):
+    mois, fin = start.strftime("%Y-%m"), format_ts(end)
+    while format_ts(_debut_mois(mois)) < fin:
+        yield mois
+        mois = _mois_suivant(mois)
+
+
+def _dossier_archives(conn):
+    for _, nom, chemin in conn.execute("PRAGMA database_list"):
+        if nom == "main":
+            return os.path.join(os.path.dirname(os.path.abspath(chemin or ".")), ARCHIVE_DIR)
+
+
+def archived_months(conn):
+    try:
+        rows = conn.execute("SELECT mois, fichier, retard FROM partitions").fetchall()
+    except sqlite3.OperationalError:
+        # Base pas encore migrée : tout est dans la partition chaude
+        return {}
+    dossier = _dossier_archives(conn)
+    return {mois: (os.path.join(dossier, fichier), retard) for mois, fichier, retard in rows}
+
+
+def _archive(chemin):
+    with _archives_lock:
+        conn = _archives.get(chemin)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{chemin}?mode=ro", uri=True, check_same_thread=False)
+            _archives[chemin] = conn
+        return conn
+
+
+def _oublier_archive(chemin):
+    with _archives_lock:
+        conn = _archives.pop(chemin, None)
+    if conn is not None:
+        conn.close()
+
+
+# Appelé par ingest.write_rows : signale les mesures arrivées pour un mois archivé
+def note_late_rows(conn, rows):
+    par_mois = Counter(mois_de(r[4]) for r in rows)
+    conn.executemany("UPDATE partitions SET retard = retard + ? WHERE mois = ?",
+                     [(n, mois) for mois, n in par_mois.items()])
+
+
+def _sources(conn, start, end):
+    archives = archived_months(conn)
+    if start is None or end is None:
+        return [chemin for _, (chemin, _) in sorted(archives.items())], True
+    chemins, chaude = [], False
+    for mois in _mois_entre(start, end):
+        if mois in archives:
+            chemin, retard = archives[mois]
+            chemins.append(chemin)
+            chaude = chaude or retard > 0
+        else:
+            chaude = True
+    return chemins, chaude
+
+
+# Itère les lignes (colonnes demandées) des appareils sur [start, end[, triées
+# par horodatage, en ne lisant que les partitions nécessaires.
+# devices=None : tous les appareils. blocs=False : sans les jours compactés
+# (data_access les décode lui-même en tableaux).
+def iter_range(conn, colonnes, devices, start=None, end=None, blocs=True):
+    if "timestamp" not in colonnes:
+        raise ValueError("colonnes doit contenir timestamp")
+    filtre = "timestamp IS NOT NULL"
+    params = []
+    if devices is not None:
+        filtre += f" AND device IN ({', '.join('?' * len(devices))})"
+        params.extend(devices)
+    if start is not None:
+        filtre += " AND timestamp >= ?"
+        params.append(format_ts(start))
+    if end is not None:
+        filtre += " AND timestamp < ?"
+        params.append(format_ts(end))
+    sql = f"SELECT {', '.join(colonnes)} FROM mesures WHERE {filtre} ORDER BY timestamp"
+
+    chemins, chaude = _sources(conn, start, end)
+    curseurs = [_archive(chemin).execute(sql, params) for chemin in chemins]
+    if chaude:
+        curseurs.append(conn.execute(sql, params))
+    if blocs:
+        # Source ajoutée seulement si la plage a des blocs : sans eux, le
+        # curseur unique est rendu tel quel, sans fusion
+        lignes = blocks.iter_rows(conn, colonnes, devices, start, end)
+        premiere = next(lignes, None)
+        if premiere is not None:
+            curseurs.append(chain([premiere], lignes))
+    if len(curseurs) == 1:
+        return iter(curseurs[0])
+    i = colonnes.index("timestamp")
+    return heapq.merge(*curseurs, key=lambda row: row[i] or "")
+
+
+def select_range(conn, colonnes, devices, start=None, end=None, blocs=True):
+    return list(iter_range(conn, colonnes, devices, start, end, blocs))
+
+
+# Appareils distincts par sauts dans l'index (device, timestamp)
+APPAREILS = """
+    WITH RECURSIVE appareils(device) AS (
+        SELECT MIN(device) FROM mesures
+        UNION ALL
+        SELECT (SELECT MIN(device) FROM mesures WHERE device > appareils.device)
+        FROM appareils
+        WHERE appareils.device IS NOT NULL
+    )
+    SELECT device FROM appareils WHERE device IS NOT NULL
+"""
+
+
+def list_devices(conn):
+    devices = {row[0] for row in conn.execute(APPAREILS)}
+    for chemin, _ in archived_months(conn).values():
+        devices.update(row[0] for row in _archive(chemin).execute(APPAREILS))
+    return sorted(devices)
+
+
+# -- dernières mesures -------------------------------------------------------
+
+# Un appareil muet depuis un mois archivé (ou dont des jours récents sont
+# compactés) n'a plus ses n dernières mesures dans la partition chaude. Les
+# blocs puis les archives, de la plus récente à la plus ancienne, complètent
+# ce qui manque ; une source n'est lue que si elle peut encore contenir une
+# des n plus récentes (plus_recent : borne haute de ses horodatages).
+def _manque(rows, n, plus_recent):
+    return len(rows) < n or rows[0][4] < plus_recent
+
+
+def _completer(trouves, device, rows, n):
+    if rows:
+        trouves[device] = sorted([*trouves.get(device, []), *rows], key=itemgetter(4))[-n:]
+
+
+# Comme queries.latest_per_device (device=None) ou latest_for_device, sur
+# toutes les partitions
+def latest_rows(conn, n, device=None):
+    if device is None:
+        trouves = dict(latest_per_device(conn, n))
+    else:
+        trouves = {device: latest_for_device(conn, device, n)}
+    for d, plus_recent in blocks.last_seen(conn, device):
+        if _manque(trouves.get(d, []), n, plus_recent):
+            _completer(trouves, d, blocks.latest_rows(conn, d, n), n)
+    for mois, (chemin, _) in sorted(archived_months(conn).items(), reverse=True):
+        fin = format_ts(_debut_mois(_mois_suivant(mois)))
+        archive = _archive(chemin)
+        if device is not None:
+            if not _manque(trouves[device], n, fin):
+                break
+            _completer(trouves, device, latest_for_device(archive, device, n), n)
+            continue
+        # Tous les appareils : un appareil peut n'exister que dans une vieille archive
+        for d, rows in latest_per_device(archive, n):
+            if _manque(trouves.get(d, []), n, fin):
+                _completer(trouves, d, rows, n)
+    if device is not None:
+        return trouves[device]
+    return sorted((d, rows) for d, rows in trouves.items() if rows)
+
+
+# -- archivage -------------------------------------------------------------
+
+def closed_months(conn, maintenant=None, delai_jours=DELAI_JOURS):
+    limite = ((maintenant or datetime.now()) - timedelta(days=delai_jours)).strftime("%Y-%m")
+    mois = []
+    row = conn.execute("SELECT MIN(timestamp) FROM mesures WHERE timestamp IS NOT NULL").fetchone()
+    while row[0] is not None and mois_de(row[0]) < limite:
+        mois.append(mois_de(row[0]))
+        row = conn.execute("SELECT MIN(timestamp) FROM mesures WHERE timestamp >= ?",
+                           (format_ts(_debut_mois(_mois_suivant(mois[-1]))),)).fetchone()
+    return mois
+
+
+def _rendre_inscriptible(chemin, inscriptible):
+    if os.path.exists(chemin):
+        mode = os.stat(chemin).st_mode
+        if inscriptible:
+            os.chmod(chemin, mode | stat.S_IWUSR)
+        else:
+            os.chmod(chemin, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+
+# verrou : verrou d'écriture commun des workers (wsgi.py), pris pour
+# l'inscription et chaque paquet de suppressions ; drop_month (rétention) le
+# prend aussi. La copie (étape 1) n'écrit que dans l'archive et s'en passe.
+def archive_month(conn, mois, verbose=False, verrou=None):
+    dossier = _dossier_archives(conn)
+    os.makedirs(dossier, exist_ok=True)
+    fichier = f"mesures_{mois}.db"
+    chemin = os.path.join(dossier, fichier)
+    debut = format_ts(_debut_mois(mois))
+    fin = format_ts(_debut_mois(_mois_suivant(mois)))
+
+    _oublier_archive(chemin)
+    _rendre_inscriptible(chemin, True)
+
+    # 1. copie vers l'archive (idempotente : relancer après un arrêt est sans risque)
+    conn.execute("ATTACH DATABASE ? AS arch", (chemin,))
+    try:
+        conn.execute("BEGIN")
+        try:
+            # Lus dans l'instantané de la copie : les mesures insérées depuis
+            # (id plus grand) restent en place, et le retard vu est celui des
+            # mesures copiées
+            max_id = conn.execute("SELECT MAX(id) FROM main.mesures").fetchone()[0] or 0
+            row = conn.execute("SELECT retard FROM main.partitions WHERE mois = ?", (mois,)).fetchone()
+            retard_vu = row[0] if row else 0
+            for sql in ARCHIVE_SCHEMA:
+                conn.execute(sql.replace("EXISTS mesures", "EXISTS arch.mesures")
+                                .replace("EXISTS idx_", "EXISTS arch.idx_"))
+            conn.execute("""
+                INSERT OR IGNORE INTO arch.mesures (id, device, temperature, humidity, pressure, timestamp)
+                SELECT id, device, temperature, humidity, pressure, timestamp
+                FROM main.mesures
+                WHERE timestamp >= ? AND timestamp < ? AND id <= ?
+            """, (debut, fin, max_id))
+            lignes = conn.execute("SELECT COUNT(*) FROM arch.mesures").fetchone()[0]
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    finally:
+        conn.execute("DETACH DATABASE arch")
+
+    # 2. le routeur lit désormais l'archive pour ce mois. Les mesures du mois
+    #    insérées depuis la copie (id > max_id) n'ont pas été signalées par
+    #    note_late_rows (mois pas encore inscrit) : comptées ici comme retard,
+    #    dans la même transaction d'écriture, elles restent lues dans la
+    #    partition chaude jusqu'à l'archivage suivant. Une archive effacée
+    #    entre-temps par la rétention (drop_month) n'est pas inscrite : ses
+    #    mesures restent dans la partition chaude.
+    with verrou or nullcontext():
+        if not os.path.exists(chemin):
+            return 0
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            nouvelles = conn.execute("""
+                SELECT COUNT(*) FROM mesures WHERE id > ? AND timestamp >= ? AND timestamp < ?
+            """, (max_id, debut, fin)).fetchone()[0]
+            conn.execute("""
+                INSERT INTO partitions (mois, fichier, lignes, retard, archive_le) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (mois) DO UPDATE SET
+                    lignes = excluded.lignes,
+                    retard = max(retard - ?, 0),
+                    archive_le = excluded.archive_le
+            """, (mois, fichier, lignes, nouvelles, format_ts(datetime.now()), retard_vu))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    # 3. suppression dans la partition chaude par petites transactions,
+    #    pour ne jamais bloquer /receive_batch longtemps. Chaque paquet
+    #    vérifie, sous le verrou, que l'archive est toujours inscrite : après
+    #    un drop_month, les mesures restantes ne sont plus ailleurs.
+    supprimees = 0
+    while True:
+        with verrou or nullcontext():
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                n = 0
+                if conn.execute("SELECT 1 FROM partitions WHERE mois = ?", (mois,)).fetchone():
+                    n = conn.execute("""
+                        DELETE FROM mesures WHERE id IN (
+                            SELECT id FROM mesures
+                            WHERE timestamp >= ? AND timestamp < ? AND id <= ?
+                            LIMIT ?
+                        )
+                    """, (debut, fin, max_id, TAILLE_SUPPRESSION)).rowcount
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        if n == 0:
+            break
+        supprimees += n
+
+    # 4. compactage de l'archive puis passage en lecture seule ; mode=rw ne
+    #    recrée pas une archive effacée entre-temps
+    try:
+        arch = sqlite3.connect(f"file:{chemin}?mode=rw", uri=True)
+    except sqlite3.OperationalError:
+        return supprimees
+    try:
+        arch.execute("PRAGMA journal_mode = DELETE")
+        arch.execute("ANALYZE")
+        arch.execute("VACUUM")
+    finally:
+        arch.close()
+    _rendre_inscriptible(chemin, False)
+
+    if verbose:
+        print(f"{mois} : {supprimees} lignes déplacées vers {chemin} ({lignes} au total)")
+    return supprimees
+
+
+# Mois archivés entièrement antérieurs à limite : [(mois, chemin, lignes)]
+def archived_months_before(conn, limite):
+    archives = archived_months(conn)
+    if not archives:
+        return []
+    lignes = dict(conn.execute("SELECT mois, lignes FROM partitions"))
+    return [(mois, chemin, lignes[mois]) for mois, (chemin, _) in sorted(archives.items())
+            if format_ts(_debut_mois(_mois_suivant(mois))) <= limite]
+
+
+# Supprime l'archive d'un mois (rétention) : le routeur ne la lit plus, puis
+# le fichier est effacé. Renvoie le nombre d'octets libérés. Sous le verrou
+# d'écriture, comme les étapes d'archive_month qu'il ne doit pas entrelacer.
+def drop_month(conn, mois, verrou=None):
+    with verrou or nullcontext():
+        archives = archived_months(conn)
+        if mois not in archives:
+            return 0
+        chemin = archives[mois][0]
+        with conn:
+            conn.execute("DELETE FROM partitions WHERE mois = ?", (mois,))
+        _oublier_archive(chemin)
+        if not os.path.exists(chemin):
+            return 0
+        octets = os.path.getsize(chemin)
+        # Windows refuse d'effacer un fichier en lecture seule
+        _rendre_inscriptible(chemin, True)
+        os.remove(chemin)
+        return octets
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive les mois clos dans des partitions mensuelles")
+    parser.add_argument("db", nargs="?", default=DB_FILE)
+    parser.add_argument("--delai-jours", type=int, default=DELAI_JOURS,
+                        help="un mois est clos ce nombre de jours après sa fin")
+    parser.add_argument("--dry-run", action="store_true", help="liste les mois sans archiver")
+    parser.add_argument("--vacuum", action="store_true", help="VACUUM de la base principale ensuite")
+    args = parser.parse_args()
+
+    conn = connect(args.db)
+    try:
+        migrate(conn, verbose=True)
+        mois = closed_months(conn, delai_jours=args.delai_jours)
+        if args.dry_run:
+            print("Mois à archiver :", ", ".join(mois) or "aucun")
+            return
+        t0 = time.perf_counter()
+        # Verrou d'écriture des workers (wsgi.py) : leur rétention peut
+        # effacer une archive pendant ce temps
+        verrou = FileLock(args.db + ".ecriture.lock")
+        for m in mois:
+            archive_month(conn, m, verbose=True, verrou=verrou)
+        print(f"{len(mois)} mois archivés en {time.perf_counter() - t0:.1f} s")
+        if args.vacuum and mois:
+            conn.execute("VACUUM")
+            print("VACUUM terminé")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+from itertools import groupby
+from operator import itemgetter
+
+# Requêtes de lecture partagées par le serveur et les afficheurs.
+
+# « N dernières mesures par appareil » en une seule requête :
+#  - la CTE récursive parcourt les appareils distincts par sauts dans l'index
+#    (device, timestamp) au lieu de lire toute la table ;
+#  - pour chaque appareil, la sous-requête OFFSET trouve le N-ième horodatage
+#    le plus récent, et la jointure ne lit que la fin de l'index ;
+#  - ROW_NUMBER() ne numérote que ces quelques lignes (ex aequo compris).
+# Le coût dépend du nombre d'appareils et de N, pas du nombre de lignes.
+# CROSS JOIN impose l'ordre des boucles : appareils d'abord, puis l'index.
+LATEST_PER_DEVICE = """
+    WITH RECURSIVE appareils(device) AS (
+        SELECT MIN(device) FROM mesures
+        UNION ALL
+        SELECT (SELECT MIN(device) FROM mesures WHERE device > appareils.device)
+        FROM appareils
+        WHERE appareils.device IS NOT NULL
+    ),
+    fenetre AS (
+        SELECT m.device, m.temperature, m.humidity, m.pressure, m.timestamp,
+               ROW_NUMBER() OVER (PARTITION BY m.device ORDER BY m.timestamp DESC, m.id DESC) AS rang
+        FROM appareils a
+        CROSS JOIN mesures m
+        WHERE m.device = a.device
+          AND m.timestamp >= IFNULL((
+              SELECT timestamp FROM mesures
+              WHERE device = a.device
+              ORDER BY timestamp DESC
+              LIMIT 1 OFFSET :n - 1
+          ), '')
+    )
+    SELECT device, temperature, humidity, pressure, timestamp
+    FROM fenetre
+    WHERE rang <= :n
+    ORDER BY device, rang DESC
+"""
+
+
+def latest_per_device(conn, n=24):
+    rows = conn.execute(LATEST_PER_DEVICE, {"n": n}).fetchall()
+    return [(device, list(mesures)) for device, mesures in groupby(rows, key=itemgetter(0))]
+
+
+LATEST_FOR_DEVICE = """
+    SELECT device, temperature, humidity, pressure, timestamp
+    FROM mesures
+    WHERE device = ? AND timestamp IS NOT NULL
+    ORDER BY timestamp DESC, id DESC
+    LIMIT ?
+"""
+
+
+def latest_for_device(conn, device, n=24):
+    rows = conn.execute(LATEST_FOR_DEVICE, (device, n)).fetchall()
+    rows.reverse()
+    return rows
@@ -0,0 +1,238 @@
+import matplotlib
+from matplotlib.collections import LineCollection
+from matplotlib.lines import Line2D
+import numpy as np
+from matplotlib.ticker import FuncFormatter, MultipleLocator
+
+# Moteur de rendu de la vue jour des afficheurs.
+#
+# Les courbes (Line2D) sont créées une seule fois puis mises à jour par
+# set_data. L'axe des x est en heures depuis le début de la vue : il ne change
+# pas d'un jour à l'autre. L'axe des y ne bouge que si les nouvelles valeurs en
+# sortent ou n'en occupent plus qu'une petite partie. Tant que les axes ne
+# changent pas, une image n'est que : fond mémorisé + courbes + titre (blit) ;
+# sinon la figure est redessinée en entier, via draw_idle qui regroupe les
+# demandes rapprochées.
+
+STYLES = {
+    "temperature": ("Température", "Température (°C)", "red"),
+    "humidity": ("Humidité", "Humidité (%)", "blue"),
+    "pressure": ("Pression", "Pression (hPa)", "green"),
+}
+
+MARGE_Y = 0.1
+# Les valeurs doivent couvrir au moins cette part de l'axe des y
+REMPLISSAGE_MIN = 0.5
+
+
+def _format_heure(h, _):
+    h = int(round(h * 60))
+    return f"{h // 60:02d}:{h % 60:02d}"
+
+
+def _axe_heures(ax, duree_h):
+    ax.set_xlim(0, duree_h)
+    ax.xaxis.set_major_locator(MultipleLocator(3))
+    ax.xaxis.set_major_formatter(FuncFormatter(_format_heure))
+    ax.set_xlabel("Heure")
+
+
+# Recadre l'axe des y si les valeurs en sortent ou n'en couvrent plus assez.
+# Renvoie True si l'axe a changé.
+def _ajuster_y(ax, y):
+    y = y[~np.isnan(y)]
+    if not len(y):
+        return False
+    bas, haut = float(y.min()), float(y.max())
+    y0, y1 = ax.get_ylim()
+    if y0 <= bas and haut <= y1 and (haut - bas) >= REMPLISSAGE_MIN * (y1 - y0):
+        return False
+    etendue = haut - bas or 1.0
+    ax.set_ylim(bas - MARGE_Y * etendue, haut + MARGE_Y * etendue)
+    return True
+
+
+class DayPlot:
+    def __init__(self, canvas, axes, voies=tuple(STYLES)):
+        self.canvas = canvas
+        self.fig = canvas.figure
+        self.axes = dict(zip(voies, axes))
+        self.lines = {}
+        self.legendes = {}
+        self.duree_h = 24.0
+        self.start = None
+        self._fond = None
+        self.stats = {"images_blit": 0, "images_completes": 0}
+
+        for voie, ax in self.axes.items():
+            label, ylabel, couleur = STYLES[voie]
+            ax.clear()
+            # animated : exclue du dessin normal, dessinée par-dessus le fond
+            line, = ax.plot([], [], label=label, color=couleur, animated=True)
+            self.lines[voie] = line
+            _axe_heures(ax, self.duree_h)
+            ax.set_ylabel(ylabel)
+            ax.grid(True)
+            self.legendes[voie] = ax.legend(loc="upper right")
+        self.titre = self.fig.suptitle("", fontsize=14, animated=True)
+
+        canvas.mpl_connect("draw_event", self._on_draw)
+
+    def _on_draw(self, event):
+        # Après chaque dessin complet (y compris redimensionnement)
+        self._fond = self.canvas.copy_from_bbox(self.fig.bbox)
+        self._dessiner_animes()
+
+    def _dessiner_animes(self):
+        for voie, line in self.lines.items():
+            self.axes[voie].draw_artist(line)
+        self.fig.draw_artist(self.titre)
+
+    def _set_visible(self, voie, visible):
+        ax = self.axes[voie]
+        self.lines[voie].set_visible(visible)
+        self.legendes[voie].set_visible(visible)
+        ax.set_ylabel(STYLES[voie][1] if visible else "")
+        ax.grid(visible)
+
+    # times : datetime64 ; valeurs : {voie: tableau} ; visibles : {voie: bool}
+    def update(self, start, end, times, valeurs, visibles, titre):
+        complet = self._fond is None
+        duree_h = (end - start).total_seconds() / 3600
+        if duree_h != self.duree_h:
+            self.duree_h = duree_h
+            for ax in self.axes.values():
+                ax.set_xlim(0, duree_h)
+            complet = True
+
+        self.start = start
+        x = self._heures(times)
+        for voie, line in self.lines.items():
+            y = valeurs.get(voie, np.empty(0))
+            line.set_data(x, y)
+            visible = visibles.get(voie, True)
+            if visible != line.get_visible():
+                self._set_visible(voie, visible)
+                complet = True
+            if visible and _ajuster_y(self.axes[voie], y):
+                complet = True
+        self.titre.set_text(titre)
+        self._afficher(complet)
+
+    # Mode direct : nouveaux points ajoutés au bout des courbes existantes.
+    # Renvoie False (rien n'est fait) si ces points ne viennent pas après
+    # ceux affichés : la journée est alors à relire.
+    def append(self, times, valeurs):
+        if self.start is None:
+            return False
+        x = self._heures(times)
+        deja = self.lines[next(iter(self.lines))].get_xdata()
+        if len(deja) and len(x) and x[0] < deja[-1]:
+            return False
+        complet = False
+        for voie, line in self.lines.items():
+            xs = np.concatenate([line.get_xdata(), x])
+            ys = np.concatenate([line.get_ydata(), valeurs[voie]])
+            line.set_data(xs, ys)
+            if line.get_visible() and _ajuster_y(self.axes[voie], ys):
+                complet = True
+        self._afficher(complet)
+        return True
+
+    def clear(self, titre):
+        self.start = None
+        for line in self.lines.values():
+            line.set_data([], [])
+        self.titre.set_text(titre)
+        self._afficher(False)
+
+    def _heures(self, times):
+        return (times - np.datetime64(self.start, "s")) / np.timedelta64(1, "h")
+
+    def _afficher(self, complet):
+        if complet or self._fond is None or not self.canvas.supports_blit:
+            self.stats["images_completes"] += 1
+            self.canvas.draw_idle()
+            return
+        self.stats["images_blit"] += 1
+        self.canvas.restore_region(self._fond)
+        self._dessiner_animes()
+        self.canvas.blit(self.fig.bbox)
+
+
+# Vue de comparaison de curseur : une voie de plusieurs dizaines d'appareils
+# superposés sur un seul axe. Toutes les courbes sont les segments d'une seule
+# LineCollection : une image coûte selon le nombre de points, pas selon le
+# nombre d'appareils. Même principe que DayPlot pour le reste : fond mémorisé
+# et blit tant que les axes et la légende ne changent pas.
+class ComparisonPlot:
+    def __init__(self, canvas, ax, palette="tab20"):
+        self.canvas = canvas
+        self.fig = canvas.figure
+        self.ax = ax
+        self.palette = matplotlib.colormaps[palette]
+        self.duree_h = 24.0
+        self.voie = None
+        self.devices = None
+        self.legende = None
+        self._fond = None
+        self.stats = {"images_blit": 0, "images_completes": 0}
+
+        self.collection = LineCollection([], linewidths=1.2, animated=True)
+        ax.add_collection(self.collection)
+        _axe_heures(ax, self.duree_h)
+        ax.grid(True)
+        self.titre = ax.set_title("", animated=True)
+
+        canvas.mpl_connect("draw_event", self._on_draw)
+
+    def _on_draw(self, event):
+        self._fond = self.canvas.copy_from_bbox(self.fig.bbox)
+        self._dessiner_animes()
+
+    def _dessiner_animes(self):
+        self.ax.draw_artist(self.collection)
+        self.ax.draw_artist(self.titre)
+
+    def couleurs(self, n):
+        return self.palette(np.arange(n) % self.palette.N)
+
+    # devices, t, valeurs, bornes : comme data_access.load_comparison
+    def update(self, start, end, voie, devices, t, valeurs, bornes, titre):
+        complet = self._fond is None
+        duree_h = (end - start).total_seconds() / 3600
+        if duree_h != self.duree_h:
+            self.duree_h = duree_h
+            self.ax.set_xlim(0, duree_h)
+            complet = True
+        if voie != self.voie:
+            self.voie = voie
+            self.ax.set_ylabel(STYLES[voie][1])
+            complet = True
+
+        couleurs = self.couleurs(len(devices))
+        if devices != self.devices:
+            self.devices = list(devices)
+            if self.legende is not None:
+                self.legende.remove()
+            poignees = [Line2D([], [], color=c) for c in couleurs]
+            self.legende = self.ax.legend(poignees, devices, loc="upper left", bbox_to_anchor=(1.01, 1),
+                                          fontsize="small", ncol=1 + len(devices) // 25, frameon=False)
+            complet = True
+
+        x = (t - np.datetime64(start, "s")) / np.timedelta64(1, "h")
+        self.collection.set_segments([np.column_stack([x[a:b], valeurs[a:b]])
+                                      for a, b in zip(bornes[:-1], bornes[1:])])
+        self.collection.set_color(couleurs)
+        if _ajuster_y(self.ax, valeurs):
+            complet = True
+        self.titre.set_text(titre)
+
+        if complet or self._fond is None or not self.canvas.supports_blit:
+            self.stats["images_completes"] += 1
+            self.canvas.draw_idle()
+            return
+        self.stats["images_blit"] += 1
+        self.canvas.restore_region(self._fond)
+        self._dessiner_animes()
+        self.canvas.blit(self.fig.bbox)
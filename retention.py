@@ -0,0 +1,382 @@
+import argparse
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+import os
+import sqlite3
+import threading
+import time
+
+from db import DB_FILE, FileLock, connect
+from partitions import APPAREILS, DELAI_JOURS, archived_months_before, drop_month
+from rollups import RESOLUTIONS
+from schema import format_ts, migrate
+
+# Rétention des données anciennes.
+#
+# Les mesures brutes sont gardées N jours ; au-delà, les tables d'agrégats
+# (tenues à jour à l'ingestion) les remplacent : la vue jour d'une date
+# purgée passe en moyennes 5 min, ou horaires si les seaux 5 min sont purgés
+# eux aussi. Les moyennes journalières sont gardées sans limite. Les
+# identifiants de lots (déduplication) ne servent que tant qu'un ESP peut
+# renvoyer un lot, soit quelques jours.
+#
+# La politique donne le nombre de jours gardés par niveau (None : sans
+# limite). Les limites tombent à minuit, donc sur un début de seau à toutes
+# les résolutions. La table retention garde, par niveau, la limite sous
+# laquelle des lignes ont été supprimées : les lecteurs (rollups.query_series)
+# et les recalculs (rollups.backfill, catalogue.rebuild, anomalies.backfill)
+# n'attendent plus de mesures brutes avant elle.
+#
+# Les suppressions se font par TAILLE_SUPPRESSION lignes, une transaction
+# chacune (sous le verrou d'écriture des workers s'il y en a un) : une passe
+# ne bloque jamais /receive_batch plus de quelques millisecondes. Les mois
+# archivés entièrement sous la limite sont supprimés d'un bloc (fichier
+# effacé), les jours compactés (blocks.py) par paquets de blocs entiers. Les
+# pages libérées sont rendues au système par vacuum incrémental si la base
+# est en auto_vacuum = INCREMENTAL (bases créées depuis, ou converties une
+# fois avec --vacuum).
+
+NIVEAUX = ("brut", "5min", "heure", "lots")
+POLITIQUE_DEFAUT = {"brut": 180, "5min": 180, "heure": None, "lots": 30}
+# Niveaux purgés du plus fin au plus grossier : un niveau ne peut pas être
+# gardé moins longtemps que le précédent
+ORDRE = ("brut", "5min", "heure")
+
+TAILLE_SUPPRESSION = 2000
+PAUSE_S = 0.05
+PAGES_VACUUM = 1000
+PERIODE_S = 6 * 3600
+DELAI_DEMARRAGE_S = 60
+
+# Mesures brutes : appareil par appareil, pour que chaque paquet (et la
+# requête vide qui termine) soit une recherche dans l'index (device,
+# timestamp) et non un parcours de toute la table sous le verrou d'écriture.
+# « device IS ? » couvre aussi les lignes sans appareil.
+SUPPRESSIONS = {
+    "brut": """
+        DELETE FROM mesures WHERE id IN (
+            SELECT id FROM mesures WHERE device IS ? AND timestamp < ? LIMIT ?
+        )
+    """,
+    **{nom: f"""
+        DELETE FROM {RESOLUTIONS[nom][0]} WHERE (device, bucket) IN (
+            SELECT device, bucket FROM {RESOLUTIONS[nom][0]} WHERE bucket < ? LIMIT ?
+        )
+    """ for nom in ("5min", "heure")},
+    "lots": """
+        DELETE FROM lots_recus WHERE rowid IN (
+            SELECT rowid FROM lots_recus WHERE recu_le < ? LIMIT ?
+        )
+    """,
+}
+
+# Jours compactés (blocks.py) : un bloc par appareil et par jour ; la limite
+# tombe à minuit, un bloc est donc supprimé entier
+SUPPRESSION_BLOCS = """
+    DELETE FROM blocs WHERE rowid IN (
+        SELECT rowid FROM blocs WHERE jour < substr(?, 1, 10) LIMIT ?
+    )
+"""
+COMPTAGE_BLOCS = "SELECT COUNT(*), IFNULL(SUM(n), 0) FROM blocs WHERE jour < substr(?, 1, 10)"
+
+# Lignes concernées et tables (avec index) qui les stockent, pour le rapport
+COMPTAGES = {
+    "brut": ("SELECT COUNT(*) FROM mesures WHERE device IS ? AND timestamp < ?",
+             ("mesures", "idx_mesures_device_ts")),
+    **{nom: (f"SELECT COUNT(*) FROM {RESOLUTIONS[nom][0]} WHERE bucket < ?", (RESOLUTIONS[nom][0],))
+       for nom in ("5min", "heure")},
+    "lots": ("SELECT COUNT(*) FROM lots_recus WHERE recu_le < ?",
+             ("lots_recus", "sqlite_autoindex_lots_recus_1")),
+}
+
+
+def create_table(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS retention (
+            niveau TEXT PRIMARY KEY,
+            avant TEXT NOT NULL,
+            purge_le TEXT NOT NULL
+        )
+    """)
+
+
+# Limite sous laquelle le niveau a été purgé, ou None
+def horizon(conn, niveau):
+    try:
+        row = conn.execute("SELECT avant FROM retention WHERE niveau = ?", (niveau,)).fetchone()
+    except sqlite3.OperationalError:
+        # Base pas encore migrée : rien n'a été purgé
+        return None
+    return row[0] if row else None
+
+
+# -- politique ---------------------------------------------------------------
+
+# "brut=90,5min=365,heure=" : jours gardés par niveau (vide : sans limite) ;
+# les niveaux absents gardent leur valeur par défaut
+def parse_policy(texte):
+    politique = dict(POLITIQUE_DEFAUT)
+    for morceau in filter(None, (m.strip() for m in texte.split(","))):
+        niveau, _, jours = morceau.partition("=")
+        niveau = niveau.strip()
+        if niveau not in NIVEAUX:
+            raise ValueError(f"Niveau inconnu : {niveau} ({', '.join(NIVEAUX)})")
+        politique[niveau] = int(jours) if jours.strip() else None
+    check_policy(politique)
+    return politique
+
+
+def check_policy(politique):
+    # Les ESP gardent jusqu'à 7 jours de mesures et peuvent renvoyer un lot
+    for niveau in ("brut", "lots"):
+        jours = politique.get(niveau)
+        if jours is not None and jours < DELAI_JOURS:
+            raise ValueError(f"'{niveau}' : au moins {DELAI_JOURS} jours")
+    precedent = 0
+    for niveau in ORDRE:
+        jours = politique.get(niveau)
+        if jours is None:
+            precedent = None
+        elif precedent is None or jours < precedent:
+            raise ValueError(f"'{niveau}' doit être gardé au moins aussi longtemps que les niveaux plus fins")
+        else:
+            precedent = jours
+
+
+def format_policy(politique):
+    return ", ".join(f"{n}={politique[n] if politique.get(n) is not None else '∞'}" for n in NIVEAUX)
+
+
+# {niveau: limite "YYYY-MM-DD 00:00:00"} des niveaux à purger
+def limits(politique, maintenant=None):
+    maintenant = maintenant or datetime.now()
+    return {niveau: (maintenant - timedelta(days=jours)).strftime("%Y-%m-%d 00:00:00")
+            for niveau, jours in politique.items() if jours is not None}
+
+
+# -- rapport (dry-run) -------------------------------------------------------
+
+def _octets(conn, tables):
+    # Place occupée par des tables et index (table virtuelle dbstat)
+    try:
+        return conn.execute(f"""
+            SELECT SUM(pgsize) FROM dbstat WHERE name IN ({", ".join("?" * len(tables))})
+        """, tables).fetchone()[0] or 0
+    except sqlite3.OperationalError:
+        # SQLite compilé sans dbstat
+        return None
+
+
+# Appareils de la table mesures (sauts dans l'index), et None pour les
+# lignes sans appareil : les requêtes brutes se font appareil par appareil
+def _appareils(conn):
+    return [row[0] for row in conn.execute(APPAREILS)] + [None]
+
+
+# [{niveau, avant, lignes, octets}] : ce qu'une passe supprimerait, octets
+# estimés au prorata des lignes (None si dbstat est absent). Les archives
+# mensuelles comptent pour leur taille de fichier.
+def report(conn, politique, maintenant=None):
+    resultat = []
+    for niveau, limite in limits(politique, maintenant).items():
+        sql, tables = COMPTAGES[niveau]
+        if niveau == "brut":
+            lignes = sum(conn.execute(sql, (device, limite)).fetchone()[0] for device in _appareils(conn))
+        else:
+            lignes = conn.execute(sql, (limite,)).fetchone()[0]
+        total = conn.execute(f"SELECT COUNT(*) FROM {tables[0]}").fetchone()[0]
+        octets = _octets(conn, tables)
+        if octets is not None:
+            octets = octets * lignes // total if total else 0
+        resultat.append({"niveau": niveau, "avant": limite, "lignes": lignes, "octets": octets})
+        if niveau == "brut":
+            for mois, chemin, n in archived_months_before(conn, limite):
+                resultat.append({"niveau": f"archive {mois}", "avant": limite, "lignes": n,
+                                 "octets": os.path.getsize(chemin) if os.path.exists(chemin) else 0})
+            blocs, n = conn.execute(COMPTAGE_BLOCS, (limite,)).fetchone()
+            if blocs:
+                total = conn.execute("SELECT COUNT(*) FROM blocs").fetchone()[0]
+                octets = _octets(conn, ("blocs", "sqlite_autoindex_blocs_1"))
+                resultat.append({"niveau": "blocs", "avant": limite, "lignes": n,
+                                 "octets": octets * blocs // total if octets is not None else None})
+    return resultat
+
+
+def free_space(conn):
+    page = conn.execute("PRAGMA page_size").fetchone()[0]
+    libres = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    incremental = conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    return libres * page, incremental
+
+
+# -- purge -------------------------------------------------------------------
+
+def _supprimer(conn, sql, params, verrou, pause_s):
+    total = 0
+    while True:
+        with verrou or nullcontext():
+            with conn:
+                n = conn.execute(sql, (*params, TAILLE_SUPPRESSION)).rowcount
+        total += n
+        if n < TAILLE_SUPPRESSION:
+            return total
+        if pause_s:
+            time.sleep(pause_s)
+
+
+def _noter_horizon(conn, niveau, limite, verrou):
+    with verrou or nullcontext():
+        with conn:
+            conn.execute("""
+                INSERT INTO retention (niveau, avant, purge_le) VALUES (?, ?, ?)
+                ON CONFLICT (niveau) DO UPDATE SET
+                    avant = max(avant, excluded.avant), purge_le = excluded.purge_le
+            """, (niveau, limite, format_ts(datetime.now())))
+
+
+def incremental_vacuum(conn, verrou=None, pause_s=PAUSE_S):
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return 0
+    page = conn.execute("PRAGMA page_size").fetchone()[0]
+    liberes = 0
+    while True:
+        with verrou or nullcontext():
+            libres = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if not libres:
+                return liberes
+            # execute() n'avancerait le pragma que d'un pas (une page)
+            conn.executescript(f"PRAGMA incremental_vacuum({PAGES_VACUUM})")
+        liberes += min(libres, PAGES_VACUUM) * page
+        if pause_s:
+            time.sleep(pause_s)
+
+
+# Une passe complète ; renvoie {niveau: lignes supprimées, "octets_vacuum": ...}
+def purge(conn, politique, maintenant=None, verrou=None, pause_s=PAUSE_S, verbose=False):
+    stats = {}
+    for niveau, limite in limits(politique, maintenant).items():
+        t0 = time.perf_counter()
+        if niveau != "lots":
+            # Avant toute suppression : les lecteurs passent aux agrégats
+            _noter_horizon(conn, niveau, limite, verrou)
+        n = 0
+        if niveau == "brut":
+            for mois, _, lignes in archived_months_before(conn, limite):
+                drop_month(conn, mois, verrou)
+                n += lignes
+            n += conn.execute(COMPTAGE_BLOCS, (limite,)).fetchone()[1]
+            _supprimer(conn, SUPPRESSION_BLOCS, (limite,), verrou, pause_s)
+            # Liste lue hors verrou ; un appareil apparu depuis n'a rien d'ancien
+            for device in _appareils(conn):
+                n += _supprimer(conn, SUPPRESSIONS[niveau], (device, limite), verrou, pause_s)
+        else:
+            n += _supprimer(conn, SUPPRESSIONS[niveau], (limite,), verrou, pause_s)
+        stats[niveau] = n
+        if verbose:
+            print(f"{niveau:<6} avant {limite} : {n} lignes supprimées en {time.perf_counter() - t0:.1f} s")
+    stats["octets_vacuum"] = incremental_vacuum(conn, verrou, pause_s)
+    return stats
+
+
+# Passes périodiques dans un thread du serveur. Sous plusieurs workers, un
+# verrou de fichier réserve chaque passe à un seul d'entre eux ; verrou est
+# le verrou d'écriture commun, pris pour chaque transaction.
+class RetentionJob:
+    def __init__(self, pool, politique, verrou=None, periode_s=PERIODE_S):
+        check_policy(politique)
+        self.pool = pool
+        self.politique = politique
+        self.verrou = verrou
+        self.periode_s = periode_s
+        self._exclusif = FileLock(pool.path + ".retention.lock")
+        self._arret = threading.Event()
+        self._thread = None
+        self.stats = {"passes": 0, "erreurs": 0, **{niveau: 0 for niveau in NIVEAUX}, "octets_vacuum": 0}
+
+    def start(self):
+        if self._thread is None:
+            self._arret.clear()
+            self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=30):
+        if self._thread is not None:
+            self._arret.set()
+            self._thread.join(timeout)
+            self._thread = None
+
+    def run_once(self):
+        if not self._exclusif.acquire(bloquant=False):
+            return None
+        try:
+            with self.pool.connection() as conn:
+                stats = purge(conn, self.politique, verrou=self.verrou)
+        finally:
+            self._exclusif.release()
+        self.stats["passes"] += 1
+        for cle, n in stats.items():
+            self.stats[cle] += n
+        return stats
+
+    def _run(self):
+        attente = DELAI_DEMARRAGE_S
+        while not self._arret.wait(attente):
+            attente = self.periode_s
+            try:
+                stats = self.run_once()
+            except Exception as e:
+                self.stats["erreurs"] += 1
+                print(f"Erreur de la rétention : {e}")
+                continue
+            if stats and any(stats.values()):
+                print(f"Rétention : {stats}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Supprime les données plus anciennes que la politique de rétention")
+    parser.add_argument("db", nargs="?", default=DB_FILE)
+    parser.add_argument("--politique", default="",
+                        help=f"jours gardés par niveau, ex. brut=90,5min=365,heure= "
+                             f"(défaut : {format_policy(POLITIQUE_DEFAUT)})")
+    parser.add_argument("--dry-run", action="store_true", help="rapport sans rien supprimer")
+    parser.add_argument("--vacuum", action="store_true",
+                        help="passe la base en vacuum incrémental si besoin (VACUUM complet, une fois)")
+    args = parser.parse_args()
+
+    try:
+        politique = parse_policy(args.politique)
+    except ValueError as e:
+        parser.error(str(e))
+
+    conn = connect(args.db)
+    try:
+        migrate(conn, verbose=True)
+        print(f"Politique : {format_policy(politique)}")
+        if args.dry_run:
+            total = 0
+            for ligne in report(conn, politique):
+                octets = ligne["octets"]
+                total += octets or 0
+                taille = f"{octets / 1e6:>9.1f} Mo" if octets is not None else "        ? Mo"
+                print(f"{ligne['niveau']:<16} avant {ligne['avant']} : {ligne['lignes']:>10} lignes {taille}")
+            libres, incremental = free_space(conn)
+            print(f"Total estimé : {total / 1e6:.1f} Mo ; déjà libres dans le fichier : {libres / 1e6:.1f} Mo")
+            if not incremental:
+                print("La base n'est pas en vacuum incrémental : lancez une fois avec --vacuum "
+                      "pour rendre la place au système")
+            return
+        t0 = time.perf_counter()
+        stats = purge(conn, politique, verbose=True)
+        if args.vacuum and conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+            print("Base passée en vacuum incrémental (VACUUM terminé)")
+        elif stats["octets_vacuum"]:
+            print(f"Vacuum incrémental : {stats['octets_vacuum'] / 1e6:.1f} Mo rendus au système")
+        print(f"Rétention appliquée en {time.perf_counter() - t0:.1f} s")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
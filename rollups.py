@@ -0,0 +1,296 @@
+import argparse
+from datetime import datetime
+from itertools import islice
+import sqlite3
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import blocks
+from db import DB_FILE, connect
+from partitions import archived_months, select_range
+from schema import format_ts, migrate, parse_ts
+
+# Tables d'agrégats (5 min / heure / jour) par appareil, tenues à jour dans la
+# transaction d'ingestion. Chaque voie garde n, somme, min et max : la moyenne
+# se recalcule et les agrégats se cumulent sans relire les mesures brutes.
+
+VOIES = ("temperature", "humidity", "pressure")
+
+# Du plus fin au plus grossier : nom -> (table, durée d'un seau en secondes)
+RESOLUTIONS = {
+    "5min": ("rollup_5min", 300),
+    "heure": ("rollup_heure", 3600),
+    "jour": ("rollup_jour", 86400),
+}
+
+# Nombre de points minimal qu'une vue doit obtenir avec une résolution agrégée.
+# Une journée ne donne que 288 seaux de 5 min : la vue jour reste donc brute,
+# une semaine passe en 5 min, un an en jours.
+POINTS_MIN = 300
+
+TAILLE_PAQUET = 50000
+
+# À partir de cette taille de lot, l'agrégation à l'ingestion passe par NumPy
+# (un tri par résolution) plutôt que par une boucle Python par résolution
+SEUIL_NUMPY = 256
+
+
+def _seau_5min(ts):
+    return f"{ts[:14]}{int(ts[14:16]) // 5 * 5:02d}:00"
+
+
+def _seau_heure(ts):
+    return ts[:13] + ":00:00"
+
+
+def _seau_jour(ts):
+    return ts[:10] + " 00:00:00"
+
+
+SEAUX = {"5min": _seau_5min, "heure": _seau_heure, "jour": _seau_jour}
+
+# Même découpage côté SQL, pour le recalcul complet
+SEAUX_SQL = {
+    "5min": "strftime('%Y-%m-%d %H:', timestamp) || printf('%02d', CAST(strftime('%M', timestamp) AS INTEGER) / 5 * 5) || ':00'",
+    "heure": "strftime('%Y-%m-%d %H:00:00', timestamp)",
+    "jour": "strftime('%Y-%m-%d 00:00:00', timestamp)",
+}
+
+COLONNES = ["n"] + [f"{v}_{a}" for v in VOIES for a in ("n", "sum", "min", "max")]
+
+
+def create_tables(conn):
+    colonnes = ",\n".join(
+        f"{v}_n INTEGER NOT NULL, {v}_sum REAL NOT NULL, {v}_min REAL, {v}_max REAL" for v in VOIES)
+    for table, _ in RESOLUTIONS.values():
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                device TEXT NOT NULL,
+                bucket TEXT NOT NULL,
+                n INTEGER NOT NULL,
+                {colonnes},
+                PRIMARY KEY (device, bucket)
+            ) WITHOUT ROWID
+        """)
+
+
+def _upsert_sql(table):
+    maj = ["n = n + excluded.n"]
+    for v in VOIES:
+        maj.append(f"{v}_n = {v}_n + excluded.{v}_n")
+        maj.append(f"{v}_sum = {v}_sum + excluded.{v}_sum")
+        # min()/max() à plusieurs arguments renvoient NULL si l'un est NULL
+        maj.append(f"{v}_min = coalesce(min({v}_min, excluded.{v}_min), {v}_min, excluded.{v}_min)")
+        maj.append(f"{v}_max = coalesce(max({v}_max, excluded.{v}_max), {v}_max, excluded.{v}_max)")
+    return f"""
+        INSERT INTO {table} (device, bucket, {", ".join(COLONNES)})
+        VALUES ({", ".join("?" * (len(COLONNES) + 2))})
+        ON CONFLICT (device, bucket) DO UPDATE SET {", ".join(maj)}
+    """
+
+
+UPSERTS = {nom: _upsert_sql(table) for nom, (table, _) in RESOLUTIONS.items()}
+
+
+def _agreger(rows, seau):
+    acc = {}
+    for device, t, h, p, ts in rows:
+        cle = (device, seau(ts))
+        a = acc.get(cle)
+        if a is None:
+            a = acc[cle] = [0, 0, 0.0, None, None, 0, 0.0, None, None, 0, 0.0, None, None]
+        a[0] += 1
+        for j, v in ((1, t), (5, h), (9, p)):
+            if v is None:
+                continue
+            a[j] += 1
+            a[j + 1] += v
+            if a[j + 2] is None or v < a[j + 2]:
+                a[j + 2] = v
+            if a[j + 3] is None or v > a[j + 3]:
+                a[j + 3] = v
+    return [(device, bucket, *a) for (device, bucket), a in acc.items()]
+
+
+# Les trois résolutions en un passage : seaux calculés en secondes (5 min,
+# heure et jour tombent sur des multiples de leur durée depuis 1970), lignes
+# triées par (appareil, seau), puis sommes et extrêmes par tranche. Même
+# résultat que _agreger, aux arrondis de sommation près.
+def _agreger_numpy(rows):
+    devices, t, h, p, ts = zip(*rows)
+    noms, appareil = np.unique(np.array(devices), return_inverse=True)
+    secondes = np.array(ts, dtype="datetime64[s]").astype(np.int64)
+    valeurs = np.array((t, h, p), dtype=np.float64)  # None -> NaN
+    presentes = ~np.isnan(valeurs)
+    sommes = np.where(presentes, valeurs, 0.0)
+    minima = np.where(presentes, valeurs, np.inf)
+    maxima = np.where(presentes, valeurs, -np.inf)
+
+    resultats = {}
+    for nom, (_, duree) in RESOLUTIONS.items():
+        seaux = secondes // duree * duree
+        cles, groupe = np.unique(appareil.astype(np.int64) << 34 | seaux, return_inverse=True)
+        ordre = np.argsort(groupe, kind="stable")
+        n = np.bincount(groupe, minlength=len(cles))
+        debuts = np.cumsum(n) - n
+        colonnes = [n.tolist()]
+        for i in range(len(VOIES)):
+            n_voie = np.bincount(groupe, weights=presentes[i], minlength=len(cles)).astype(np.int64)
+            vides = np.flatnonzero(n_voie == 0).tolist()
+            colonnes.append(n_voie.tolist())
+            colonnes.append(np.bincount(groupe, weights=sommes[i], minlength=len(cles)).tolist())
+            for extremes, reduction in ((minima, np.minimum), (maxima, np.maximum)):
+                e = reduction.reduceat(extremes[i][ordre], debuts).tolist()
+                for j in vides:
+                    e[j] = None
+                colonnes.append(e)
+        instants = (cles & ((1 << 34) - 1)).astype("datetime64[s]")
+        buckets = np.char.replace(np.datetime_as_string(instants, unit="s"), "T", " ").tolist()
+        resultats[nom] = list(zip(noms[cles >> 34].tolist(), buckets, *colonnes))
+    return resultats
+
+
+# Appelé par ingest.write_rows, dans la transaction d'insertion
+def update_rollups(conn, rows):
+    if np is not None and len(rows) >= SEUIL_NUMPY:
+        for nom, seaux in _agreger_numpy(rows).items():
+            conn.executemany(UPSERTS[nom], seaux)
+        return
+    for nom, seau in SEAUX.items():
+        conn.executemany(UPSERTS[nom], _agreger(rows, seau))
+
+
+def _sources_backfill(conn):
+    yield conn
+    # Mois archivés : l'agrégation se fait dans l'archive, seuls les seaux
+    # remontent ; les mesures en retard de la partition chaude s'y ajoutent
+    for chemin, _ in archived_months(conn).values():
+        source = sqlite3.connect(f"file:{chemin}?mode=ro", uri=True)
+        try:
+            yield source
+        finally:
+            source.close()
+
+
+def _horizon(conn, niveau):
+    # Import local : retention dépend lui-même de ce module
+    from retention import horizon
+    return horizon(conn, niveau)
+
+
+def backfill(conn, depuis=None):
+    # Recalcul complet (ou à partir d'une date) depuis les mesures brutes.
+    # Avant la limite de rétention, les mesures brutes ont été supprimées :
+    # les agrégats de cette période sont les seuls qui restent et ne sont
+    # jamais recalculés.
+    purge = _horizon(conn, "brut")
+    if purge is not None and (depuis is None or format_ts(depuis) < purge):
+        depuis = parse_ts(purge)
+    agregats = ", ".join(f"COUNT({v}), TOTAL({v}), MIN({v}), MAX({v})" for v in VOIES)
+    for nom, (table, _) in RESOLUTIONS.items():
+        filtre = "timestamp IS NOT NULL AND device IS NOT NULL"
+        params = ()
+        if depuis is None:
+            conn.execute(f"DELETE FROM {table}")
+        else:
+            # Le seau contenant « depuis » est recalculé en entier
+            debut = SEAUX[nom](format_ts(depuis))
+            conn.execute(f"DELETE FROM {table} WHERE bucket >= ?", (debut,))
+            filtre += " AND timestamp >= ?"
+            params = (debut,)
+        for source in _sources_backfill(conn):
+            seaux = source.execute(f"""
+                SELECT device, {SEAUX_SQL[nom]} AS bucket, COUNT(*), {agregats}
+                FROM mesures
+                WHERE {filtre}
+                GROUP BY device, bucket
+            """, params)
+            conn.executemany(UPSERTS[nom], seaux)
+        # Jours compactés : agrégés en Python, par paquets (les seaux s'additionnent)
+        rows = blocks.iter_rows(conn, ["device", *VOIES, "timestamp"], None,
+                                parse_ts(params[0]) if params else None)
+        while True:
+            paquet = list(islice(rows, TAILLE_PAQUET))
+            if not paquet:
+                break
+            conn.executemany(UPSERTS[nom], _agreger(paquet, SEAUX[nom]))
+
+
+def choose_resolution(start, end, points_min=POINTS_MIN):
+    duree = (end - start).total_seconds()
+    choix = None
+    for nom, (_, secondes) in RESOLUTIONS.items():
+        if duree / secondes >= points_min:
+            choix = nom
+    return choix
+
+
+def query_rollup(conn, resolution, device, start, end):
+    table = RESOLUTIONS[resolution][0]
+    return conn.execute(f"""
+        SELECT bucket, n, {", ".join(COLONNES[1:])}
+        FROM {table}
+        WHERE device = ? AND bucket >= ? AND bucket < ?
+        ORDER BY bucket
+    """, (device, format_ts(start), format_ts(end))).fetchall()
+
+
+# Une plage qui commence avant la limite de rétention d'une résolution passe
+# à la suivante (mesures brutes -> 5 min -> heure -> jour)
+def _resolution_conservee(conn, resolution, start):
+    ordre = [None, *RESOLUTIONS]
+    i = ordre.index(resolution)
+    while i < len(ordre) - 1:
+        purge = _horizon(conn, ordre[i] or "brut")
+        if purge is None or format_ts(start) >= purge:
+            break
+        i += 1
+    return ordre[i]
+
+
+# Série (horodatage, température, humidité, pression) sur [start, end[ à la
+# résolution la plus grossière qui donne encore points_min points ; les
+# agrégats renvoient la moyenne du seau. Renvoie (résolution, lignes), avec
+# résolution None pour les mesures brutes.
+def query_series(conn, device, start, end, points_min=POINTS_MIN):
+    resolution = _resolution_conservee(conn, choose_resolution(start, end, points_min), start)
+    if resolution is None:
+        rows = select_range(conn, ["timestamp", "temperature", "humidity", "pressure"],
+                            [device], start, end)
+        return None, rows
+
+    table = RESOLUTIONS[resolution][0]
+    moyennes = ", ".join(f"{v}_sum / NULLIF({v}_n, 0)" for v in VOIES)
+    rows = conn.execute(f"""
+        SELECT bucket, {moyennes}
+        FROM {table}
+        WHERE device = ? AND bucket >= ? AND bucket < ?
+        ORDER BY bucket
+    """, (device, format_ts(start), format_ts(end))).fetchall()
+    return resolution, rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recalcule les tables d'agrégats")
+    parser.add_argument("db", nargs="?", default=DB_FILE)
+    parser.add_argument("--depuis", help="date de début YYYY-MM-DD (par défaut : tout)")
+    args = parser.parse_args()
+
+    depuis = datetime.strptime(args.depuis, "%Y-%m-%d") if args.depuis else None
+    conn = connect(args.db)
+    try:
+        migrate(conn, verbose=True)
+        t0 = time.perf_counter()
+        with conn:
+            backfill(conn, depuis)
+        print(f"Agrégats recalculés en {time.perf_counter() - t0:.1f} s")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+import argparse
+from datetime import datetime
+
+from db import DB_FILE, connect
+
+# Migrations versionnées du schéma de mesures_bme280.db.
+# La version courante est stockée dans PRAGMA user_version ; le serveur
+# applique les migrations au démarrage, les afficheurs vérifient seulement.
+
+# Forme unique et triable des horodatages stockés dans mesures.timestamp
+FORMAT_TIMESTAMP = "%Y-%m-%d %H:%M:%S"
+
+
+class SchemaError(RuntimeError):
+    pass
+
+
+def format_ts(dt):
+    return dt.strftime(FORMAT_TIMESTAMP)
+
+
+def parse_ts(ts):
+    return datetime.strptime(ts, FORMAT_TIMESTAMP)
+
+
+def _v1_table_mesures(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS mesures (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device TEXT,
+            temperature REAL,
+            humidity REAL,
+            pressure REAL,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def _v2_normaliser_horodatages(conn):
+    # 'YYYY-MM-DDTHH:MM:SS', secondes absentes, fractions... -> FORMAT_TIMESTAMP.
+    # Les valeurs que SQLite ne sait pas interpréter sont laissées telles quelles.
+    conn.execute("""
+        UPDATE mesures
+        SET timestamp = strftime('%Y-%m-%d %H:%M:%S', timestamp)
+        WHERE strftime('%Y-%m-%d %H:%M:%S', timestamp) IS NOT NULL
+          AND timestamp != strftime('%Y-%m-%d %H:%M:%S', timestamp)
+    """)
+
+
+def _v3_index_device_timestamp(conn):
+    # Index couvrant : les vues jour se servent sans toucher la table
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_mesures_device_ts
+        ON mesures (device, timestamp, temperature, humidity, pressure)
+    """)
+    conn.execute("ANALYZE mesures")
+
+
+def _v4_etat_ingestion(conn):
+    # Compteurs persistants du chemin d'ingestion (ex. dernier lot du journal
+    # de la file validé en base), mis à jour dans la même transaction que les lignes
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS ingest_etat (
+            cle TEXT PRIMARY KEY,
+            valeur INTEGER NOT NULL
+        )
+    """)
+
+
+def _v5_deduplication(conn):
+    # Lots déjà intégrés (identifiant fourni par le client ou empreinte du corps)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS lots_recus (
+            batch_id TEXT PRIMARY KEY,
+            recu_le TEXT NOT NULL
+        )
+    """)
+    # Plus récent horodatage intégré par appareil : les lignes plus anciennes
+    # d'un lot sont des renvois et sont écartées sans recherche ligne à ligne
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS device_watermark (
+            device TEXT PRIMARY KEY,
+            max_timestamp TEXT NOT NULL
+        )
+    """)
+    conn.execute("""
+        INSERT OR REPLACE INTO device_watermark (device, max_timestamp)
+        SELECT device, MAX(timestamp) FROM mesures
+        WHERE device IS NOT NULL AND timestamp IS NOT NULL
+        GROUP BY device
+    """)
+
+
+def _v6_agregats(conn):
+    # Import local : rollups dépend lui-même de ce module
+    from rollups import backfill, create_tables
+    create_tables(conn)
+    backfill(conn)
+
+
+def _v7_partitions(conn):
+    from partitions import create_table
+    create_table(conn)
+
+
+def _v8_catalogue(conn):
+    from catalogue import create_table, rebuild
+    create_table(conn)
+    rebuild(conn)
+
+
+def _v9_evenements(conn):
+    from anomalies import backfill, create_tables
+    create_tables(conn)
+    try:
+        backfill(conn)
+    except ImportError:
+        # Sans NumPy, la détection part des prochaines mesures ;
+        # python anomalies.py recalculera l'historique
+        pass
+
+
+def _v10_retention(conn):
+    from retention import create_table
+    create_table(conn)
+
+
+def _v11_blocs(conn):
+    # Table vide : les jours froids sont compactés par python blocks.py
+    from blocks import create_table
+    create_table(conn)
+
+
+MIGRATIONS = [
+    (1, "table mesures", _v1_table_mesures),
+    (2, "normalisation des horodatages", _v2_normaliser_horodatages),
+    (3, "index (device, timestamp)", _v3_index_device_timestamp),
+    (4, "état de l'ingestion", _v4_etat_ingestion),
+    (5, "déduplication des lots", _v5_deduplication),
+    (6, "tables d'agrégats 5 min / heure / jour", _v6_agregats),
+    (7, "partitions mensuelles archivées", _v7_partitions),
+    (8, "catalogue des appareils", _v8_catalogue),
+    (9, "détection des trous et anomalies", _v9_evenements),
+    (10, "rétention des données anciennes", _v10_retention),
+    (11, "blocs colonnes compressés des jours froids", _v11_blocs),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn, cible=SCHEMA_VERSION, verbose=False):
+    version = get_version(conn)
+    if version > SCHEMA_VERSION:
+        raise SchemaError(f"Base en version {version}, plus récente que ce code ({SCHEMA_VERSION})")
+    for numero, description, migration in MIGRATIONS:
+        if numero <= version or numero > cible:
+            continue
+        if verbose:
+            print(f"Migration {numero} : {description}...")
+        # Chaque migration et sa version sont validées ensemble
+        conn.execute("BEGIN")
+        try:
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {numero}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        version = numero
+    return version
+
+
+def check_schema(conn):
+    version = get_version(conn)
+    if version != SCHEMA_VERSION:
+        raise SchemaError(
+            f"Schéma en version {version}, version {SCHEMA_VERSION} attendue. "
+            f"Lancez : python schema.py")
+    return version
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrations du schéma de la base de mesures")
+    parser.add_argument("db", nargs="?", default=DB_FILE)
+    parser.add_argument("--status", action="store_true", help="affiche la version sans migrer")
+    args = parser.parse_args()
+
+    conn = connect(args.db)
+    try:
+        if args.status:
+            print(f"{args.db} : version {get_version(conn)} (code : {SCHEMA_VERSION})")
+        else:
+            version = migrate(conn, verbose=True)
+            print(f"{args.db} : schéma en version {version}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
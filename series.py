@@ -0,0 +1,140 @@
+import numpy as np
+
+from data_access import load_columns, load_series
+from dedup import generation
+from retention import horizon
+from rollups import POINTS_MIN
+from schema import format_ts, parse_ts
+
+# Séries temporelles réduites côté serveur pour /api/series.
+#
+# Les colonnes sont chargées en tableaux NumPy (horodatages en secondes,
+# valeurs en float64 avec NaN pour les mesures absentes), puis réduites à un
+# nombre de points cible en une passe vectorisée :
+#  - lttb : Largest-Triangle-Three-Buckets, garde dans chaque seau le point qui
+#    forme le plus grand triangle avec ses voisins (forme de la courbe) ;
+#  - minmax : garde le minimum et le maximum de chaque seau (pics conservés).
+# Les seaux sont de durée égale : un trou dans les mesures reste un trou.
+
+METHODES = ("lttb", "minmax")
+POINTS_DEFAUT = 1000
+POINTS_MAX = 20000
+
+
+def _seaux(x, nb):
+    # Numéro de seau de chaque point (x trié), et début de chaque seau non vide
+    etendue = x[-1] - x[0] + 1
+    ids = (x - x[0]) * nb // etendue
+    debuts = np.flatnonzero(np.diff(ids, prepend=-1))
+    return ids, debuts
+
+
+def _premier_par_seau(masque, ids):
+    # Indice du premier point vrai de chaque seau
+    indices = np.flatnonzero(masque)
+    _, premiers = np.unique(ids[indices], return_index=True)
+    return indices[premiers]
+
+
+def minmax(x, y, points):
+    if len(x) <= points:
+        return x, y
+    ids, debuts = _seaux(x, max(points // 2, 1))
+    tailles = np.diff(np.append(debuts, len(x)))
+    bas = np.minimum.reduceat(y, debuts)
+    haut = np.maximum.reduceat(y, debuts)
+    i_min = _premier_par_seau(y == np.repeat(bas, tailles), ids)
+    i_max = _premier_par_seau(y == np.repeat(haut, tailles), ids)
+    garde = np.unique(np.concatenate([i_min, i_max]))
+    return x[garde], y[garde]
+
+
+# Variante vectorisée de LTTB : le sommet A du triangle est la moyenne du seau
+# précédent (et non le point retenu dans ce seau), ce qui rend les seaux
+# indépendants et permet de tout calculer en une passe.
+def lttb(x, y, points):
+    if len(x) <= points or points < 3:
+        return x, y
+    xi, yi = x[1:-1], y[1:-1]
+    ids, debuts = _seaux(xi, points - 2)
+    tailles = np.diff(np.append(debuts, len(xi)))
+    xf = xi.astype(np.float64)
+    mx = np.add.reduceat(xf, debuts) / tailles
+    my = np.add.reduceat(yi, debuts) / tailles
+    ax = np.concatenate([[x[0]], mx[:-1]])
+    ay = np.concatenate([[y[0]], my[:-1]])
+    cx = np.concatenate([mx[1:], [x[-1]]])
+    cy = np.concatenate([my[1:], [y[-1]]])
+    ax, ay, cx, cy = (np.repeat(a, tailles) for a in (ax, ay, cx, cy))
+    aire = np.abs((ax - cx) * (yi - ay) - (ax - xf) * (cy - ay))
+    maxima = np.maximum.reduceat(aire, debuts)
+    garde = _premier_par_seau(aire == np.repeat(maxima, tailles), ids) + 1
+    garde = np.concatenate([[0], garde, [len(x) - 1]])
+    return x[garde], y[garde]
+
+
+REDUCTIONS = {"lttb": lttb, "minmax": minmax}
+
+
+def downsample(t, valeurs, points, methode="lttb"):
+    reduire = REDUCTIONS[methode]
+    x = t.astype(np.int64)
+    series = {}
+    for voie, y in valeurs.items():
+        valide = ~np.isnan(y)
+        xs, ys = reduire(x[valide], y[valide], points)
+        series[voie] = (xs.astype("datetime64[s]"), ys)
+    return series
+
+
+# Version des données d'une plage, pour l'ETag de /api/series. L'ingestion
+# refuse les mesures antérieures au filigrane de l'appareil : une plage qui se
+# termine avant lui ne peut plus changer, sauf si la rétention en supprime
+# les mesures brutes ou si dedup.py en supprime les doublons (compteur de
+# passes). Sinon la version suit le dernier id.
+def data_version(conn, device, start, end):
+    purge = horizon(conn, "brut")
+    suffixe = f"/{purge}" if purge is not None and format_ts(start) < purge else ""
+    doublons = generation(conn)
+    if doublons:
+        suffixe += f"/d{doublons}"
+    row = conn.execute("SELECT max_timestamp FROM device_watermark WHERE device = ?",
+                       (device,)).fetchone()
+    if row is not None and format_ts(end) <= row[0]:
+        return "close" + suffixe
+    max_id = conn.execute("SELECT MAX(id) FROM mesures").fetchone()[0]
+    return f"{row[0] if row else ''}/{max_id}{suffixe}"
+
+
+# Colonnes de [start, end[ ; avant la limite de rétention, les mesures brutes
+# sont remplacées par les moyennes des agrégats
+def _colonnes(conn, device, voies, start, end):
+    purge = horizon(conn, "brut")
+    if purge is None or format_ts(start) >= purge:
+        return load_columns(conn, [device], voies, start, end, dtype=np.float64)
+    limite = min(parse_ts(purge), end)
+    _, t_moy, moyennes = load_series(conn, device, start, limite, POINTS_MIN, dtype=np.float64)
+    if limite >= end:
+        return t_moy, {v: moyennes[v] for v in voies}
+    t, valeurs = load_columns(conn, [device], voies, limite, end, dtype=np.float64)
+    return np.concatenate([t_moy, t]), {v: np.concatenate([moyennes[v], valeurs[v]]) for v in voies}
+
+
+# Corps JSON de /api/series : une série colonne par voie
+def series_json(conn, device, voies, start, end, points=POINTS_DEFAUT, methode="lttb"):
+    t, valeurs = _colonnes(conn, device, voies, start, end)
+    series = downsample(t, valeurs, points, methode)
+    return {
+        "device": device,
+        "debut": format_ts(start),
+        "fin": format_ts(end),
+        "methode": methode,
+        "lignes": len(t),
+        "series": {
+            voie: {
+                "t": np.char.replace(np.datetime_as_string(xs, unit="s"), "T", " ").tolist(),
+                "v": np.round(ys, 2).tolist(),
+            }
+            for voie, (xs, ys) in series.items()
+        },
+    }
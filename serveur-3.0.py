@@ -1,10 +1,131 @@
-from flask import Flask, request, jsonify, render_template_string
-import sqlite3
-from datetime import datetime
+from flask import Flask, Response, g, request, jsonify, render_template_string, stream_template_string
+import cProfile
+from datetime import datetime, timedelta, timezone
+import hashlib
+import json
+import os
+import threading
+import time
 import urllib
+from werkzeug.http import is_resource_modified
+
+from anomalies import TYPES as TYPES_EVENEMENTS, list_events
+from binary_format import CONTENT_TYPE as BINARY_CONTENT_TYPE, decode_batch
+from broker import Broker, TooManySubscribers
+from catalogue import catalogue
+from db import ConnectionPool
+from ingest import BatchError, batch_id_for, validate_batch
+from ingest_queue import BatchQuarantined, IngestQueue, QueueFull
+from latest_cache import LatestCache
+import metrics
+from metrics import HTTP_DUREE, LOT_DECODAGE, LOT_LIGNES
+from retention import RetentionJob, parse_policy
+from schema import FORMAT_TIMESTAMP, check_schema, migrate
+
+try:
+    import series
+except ImportError:
+    # /api/series a besoin de NumPy ; le reste du serveur s'en passe
+    series = None
 
 app = Flask(__name__)
-DB_NAME = 'mesures_bme280.db'
+# Base de données : LOGGER_DB, ou mesures_bme280.db du répertoire courant
+DB_NAME = os.environ.get('LOGGER_DB', 'mesures_bme280.db')
+pool = ConnectionPool(DB_NAME)
+# Journal de la file d'ingestion : les lots acquittés mais pas encore en base
+ingest_queue = IngestQueue(pool, spool_path=DB_NAME + '.spool')
+# Dernières mesures de chaque appareil en mémoire, tenues à jour par la file
+NB_DERNIERES = 24
+cache = LatestCache(pool, taille=NB_DERNIERES)
+
+# Rétention des données anciennes en tâche de fond (retention.py), si
+# LOGGER_RETENTION donne une politique, ex. LOGGER_RETENTION="brut=180,lots=30"
+# (une chaîne vide garde la politique par défaut)
+retention_job = None
+if os.environ.get('LOGGER_RETENTION') is not None:
+    retention_job = RetentionJob(pool, parse_policy(os.environ['LOGGER_RETENTION']))
+
+# Heure du dernier commit par appareil, pour Last-Modified de /api/series
+DEMARRAGE = datetime.now(timezone.utc).replace(microsecond=0)
+derniere_ecriture = {}
+
+def noter_ecriture(rows):
+    maintenant = datetime.now(timezone.utc).replace(microsecond=0)
+    for device in {row[0] for row in rows}:
+        derniere_ecriture[device] = maintenant
+
+# Diffusion des mesures validées : /stream (SSE) et /api/poll (long-poll)
+broker = Broker()
+HEARTBEAT_S = 15
+
+# Abonnés des lignes validées. Sous plusieurs workers, wsgi.py les alimente
+# depuis la base pour que chacun voie aussi les écritures des autres.
+ABONNES_COMMIT = (cache.append, noter_ecriture, broker.publish)
+for abonne in ABONNES_COMMIT:
+    ingest_queue.on_commit(abonne)
+
+# Profilage d'une requête (cProfile) : en-tête « X-Profile: 1 » ou paramètre
+# « _profile=1 », si le serveur est lancé avec LOGGER_PROFILAGE=1. Le profil
+# est écrit dans PROFILS_DIR (lisible avec pstats ou snakeviz) et son chemin
+# renvoyé dans l'en-tête X-Profile-File. Une seule requête profilée à la fois.
+PROFILAGE = os.environ.get("LOGGER_PROFILAGE") == "1"
+PROFILS_DIR = "profils"
+_profilage = threading.Lock()
+
+@app.before_request
+def debut_requete():
+    g.t0 = time.perf_counter()
+    if PROFILAGE and (request.headers.get('X-Profile') or request.args.get('_profile')):
+        if _profilage.acquire(blocking=False):
+            g.profil = cProfile.Profile()
+            g.profil.enable()
+
+@app.after_request
+def fin_requete(response):
+    profil = g.pop('profil', None)
+    if profil is not None:
+        profil.disable()
+        _profilage.release()
+        os.makedirs(PROFILS_DIR, exist_ok=True)
+        chemin = os.path.join(PROFILS_DIR, f"{request.endpoint}-{datetime.now():%Y%m%d-%H%M%S-%f}.prof")
+        profil.dump_stats(chemin)
+        response.headers['X-Profile-File'] = chemin
+    # Pour les réponses en flux (/data, /stream), jusqu'au premier octet
+    route = request.url_rule.rule if request.url_rule is not None else "inconnue"
+    HTTP_DUREE.observe(time.perf_counter() - g.t0, route, request.method, response.status_code)
+    return response
+
+@app.teardown_request
+def nettoyer_requete(exc):
+    # Exception non interceptée : after_request n'a pas été appelé
+    profil = g.pop('profil', None)
+    if profil is not None:
+        profil.disable()
+        _profilage.release()
+
+@metrics.collector
+def etat_serveur():
+    fichiers = [({"fichier": "base"}, DB_NAME), ({"fichier": "wal"}, DB_NAME + "-wal")]
+    file_stats = ingest_queue.stats
+    return [
+        ("logger_db_size_bytes", "gauge", "Taille des fichiers de la base",
+         [(e, os.path.getsize(f) if os.path.exists(f) else 0) for e, f in fichiers]),
+        ("logger_ingest_queue_depth", "gauge", "Lots en attente d'écriture", [({}, ingest_queue.depth())]),
+        ("logger_ingest_batches_total", "counter", "Lots reçus par la file, par issue",
+         [({"issue": "acceptes"}, file_stats["lots_recus"]), ({"issue": "refuses"}, file_stats["lots_refuses"])]),
+        ("logger_ingest_rows_total", "counter", "Lignes écrites ou ignorées (doublons, filigrane)",
+         [({"issue": "inserees"}, file_stats["lignes"]), ({"issue": "ignorees"}, file_stats["lignes_ignorees"])]),
+        ("logger_ingest_errors_total", "counter", "Groupes en erreur (retentés)", [({}, file_stats["erreurs"])]),
+        ("logger_ingest_quarantined_total", "counter", "Lots mis en quarantaine après échecs répétés",
+         [({}, file_stats["lots_quarantaine"])]),
+        ("logger_cache_requests_total", "counter", "Lectures du cache des dernières mesures",
+         [({"issue": "hit"}, cache.stats["hits"]), ({"issue": "miss"}, cache.stats["misses"])]),
+        ("logger_stream_subscribers", "gauge", "Abonnés SSE connectés", [({}, broker.info()["abonnes"])]),
+        ("logger_retention_rows_deleted_total", "counter", "Lignes supprimées par la rétention, par niveau",
+         [({"niveau": n}, retention_job.stats[n]) for n in ("brut", "5min", "heure", "lots")]
+         if retention_job else []),
+        ("logger_process_pid", "gauge", "Processus (worker) ayant répondu", [({}, os.getpid())]),
+    ]
 
 # HTML de la page d'accueil
 HTML_PAGE = """
@@ -18,11 +139,38 @@ HTML_PAGE = """
     <h1>Données capteurs ESP (extrait)</h1>
     <ul>
         <li><a href="/data">Voir les 24 dernières mesures de chaque ESP</a></li>
+        <li><a href="/latest">Dernière mesure de chaque ESP (JSON)</a></li>
+        <li><a href="/devices">Catalogue des appareils (JSON)</a></li>
+        <li><a href="/api/events">Derniers trous et anomalies détectés (JSON)</a></li>
     </ul>
 </body>
 </html>
 """
 
+# Page /data : un tableau par appareil, rendu en flux par Jinja
+DATA_PAGE = """
+<h1>Données : {{ n }} dernières mesures par appareil</h1>
+{% for device, rows in appareils %}
+<h2>Appareil : {{ device }}</h2>
+<table border="1" cellpadding="4" cellspacing="0">
+    <tr>
+        <th>Horodatage</th>
+        <th>Température (°C)</th>
+        <th>Humidité (%)</th>
+        <th>Pression (hPa)</th>
+    </tr>
+    {% for _, temperature, humidity, pressure, timestamp in rows %}
+    <tr>
+        <td>{{ timestamp }}</td>
+        <td>{{ temperature }}</td>
+        <td>{{ humidity }}</td>
+        <td>{{ pressure }}</td>
+    </tr>
+    {% endfor %}
+</table><br>
+{% endfor %}
+"""
+
 @app.route('/')
 def index():
     return render_template_string(HTML_PAGE)
@@ -30,50 +178,8 @@ def index():
 @app.route('/data')
 def get_data():
     try:
-        conn = sqlite3.connect(DB_NAME)
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
-
-        cur.execute("SELECT DISTINCT device FROM mesures")
-        devices = [row[0] for row in cur.fetchall()]
-
-        html_output = "<h1>Données : 24 dernières mesures par appareil</h1>"
-
-        for device in devices:
-            cur.execute("""
-                SELECT device, temperature, humidity, pressure, timestamp
-                FROM mesures
-                WHERE device = ?
-                ORDER BY datetime(timestamp) DESC
-                LIMIT 24
-            """, (device,))
-            rows = cur.fetchall()
-
-            html_output += f"<h2>Appareil : {device}</h2>"
-            html_output += """
-                <table border="1" cellpadding="4" cellspacing="0">
-                    <tr>
-                        <th>Horodatage</th>
-                        <th>Température (°C)</th>
-                        <th>Humidité (%)</th>
-                        <th>Pression (hPa)</th>
-                    </tr>
-            """
-
-            for row in reversed(rows):
-                html_output += f"""
-                    <tr>
-                        <td>{row['timestamp']}</td>
-                        <td>{row['temperature']}</td>
-                        <td>{row['humidity']}</td>
-                        <td>{row['pressure']}</td>
-                    </tr>
-                """
-
-            html_output += "</table><br>"
-
-        conn.close()
-        return html_output
+        appareils = cache.snapshot(NB_DERNIERES)
+        return Response(stream_template_string(DATA_PAGE, appareils=appareils, n=NB_DERNIERES))
 
     except Exception as e:
         print(f"Erreur dans /data : {e}")
@@ -82,33 +188,204 @@ def get_data():
 @app.route('/receive_batch', methods=['POST'])
 def receive_batch():
     try:
-        data = request.get_json()
-        if not data:
-            return "Aucune donnée reçue ou format incorrect", 400
-
-        conn = sqlite3.connect(DB_NAME)
-        cur = conn.cursor()
-
-        for entry in data:
-            cur.execute("""
-                INSERT INTO mesures (device, temperature, humidity, pressure, timestamp)
-                VALUES (?, ?, ?, ?, ?)
-            """, (
-                entry.get('device'),
-                entry.get('temperature'),
-                entry.get('humidity'),
-                entry.get('pressure'),
-                entry.get('timestamp')
-            ))
-
-        conn.commit()
-        conn.close()
-        return "Données insérées avec succès", 200
+        t0 = time.perf_counter()
+        # Format binaire compact si demandé, JSON sinon (firmware actuel)
+        if request.mimetype == BINARY_CONTENT_TYPE:
+            format_lot = "binaire"
+            rows = decode_batch(request.get_data())
+        else:
+            format_lot = "json"
+            rows = validate_batch(request.get_json(silent=True))
+        LOT_DECODAGE.observe(time.perf_counter() - t0, format_lot)
+        LOT_LIGNES.observe(len(rows), format_lot)
+        batch_id = batch_id_for(request.get_data(), request.headers.get('X-Batch-Id'))
+        lot = ingest_queue.submit(rows, batch_id)
+        # Acquitté dès que le lot est journalisé : l'écriture en base suit
+        return jsonify({
+            "message": "Données reçues",
+            "lot": lot,
+            "lignes": len(rows),
+            "total_ms": round((time.perf_counter() - t0) * 1000, 3),
+        }), 202
 
+    except BatchError as e:
+        return str(e), 400
+    except QueueFull as e:
+        return str(e), 503, {"Retry-After": str(e.retry_after)}
+    except BatchQuarantined as e:
+        return str(e), 500
     except Exception as e:
         print(f"Erreur dans /receive_batch : {e}")
         return f"Erreur serveur : {e}", 500
 
+def mesure_json(row):
+    device, temperature, humidity, pressure, timestamp = row
+    return {"device": device, "temperature": temperature, "humidity": humidity,
+            "pressure": pressure, "timestamp": timestamp}
+
+@app.route('/latest')
+def latest_all():
+    # Dernière mesure de chaque appareil
+    return jsonify([mesure_json(rows[-1]) for _, rows in cache.snapshot(1) if rows])
+
+@app.route('/latest/<device>')
+def latest_device(device):
+    n = request.args.get('n', 1, type=int)
+    rows = cache.latest(device, n)
+    if not rows:
+        return f"Appareil inconnu : {device}", 404
+    return jsonify([mesure_json(row) for row in rows])
+
+# Catalogue des appareils : période couverte, nombre de mesures, dernières valeurs
+@app.route('/devices')
+def list_devices():
+    with pool.connection() as conn:
+        return jsonify(catalogue(conn))
+
+# Flux SSE des nouvelles mesures : /stream?device=abricot_BME1&device=abricot_BME2
+# (tous les appareils sans filtre). Reprise après coupure via Last-Event-ID.
+@app.route('/stream')
+def stream():
+    devices = request.args.getlist('device') or None
+    depuis = request.headers.get('Last-Event-ID', type=int)
+    try:
+        sub = broker.subscribe(devices, depuis)
+    except TooManySubscribers as e:
+        return str(e), 503, {"Retry-After": "30"}
+
+    def evenements():
+        yield "retry: 3000\n\n"
+        while True:
+            publications, perdues = sub.get(HEARTBEAT_S)
+            if perdues:
+                # Client trop lent : des publications ont été écartées
+                yield f"event: perte\ndata: {perdues}\n\n"
+            for seq, rows in publications:
+                yield f"id: {seq}\nevent: mesures\ndata: {json.dumps([mesure_json(r) for r in rows])}\n\n"
+            if not publications and not perdues:
+                yield ": keepalive\n\n"
+
+    response = Response(evenements(), mimetype='text/event-stream',
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    response.call_on_close(lambda: broker.unsubscribe(sub))
+    return response
+
+# Long-poll : /api/poll?device=abricot_BME1&depuis=<dernier>&timeout=25
+# Sans « depuis », n'attend que les mesures à venir.
+@app.route('/api/poll')
+def api_poll():
+    devices = request.args.getlist('device') or None
+    depuis = request.args.get('depuis', type=int)
+    if depuis is None:
+        depuis = broker.last_seq()
+    timeout = min(max(request.args.get('timeout', 25.0, type=float), 0.0), 60.0)
+    dernier, publications, perte = broker.poll(depuis, devices, timeout)
+    return jsonify({
+        "dernier": dernier,
+        "perte": perte,
+        "mesures": [mesure_json(row) for _, rows in publications for row in rows],
+    })
+
+def lire_date(texte):
+    for fmt in (FORMAT_TIMESTAMP, "%Y-%m-%d"):
+        try:
+            return datetime.strptime(texte, fmt)
+        except ValueError:
+            pass
+    raise ValueError(f"Date invalide : {texte!r} (YYYY-MM-DD ou YYYY-MM-DD HH:MM:SS)")
+
+# Série réduite côté serveur :
+# /api/series?device=abricot_BME1&voies=temperature,humidity&debut=2025-01-01&fin=2026-01-01&points=1000&methode=lttb
+@app.route('/api/series')
+def api_series():
+    if series is None:
+        return "NumPy n'est pas installé sur le serveur", 501
+    device = request.args.get('device')
+    if not device:
+        return "Paramètre 'device' manquant", 400
+    voies = request.args.get('voies', ','.join(series.VOIES)).split(',')
+    inconnues = [v for v in voies if v not in series.VOIES]
+    if inconnues:
+        return f"Voie(s) inconnue(s) : {', '.join(inconnues)}", 400
+    methode = request.args.get('methode', 'lttb')
+    if methode not in series.METHODES:
+        return f"Méthode inconnue : {methode} ({', '.join(series.METHODES)})", 400
+    points = request.args.get('points', series.POINTS_DEFAUT, type=int)
+    points = min(max(points, 3), series.POINTS_MAX)
+    try:
+        end = lire_date(request.args['fin']) if 'fin' in request.args else datetime.now()
+        start = lire_date(request.args['debut']) if 'debut' in request.args else end - timedelta(days=1)
+    except ValueError as e:
+        return str(e), 400
+    if start >= end:
+        return "'debut' doit précéder 'fin'", 400
+
+    try:
+        with pool.connection() as conn:
+            version = series.data_version(conn, device, start, end)
+            cle = f"{version}|{device}|{','.join(voies)}|{start}|{end}|{points}|{methode}"
+            etag = hashlib.sha1(cle.encode("utf-8")).hexdigest()
+            last_modified = derniere_ecriture.get(device, DEMARRAGE)
+            # Revalidation : rien n'est relu si le client a déjà cette version
+            if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                response = Response(status=304)
+            else:
+                response = jsonify(series.series_json(conn, device, voies, start, end, points, methode))
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.cache_control.no_cache = True
+        return response
+
+    except Exception as e:
+        print(f"Erreur dans /api/series : {e}")
+        return f"Erreur serveur : {e}", 500
+
+# Trous, capteurs muets ou figés, valeurs aberrantes, les plus récents d'abord :
+# /api/events?device=abricot_BME1&type=trou&type=muet&debut=2025-01-01&fin=2025-02-01&limite=100
+@app.route('/api/events')
+def api_events():
+    devices = request.args.getlist('device') or None
+    types = request.args.getlist('type') or None
+    inconnus = [t for t in types or () if t not in TYPES_EVENEMENTS]
+    if inconnus:
+        return f"Type(s) inconnu(s) : {', '.join(inconnus)} ({', '.join(TYPES_EVENEMENTS)})", 400
+    limite = min(max(request.args.get('limite', 1000, type=int), 1), 10000)
+    try:
+        start = lire_date(request.args['debut']) if 'debut' in request.args else None
+        end = lire_date(request.args['fin']) if 'fin' in request.args else None
+    except ValueError as e:
+        return str(e), 400
+
+    with pool.connection() as conn:
+        rows = list_events(conn, devices, start, end, types, limite)
+    return jsonify([{"device": device, "type": type_, "voie": voie or None, "debut": debut, "fin": fin,
+                     "n": n, "valeur": valeur}
+                    for device, type_, voie, debut, fin, n, valeur in rows])
+
+@app.route('/cache')
+def cache_stats():
+    return jsonify(cache.info())
+
+@app.route('/metrics')
+def metrics_prometheus():
+    return Response(metrics.exposition(), content_type=metrics.CONTENT_TYPE)
+
+# Sonde de disponibilité (répartiteur de charge, superviseur)
+@app.route('/health')
+def health():
+    etat = {"pid": os.getpid(), "file": ingest_queue.depth(), "redacteur": ingest_queue.is_running()}
+    try:
+        with pool.connection() as conn:
+            etat["schema"] = check_schema(conn)
+    except Exception as e:
+        etat.update(statut="indisponible", erreur=str(e))
+        return jsonify(etat), 503
+    if ingest_queue.is_full():
+        etat.update(statut="saturé", retry_after=ingest_queue.retry_after())
+        return jsonify(etat), 503
+    etat["statut"] = "ok"
+    return jsonify(etat)
+
 @app.route('/routes')
 def list_routes():
     output = []
@@ -132,5 +409,11 @@ def get_time():
 
 
 if __name__ == '__main__':
+    # Serveur de développement ; en production : gunicorn -c gunicorn.conf.py wsgi:app
     print("Démarrage du serveur Flask...")
+    with pool.connection() as conn:
+        migrate(conn, verbose=True)
+    cache.warm()
+    if retention_job:
+        retention_job.start()
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,307 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import heapq
+import json
+import os
+import random
+import sqlite3
+import statistics
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from binary_format import CONTENT_TYPE as BINARY_CONTENT_TYPE, encode_payload
+from simulation import PAS_MESURE, build_payload
+
+# Générateur de charge sans interface : des centaines d'ESP simulés envoient
+# leurs lots à /receive_batch, comme simul_esp8266_gui.py mais en parallèle.
+#
+# Chaque ESP a sa cadence (--intervalle) ; un ordonnanceur confie les envois
+# dus à un pool de threads, chacun avec sa session HTTP (connexions gardées
+# ouvertes). Intervalle nul : chaque ESP renvoie dès la réponse reçue.
+#
+# Tempête de reconnexion (--tempete s) : à cet instant toutes les connexions
+# sont coupées et tous les ESP renvoient en même temps --rattrapage lots
+# accumulés, comme après une coupure du Wi-Fi ou un redémarrage du serveur.
+#
+# Résultats en JSON (--sortie), comparables d'une version à l'autre
+# (--comparer ancien.json).
+
+URL_DEFAUT = "http://localhost:5000/receive_batch"
+PREFIXE = "charge"
+
+
+def percentile(valeurs, p):
+    if not valeurs:
+        return None
+    valeurs = sorted(valeurs)
+    return valeurs[min(len(valeurs) - 1, int(len(valeurs) * p / 100))]
+
+
+def resume_latences(latences):
+    if not latences:
+        return {"n": 0}
+    return {
+        "n": len(latences),
+        "p50_ms": round(percentile(latences, 50), 2),
+        "p90_ms": round(percentile(latences, 90), 2),
+        "p99_ms": round(percentile(latences, 99), 2),
+        "max_ms": round(max(latences), 2),
+        "moyenne_ms": round(statistics.fmean(latences), 2),
+    }
+
+
+# Taille de la base (avec son WAL) et nombre de mesures
+def etat_base(db_path):
+    if not db_path:
+        return None
+    octets = sum(os.path.getsize(p) for p in (db_path, db_path + "-wal") if os.path.exists(p))
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        mesures = conn.execute("SELECT MAX(id) FROM mesures").fetchone()[0] or 0
+    finally:
+        conn.close()
+    return {"octets": octets, "mesures": mesures}
+
+
+class Simulation:
+    def __init__(self, args):
+        self.args = args
+        self.debut_donnees = datetime.strptime(args.debut, "%Y-%m-%d %H:%M:%S")
+        # Prochain lot de chaque ESP (numéro, pour l'horodatage)
+        self.lots = [0] * args.esp
+        self.rngs = [random.Random(i) for i in range(args.esp)]
+        self._local = threading.local()
+        # Incrémenté pour forcer chaque thread à rouvrir sa session
+        self._generation = 0
+        self._lock = threading.Lock()
+
+        self.statuts = {}
+        self.latences = {"normal": [], "tempete": []}
+        self.lignes_acquittees = 0
+        self.erreurs = []
+
+    # -- HTTP --------------------------------------------------------------
+
+    def _session(self):
+        local = self._local
+        if getattr(local, "generation", None) != self._generation:
+            if getattr(local, "session", None) is not None:
+                local.session.close()
+            local.session = requests.Session()
+            local.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+            local.generation = self._generation
+        return local.session
+
+    def couper_connexions(self):
+        self._generation += 1
+
+    def _poster(self, payload):
+        if self.args.format == "binaire":
+            corps, entetes = encode_payload(payload), {"Content-Type": BINARY_CONTENT_TYPE}
+        else:
+            corps, entetes = json.dumps(payload).encode(), {"Content-Type": "application/json"}
+        if self.args.nouvelle_connexion:
+            # Comme simul_esp8266_gui.py : une connexion par envoi
+            return requests.post(self.args.url, data=corps, headers=entetes, timeout=self.args.timeout)
+        return self._session().post(self.args.url, data=corps, headers=entetes, timeout=self.args.timeout)
+
+    # -- un envoi ----------------------------------------------------------
+
+    # Renvoie le délai avant le prochain envoi de cet ESP imposé par le
+    # serveur (Retry-After), ou None
+    def envoyer(self, esp, nb_lots, phase):
+        mesures = self.args.mesures * nb_lots
+        debut = self.debut_donnees + PAS_MESURE * self.args.mesures * self.lots[esp]
+        payload = build_payload(f"{PREFIXE}{esp:04d}", debut, mesures, rng=self.rngs[esp])
+        t0 = time.perf_counter()
+        try:
+            reponse = self._poster(payload)
+            statut = reponse.status_code
+        except requests.RequestException as e:
+            statut = type(e).__name__
+            reponse = None
+        latence = (time.perf_counter() - t0) * 1000
+        with self._lock:
+            self.statuts[str(statut)] = self.statuts.get(str(statut), 0) + 1
+            if reponse is not None and reponse.ok:
+                self.latences[phase].append(latence)
+                self.lignes_acquittees += len(payload)
+                self.lots[esp] += nb_lots
+            elif reponse is None and len(self.erreurs) < 20:
+                self.erreurs.append(statut)
+        if reponse is not None and reponse.status_code == 503:
+            return float(reponse.headers.get("Retry-After", 1))
+        return None
+
+    # -- ordonnanceur ------------------------------------------------------
+
+    def lancer(self):
+        args = self.args
+        rng = random.Random(0)
+        t0 = time.monotonic()
+        # Départs étalés sur un intervalle pour ne pas tous tirer ensemble
+        echeances = [(t0 + rng.uniform(0, args.intervalle), esp, 1) for esp in range(args.esp)]
+        heapq.heapify(echeances)
+        fin = t0 + args.duree
+        tempete = t0 + args.tempete if args.tempete is not None else None
+        debut_tempete = None
+        en_vol = threading.Semaphore(args.threads)
+        termine = threading.Condition()
+        retours = []
+
+        def tache(esp, nb_lots, phase, prevu):
+            try:
+                attente = self.envoyer(esp, nb_lots, phase)
+            finally:
+                en_vol.release()
+            # Boucle ouverte : l'envoi suivant est dû à l'heure prévue, même
+            # si celui-ci a pris du retard
+            suivant = max(prevu + args.intervalle, time.monotonic()) if args.intervalle else time.monotonic()
+            if attente is not None:
+                suivant = time.monotonic() + attente
+            with termine:
+                retours.append((suivant, esp, 1))
+                termine.notify()
+
+        with ThreadPoolExecutor(max_workers=args.threads) as pool:
+            while True:
+                maintenant = time.monotonic()
+                if maintenant >= fin:
+                    break
+                if tempete is not None and maintenant >= tempete and debut_tempete is None:
+                    debut_tempete = maintenant
+                    print(f"Tempête : {args.esp} ESP reconnectés avec {args.rattrapage} lots chacun")
+                    self.couper_connexions()
+                    echeances = [(maintenant, esp, args.rattrapage) for _, esp, _ in echeances]
+                    heapq.heapify(echeances)
+                with termine:
+                    for retour in retours:
+                        heapq.heappush(echeances, retour)
+                    retours.clear()
+                    if not echeances or echeances[0][0] > maintenant:
+                        prochain = echeances[0][0] if echeances else fin
+                        termine.wait(min(prochain, fin) - maintenant)
+                        continue
+                prevu, esp, nb_lots = heapq.heappop(echeances)
+                en_vol.acquire()
+                phase = "tempete" if debut_tempete is not None and nb_lots > 1 else "normal"
+                pool.submit(tache, esp, nb_lots, phase, prevu)
+        # Les ESP en vol au moment de l'arrêt sont attendus : leurs envois comptent
+        self.duree_reelle = time.monotonic() - t0
+
+
+def attendre_base(db_path, attendu, delai):
+    # Les lots acquittés peuvent encore être dans la file d'ingestion
+    fin = time.monotonic() + delai
+    etat = etat_base(db_path)
+    while etat["mesures"] < attendu and time.monotonic() < fin:
+        time.sleep(0.2)
+        etat = etat_base(db_path)
+    return etat
+
+
+def resultats(args, sim, avant, apres):
+    normal = sim.latences["normal"]
+    tempete = sim.latences["tempete"]
+    lots_ok = len(normal) + len(tempete)
+    r = {
+        "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "parametres": {k: v for k, v in vars(args).items() if k not in ("sortie", "comparer")},
+        "duree_s": round(sim.duree_reelle, 2),
+        "statuts": sim.statuts,
+        "erreurs": sim.erreurs,
+        "lots_acquittes": lots_ok,
+        "lignes_acquittees": sim.lignes_acquittees,
+        "debit_lots_s": round(lots_ok / sim.duree_reelle, 1),
+        "debit_lignes_s": round(sim.lignes_acquittees / sim.duree_reelle, 1),
+        "latence": resume_latences(normal + tempete),
+        "latence_normale": resume_latences(normal),
+    }
+    if tempete:
+        r["latence_tempete"] = resume_latences(tempete)
+    if avant is not None:
+        r["base"] = {
+            "mesures_ajoutees": apres["mesures"] - avant["mesures"],
+            "octets_ajoutes": apres["octets"] - avant["octets"],
+            "octets_par_mesure": round((apres["octets"] - avant["octets"]) /
+                                       max(apres["mesures"] - avant["mesures"], 1), 1),
+            "taille_finale": apres["octets"],
+        }
+    return r
+
+
+def afficher(r):
+    print(f"Durée : {r['duree_s']} s   statuts HTTP : {r['statuts']}")
+    print(f"Débit : {r['debit_lots_s']} lots/s, {r['debit_lignes_s']} lignes/s")
+    for cle in ("latence_normale", "latence_tempete"):
+        if cle in r and r[cle]["n"]:
+            l = r[cle]
+            print(f"{cle:<16} n={l['n']:<7} p50 {l['p50_ms']} ms  p90 {l['p90_ms']} ms"
+                  f"  p99 {l['p99_ms']} ms  max {l['max_ms']} ms")
+    if "base" in r:
+        b = r["base"]
+        print(f"Base : +{b['mesures_ajoutees']} mesures, +{b['octets_ajoutes'] / 1e6:.1f} Mo"
+              f" ({b['octets_par_mesure']} o/mesure)")
+
+
+def comparer(r, chemin):
+    with open(chemin, encoding="utf-8") as f:
+        ancien = json.load(f)
+    print(f"Comparaison avec {chemin} ({ancien['date']}) :")
+    lignes = [("débit lots/s", ancien["debit_lots_s"], r["debit_lots_s"])]
+    for cle in ("p50_ms", "p99_ms"):
+        lignes.append((f"latence {cle}", ancien["latence"].get(cle), r["latence"].get(cle)))
+    if "base" in ancien and "base" in r:
+        lignes.append(("octets/mesure", ancien["base"]["octets_par_mesure"], r["base"]["octets_par_mesure"]))
+    for nom, avant, apres in lignes:
+        if avant is None or apres is None:
+            continue
+        ecart = f"{(apres - avant) / avant * 100:+.1f} %" if avant else ""
+        print(f"  {nom:<16} {avant:>10} -> {apres:<10} {ecart}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Charge de /receive_batch par des ESP simulés")
+    parser.add_argument("--url", default=URL_DEFAUT)
+    parser.add_argument("--esp", type=int, default=200, help="ESP simulés")
+    parser.add_argument("--mesures", type=int, default=6, help="mesures par capteur et par lot")
+    parser.add_argument("--intervalle", type=float, default=1.0,
+                        help="secondes entre deux lots d'un ESP (0 : au plus vite)")
+    parser.add_argument("--duree", type=float, default=30.0)
+    parser.add_argument("--threads", type=int, default=32, help="envois simultanés au plus")
+    parser.add_argument("--format", choices=("json", "binaire"), default="json")
+    parser.add_argument("--nouvelle-connexion", action="store_true",
+                        help="une connexion par envoi, comme le simulateur graphique")
+    parser.add_argument("--tempete", type=float, help="instant (s) de la tempête de reconnexion")
+    parser.add_argument("--rattrapage", type=int, default=10, help="lots renvoyés par ESP à la tempête")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--debut", default=datetime.now().strftime("%Y-%m-%d %H:00:00"),
+                        help="horodatage de la première mesure")
+    parser.add_argument("--db", help="base du serveur, pour mesurer sa croissance")
+    parser.add_argument("--sortie", help="fichier JSON des résultats")
+    parser.add_argument("--comparer", help="résultats JSON d'un passage précédent")
+    args = parser.parse_args()
+
+    avant = etat_base(args.db)
+    sim = Simulation(args)
+    print(f"{args.esp} ESP, lots de {args.mesures * 2} lignes toutes les {args.intervalle} s,"
+          f" {args.threads} threads, {args.duree} s -> {args.url}")
+    sim.lancer()
+    apres = attendre_base(args.db, avant["mesures"] + sim.lignes_acquittees, 30) if avant else None
+
+    r = resultats(args, sim, avant, apres)
+    afficher(r)
+    if args.sortie:
+        with open(args.sortie, "w", encoding="utf-8") as f:
+            json.dump(r, f, indent=2, ensure_ascii=False)
+        print(f"Résultats écrits dans {args.sortie}")
+    if args.comparer:
+        comparer(r, args.comparer)
+
+
+if __name__ == "__main__":
+    main()
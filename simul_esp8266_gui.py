@@ -1,19 +1,20 @@
 import tkinter as tk
 from tkinter import ttk
-from datetime import datetime, timedelta
-import random
+from datetime import datetime
 import requests
-import json
 import threading
 import time
 
+from binary_format import CONTENT_TYPE as BINARY_CONTENT_TYPE, encode_payload
+from simulation import build_payload
+
 SERVER_URL = "http://localhost:5000/receive_batch"
 
 class SimulESPApp(tk.Tk):
     def __init__(self):
         super().__init__()
         self.title("Simulateur ESP8266")
-        self.geometry("400x330")
+        self.geometry("400x380")
 
         self.create_widgets()
         self.running = False
@@ -34,6 +35,10 @@ class SimulESPApp(tk.Tk):
         self.nb_entry.insert(0, "24")
         self.nb_entry.pack()
 
+        ttk.Label(self, text="Format d'envoi :").pack()
+        self.format_var = tk.StringVar(value="JSON")
+        ttk.Combobox(self, textvariable=self.format_var, values=["JSON", "Binaire"], state="readonly").pack()
+
         self.loop_var = tk.BooleanVar()
         ttk.Checkbutton(self, text="Envoi périodique (1/min)", variable=self.loop_var).pack()
 
@@ -78,21 +83,14 @@ class SimulESPApp(tk.Tk):
             n = int(self.nb_entry.get())
             device = self.device_var.get()
 
-            payload = []
-            for i in range(n):
-                ts = (start_time + timedelta(minutes=5*i)).strftime("%Y-%m-%d %H:%M:%S")
-                for bme in ["BME1", "BME2"]:
-                    entry = {
-                        "device": f"{device}_{bme}",
-                        "temperature": round(22 + random.uniform(-2, 2), 2),
-                        "humidity": round(50 + random.uniform(-10, 10), 2),
-                        "pressure": round(1013 + random.uniform(-5, 5), 2),
-                        "timestamp": ts
-                    }
-                    payload.append(entry)
-
-            r = requests.post(SERVER_URL, json=payload)
-            self.status.config(text=f"Envoyé ({len(payload)} mesures) - HTTP {r.status_code}")
+            payload = build_payload(device, start_time, n)
+
+            if self.format_var.get() == "Binaire":
+                corps = encode_payload(payload)
+                r = requests.post(SERVER_URL, data=corps, headers={"Content-Type": BINARY_CONTENT_TYPE})
+            else:
+                r = requests.post(SERVER_URL, json=payload)
+            self.status.config(text=f"Envoyé ({len(payload)} mesures, {self.format_var.get()}) - HTTP {r.status_code}")
         except Exception as e:
             self.status.config(text=f"Erreur : {e}")
 
@@ -0,0 +1,26 @@
+from datetime import timedelta
+import random
+
+# Modèle de charge utile commun au simulateur graphique et aux benchmarks :
+# un ESP envoie, pour chaque pas de temps, une mesure par capteur BME280.
+CAPTEURS_BME = ["BME1", "BME2"]
+PAS_MESURE = timedelta(minutes=5)
+
+
+def build_entry(device, bme, ts, rng=random):
+    return {
+        "device": f"{device}_{bme}",
+        "temperature": round(22 + rng.uniform(-2, 2), 2),
+        "humidity": round(50 + rng.uniform(-10, 10), 2),
+        "pressure": round(1013 + rng.uniform(-5, 5), 2),
+        "timestamp": ts
+    }
+
+
+def build_payload(device, start_time, n, step=PAS_MESURE, rng=random):
+    payload = []
+    for i in range(n):
+        ts = (start_time + step * i).strftime("%Y-%m-%d %H:%M:%S")
+        for bme in CAPTEURS_BME:
+            payload.append(build_entry(device, bme, ts, rng))
+    return payload
@@ -0,0 +1,36 @@
+import math
+
+import pytest
+
+import blocks
+
+HORODATAGES = ["2025-01-01 00:00:00", "2025-01-01 00:10:00", "2025-01-01 00:20:07",
+               "2025-01-01 00:30:00", "2025-01-01 00:40:00"]
+
+
+def _identiques(a, b):
+    return a is b is None or a == b or (a is not None and b is not None and math.isnan(a) and math.isnan(b))
+
+
+@pytest.mark.parametrize("voies", [
+    # centièmes exacts, avec une valeur absente
+    ([21.5, 21.52, None, 21.49, 22.0], [50.0, 50.1, 50.2, 50.3, 50.4], [None] * 5),
+    # valeurs inexactes : flottants 64 bits
+    ([21.503, 21.5, 21.5, 21.5, 21.5], [1 / 3, None, 2 / 3, 0.1, 0.2], [1013.25] * 5),
+    # valeurs infinies, et une valeur dont les centièmes dépassent les flottants
+    ([21.5, math.inf, 21.6, -math.inf, None], [50.0, 50.0, 1e308, 50.0, 50.0], [-math.inf] * 5),
+])
+def test_aller_retour(voies):
+    rows = list(zip(HORODATAGES, *voies))
+    blob = blocks.encode_block(rows)
+
+    lues = blocks.decode_rows(blob)
+    assert [r[0] for r in lues] == HORODATAGES
+    for ligne, attendue in zip(lues, rows):
+        assert all(_identiques(a, b) for a, b in zip(ligne[1:], attendue[1:])), (ligne, attendue)
+
+    np = pytest.importorskip("numpy")
+    t, valeurs = blocks.decode_arrays(blob, dtype=np.float64)
+    assert t.astype("datetime64[s]").astype(str).tolist() == [h.replace(" ", "T") for h in HORODATAGES]
+    for v, attendues in zip(valeurs, voies):
+        assert all(_identiques(None if math.isnan(x) else x, a) for x, a in zip(v.tolist(), attendues))
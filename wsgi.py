@@ -0,0 +1,113 @@
+import importlib.util
+import os
+import threading
+
+from db import FileLock
+from ingest_queue import IngestQueue
+from live import TailFollower
+from schema import migrate
+
+# Point d'entrée de production de serveur-3.0.py :
+#
+#   gunicorn -c gunicorn.conf.py wsgi:app      (Linux, plusieurs workers)
+#   waitress-serve --port=5000 wsgi:app        (Windows, un seul processus)
+#
+# Chaque worker est un processus avec sa propre file d'ingestion. Pour que
+# la base reste cohérente :
+# - le démarrage (migrations, reprise du journal du serveur de
+#   développement) se fait sous un verrou de fichier, un worker après
+#   l'autre ;
+# - les groupes sont écrits sous un verrou commun (<base>.ecriture.lock) :
+#   un seul rédacteur à la fois, sans attente active sur SQLITE_BUSY ;
+# - un lot n'est acquitté qu'une fois en base : les lots successifs d'un
+#   ESP, reçus par des workers différents, sont écrits dans l'ordre ;
+# - le cache des dernières mesures et la diffusion SSE sont alimentés en
+#   relisant la base (live.TailFollower) : chaque worker voit aussi les
+#   mesures reçues par les autres. Les publications sont numérotées par
+#   mesures.id : les curseurs de /api/poll et de /stream (Last-Event-ID)
+#   valent d'un worker à l'autre.
+#
+# Le serveur de développement ne doit pas tourner en même temps sur la
+# même base.
+#
+# Importer ce module démarre le worker : migrations de la base, verrous
+# (<base>.demarrage.lock, <base>.ecriture.lock), threads d'ingestion et de
+# relais. La base est celle de LOGGER_DB (voir serveur-3.0.py), par défaut
+# mesures_bme280.db du répertoire courant :
+#
+#   LOGGER_DB=/var/lib/logger/mesures.db gunicorn -c gunicorn.conf.py wsgi:app
+
+RELAIS_S = 0.2
+
+ICI = os.path.dirname(os.path.abspath(__file__))
+_spec = importlib.util.spec_from_file_location("serveur", os.path.join(ICI, "serveur-3.0.py"))
+serveur = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(serveur)
+app = serveur.app
+
+DB_NAME = serveur.DB_NAME
+
+
+# Lots acquittés par le serveur de développement mais pas encore en base
+def reprendre_journal(ecriture):
+    journal = serveur.ingest_queue
+    if not journal.spool_path or not os.path.exists(journal.spool_path):
+        return
+    journal.verrou = ecriture
+    journal.start()
+    if journal.depth():
+        print(f"Reprise de {journal.depth()} lot(s) du journal {journal.spool_path}")
+    journal.stop()
+
+
+def relayer(follower, arret):
+    while not arret.wait(RELAIS_S):
+        try:
+            rows = follower.poll(ids=True)
+        except Exception as e:
+            print(f"Erreur du relais des nouvelles mesures : {e}")
+            continue
+        if not rows:
+            continue
+        ids = [row[0] for row in rows]
+        # Même forme que les lignes de la file : (device, t, h, p, timestamp)
+        rows = [(device, t, h, p, ts) for _, device, ts, t, h, p in rows]
+        for abonne in serveur.ABONNES_COMMIT:
+            try:
+                if abonne == serveur.broker.publish:
+                    # Numéro commun à tous les workers : le plus grand id relayé
+                    abonne(rows, seq=follower.dernier_id, ids=ids)
+                elif abonne == serveur.cache.append:
+                    # Un tampon rempli depuis la base écarte les lignes déjà lues
+                    abonne(rows, ids=ids)
+                else:
+                    abonne(rows)
+            except Exception as e:
+                print(f"Erreur d'un abonné du relais : {e}")
+
+
+def demarrer():
+    ecriture = FileLock(DB_NAME + ".ecriture.lock")
+    with FileLock(DB_NAME + ".demarrage.lock"):
+        with serveur.pool.connection() as conn:
+            migrate(conn, verbose=True)
+        reprendre_journal(ecriture)
+        # Aucune écriture entre les deux : chaque ligne est soit dans le
+        # cache rempli, soit relayée ensuite, jamais les deux ni aucune
+        with ecriture:
+            serveur.cache.warm()
+            follower = TailFollower(DB_NAME)
+            serveur.broker.start_at(follower.dernier_id)
+    # Les routes lisent serveur.ingest_queue à chaque requête
+    serveur.ingest_queue = IngestQueue(serveur.pool, verrou=ecriture, attendre_commit=True)
+    serveur.ingest_queue.start()
+    if serveur.retention_job:
+        # Une passe à la fois sur l'ensemble des workers, sous le verrou d'écriture
+        serveur.retention_job.verrou = ecriture
+        serveur.retention_job.start()
+    arret = threading.Event()
+    threading.Thread(target=relayer, args=(follower, arret), name="relais", daemon=True).start()
+    print(f"Worker {os.getpid()} prêt")
+
+
+demarrer()